@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load test for the map's web server: a number of clients request raw_data
+# for viewports around a location, as fast as they can, for a while. Run it
+# against each server setup in turn, for example:
+#
+#   python runserver.py -os -P 5000
+#   python Tools/Benchmarks/load_test.py --url http://127.0.0.1:5000
+#
+#   gunicorn --workers 4 --bind 127.0.0.1:5000 wsgi:app
+#   python Tools/Benchmarks/load_test.py --url http://127.0.0.1:5000
+
+import argparse
+import random
+import sys
+import time
+from threading import Thread
+
+import requests
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+# One map client, moving its viewport around a bit between requests.
+def client(args, seed, stop, latencies, errors):
+    rnd = random.Random(seed)
+    session = requests.Session()
+    url = args.url.rstrip('/') + '/raw_data'
+
+    while time.time() < stop:
+        lat = args.lat + rnd.uniform(-args.spread, args.spread)
+        lng = args.lng + rnd.uniform(-args.spread, args.spread)
+        params = {
+            'swLat': lat - args.viewport / 2, 'swLng': lng - args.viewport,
+            'neLat': lat + args.viewport / 2, 'neLng': lng + args.viewport,
+            'pokemon': 'true', 'pokestops': 'true', 'gyms': 'true',
+            'scanned': 'false', 'spawnpoints': 'false'}
+        start = time.time()
+        try:
+            r = session.get(url, params=params, timeout=30)
+            r.content
+            if r.status_code != 200:
+                errors.append(r.status_code)
+                continue
+        except requests.RequestException as e:
+            errors.append(repr(e))
+            continue
+        latencies.append(time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--duration', type=int, default=30,
+                        help='Seconds to run for.')
+    parser.add_argument('--lat', type=float, default=40.75)
+    parser.add_argument('--lng', type=float, default=-73.97)
+    parser.add_argument('--spread', type=float, default=0.01,
+                        help='Degrees viewports move around the location.')
+    parser.add_argument('--viewport', type=float, default=0.02,
+                        help='Viewport height in degrees.')
+    args = parser.parse_args()
+
+    stop = time.time() + args.duration
+    latencies = []
+    errors = []
+    threads = [Thread(target=client,
+                      args=(args, i, stop, latencies, errors))
+               for i in range(args.clients)]
+    start = time.time()
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    print('{} clients, {:.1f} seconds against {}'.format(
+        args.clients, elapsed, args.url))
+    print('requests: {}, errors: {}, requests/sec: {:.1f}'.format(
+        len(latencies), len(errors), len(latencies) / elapsed))
+    print('latency ms: p50 {:.1f}, p95 {:.1f}, p99 {:.1f}'.format(
+        percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+        percentile(latencies, 99) * 1000))
+    if errors:
+        print('first error: {}'.format(errors[0]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Compares the size and encode time of the raw_data payload formats against
+# the jsonify() output the map used to get.
+#
+#   python Tools/Benchmarks/payload_formats.py --pokemon 5000
+
+import argparse
+import calendar
+import sys
+import time
+import zlib
+from datetime import datetime
+
+from flask import Flask, jsonify
+from flask.json import JSONEncoder
+
+import synthetic
+
+sys.path.insert(0, synthetic.ROOT)
+from pogom import encoding  # noqa: E402
+
+
+# The encoder raw_data used with jsonify().
+class OldJSONEncoder(JSONEncoder):
+
+    def default(self, obj):
+        try:
+            if isinstance(obj, datetime):
+                if obj.utcoffset() is not None:
+                    obj = obj - obj.utcoffset()
+                millis = int(
+                    calendar.timegm(obj.timetuple()) * 1000 +
+                    obj.microsecond / 1000
+                )
+                return millis
+            iterable = iter(obj)
+        except TypeError:
+            pass
+        else:
+            return list(iterable)
+        return JSONEncoder.default(self, obj)
+
+
+app = Flask(__name__)
+app.json_encoder = OldJSONEncoder
+
+
+def encode_jsonify(d):
+    # jQuery sends X-Requested-With, which turns off pretty printing.
+    with app.test_request_context(
+            headers={'X-Requested-With': 'XMLHttpRequest'}):
+        return jsonify(d).get_data()
+
+
+def encoder(mimetype):
+    return lambda d: ''.join(encoding.iter_payload(d, mimetype))
+
+
+def best_time(func, payload, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        body = func(payload)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return body, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pokemon', type=int, default=5000)
+    parser.add_argument('--pokestops', type=int, default=2000)
+    parser.add_argument('--gyms', type=int, default=300)
+    parser.add_argument('--scanned', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    payload = synthetic.map_payload(args.pokemon, args.pokestops, args.gyms,
+                                    args.scanned)
+
+    formats = [('jsonify (old)', encode_jsonify),
+               ('json', encoder(encoding.JSON)),
+               ('columns', encoder(encoding.COLUMNS))]
+    if encoding.msgpack is not None:
+        formats.append(('msgpack', encoder(encoding.MSGPACK)))
+    else:
+        print('msgpack is not installed, skipping it.')
+    if encoding.brotli is None:
+        print('brotli is not installed, skipping it.')
+
+    print('{:<14} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'format', 'encode ms', 'bytes', 'gzip', 'gzip ms', 'brotli'))
+    for name, func in formats:
+        body, elapsed = best_time(func, payload, args.repeat)
+        start = time.time()
+        gzipped = zlib.compress(body, 6)
+        gzip_ms = (time.time() - start) * 1000
+        brotli_size = '-'
+        if encoding.brotli is not None:
+            brotli_size = len(encoding.brotli.compress(body, quality=5))
+        print('{:<14} {:>10.1f} {:>10} {:>10} {:>10.1f} {:>10}'.format(
+            name, elapsed * 1000, len(body), len(gzipped), gzip_ms,
+            brotli_size))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
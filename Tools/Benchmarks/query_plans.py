@@ -0,0 +1,423 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Times the model query helpers the map and the scanner use on a synthetic
+# city, at growing data sizes, and checks the query plans of the SQL they
+# run. Exits with an error when a query scans a whole table, so it can be
+# run before merging changes to the models or their indexes:
+#
+#   python Tools/Benchmarks/query_plans.py --spawnpoints 1000,10000
+#   python Tools/Benchmarks/query_plans.py --db-type mysql --db-name bench \
+#       --db-user root --db-pass secret
+#
+# The tables are dropped and created again, use a scratch database.
+
+import argparse
+import logging
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+import synthetic
+
+sys.path.insert(0, synthetic.ROOT)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-type', default='sqlite',
+                        choices=('sqlite', 'mysql'))
+    parser.add_argument('--db', default='query_plans.db',
+                        help='SQLite file, replaced on every run.')
+    parser.add_argument('--db-name')
+    parser.add_argument('--db-user')
+    parser.add_argument('--db-pass')
+    parser.add_argument('--db-host', default='127.0.0.1')
+    parser.add_argument('--db-port', type=int, default=3306)
+    parser.add_argument('--lat', type=float, default=40.75)
+    parser.add_argument('--lng', type=float, default=-73.97)
+    parser.add_argument('--size', type=float, default=0.2,
+                        help='Degrees the city is spread over.')
+    parser.add_argument('--spawnpoints', default='1000,10000',
+                        help='Spawnpoints in the city for each data size, '
+                        'the other tables grow along with them.')
+    parser.add_argument('--days', type=int, default=2,
+                        help='Days of Pokemon history.')
+    parser.add_argument('--spawns-per-hour', type=int, default=1,
+                        help='Sightings per spawnpoint and hour.')
+    parser.add_argument('--viewport', type=float, default=0.02,
+                        help='Viewport height in degrees.')
+    parser.add_argument('--steps', type=int, default=10,
+                        help='Steps of the hexes looked up.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Times each helper is timed.')
+    parser.add_argument('--allow-scan', action='append', default=[],
+                        metavar='TABLE',
+                        help='Table that may be scanned, can be repeated.')
+    parser.add_argument('--plans', action='store_true',
+                        help='Print the query plans.')
+    return parser.parse_args()
+
+
+# pogom reads its arguments on import, the database options are passed on.
+def pogom_argv(args):
+    argv = [sys.argv[0], '--only-server', '-k', 'benchmark',
+            '-l', '{},{}'.format(args.lat, args.lng),
+            '--db-type', args.db_type]
+    if args.db_type == 'mysql':
+        argv += ['--db-name', args.db_name, '--db-user', args.db_user,
+                 '--db-pass', args.db_pass, '--db-host', args.db_host,
+                 '--db-port', str(args.db_port)]
+    else:
+        argv += ['--db', args.db]
+    return argv
+
+
+# Collects the statements peewee runs.
+class QueryLog(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.queries = None
+
+    def emit(self, record):
+        if self.queries is not None and isinstance(record.msg, tuple):
+            self.queries.append(record.msg)
+
+    def capture(self, fn):
+        self.queries = []
+        try:
+            result = fn()
+        finally:
+            queries, self.queries = self.queries, None
+        return result, queries
+
+
+# Adds the rows of a synthetic city in steps, so the helpers can be timed
+# at every size without building the smaller sizes again. Every spawnpoint
+# spawns each hour at its own second, the other tables grow with the
+# number of spawnpoints.
+class City(object):
+
+    def __init__(self, m, db, args):
+        self.m = m
+        self.db = db
+        self.args = args
+        self.rnd = random.Random(1)
+        self.now = datetime.utcnow().replace(microsecond=0)
+        self.spawnpoints = 0
+        self.gym_ids = []
+        self.trainers = set()
+        self.encounters = 0
+
+    def insert(self, model, rows):
+        if not rows:
+            return
+        size = max(999 // len(rows[0]), 1)
+        with self.db.atomic():
+            for part in self.m.chunks(rows, size):
+                model.insert_many(part).execute()
+
+    def location(self):
+        return synthetic.random_location(
+            self.rnd, (self.args.lat, self.args.lng), self.args.size)
+
+    def grow(self, spawnpoints):
+        count = spawnpoints - self.spawnpoints
+        if count <= 0:
+            return
+        step = len(self.gym_ids) + self.spawnpoints
+        self.spawnpoints = spawnpoints
+
+        points = []
+        for i in xrange(count):
+            lat, lng = self.location()
+            points.append({
+                'id': '%x' % self.rnd.getrandbits(48),
+                'latitude': lat,
+                'longitude': lng,
+                'last_scanned': self.now - timedelta(
+                    seconds=self.rnd.randint(0, 3600)),
+                'latest_seen': self.rnd.randint(0, 1799),
+                'earliest_unseen': self.rnd.randint(1800, 3599),
+            })
+        self.m.add_s2cells(points)
+        self.insert(self.m.SpawnPoint, points)
+
+        self.add_pokemon(points)
+        self.add_forts(count, step)
+
+    def sighting(self, point, disappear_time):
+        self.encounters += 1
+        return {
+            'encounter_id': 'e%d' % self.encounters,
+            'spawnpoint_id': point['id'],
+            'pokemon_id': self.rnd.randint(1, 151),
+            'latitude': point['latitude'],
+            'longitude': point['longitude'],
+            's2cell': point['s2cell'],
+            'disappear_time': disappear_time,
+            'last_modified': disappear_time - timedelta(minutes=15),
+        }
+
+    # History first, an hour at a time like pokemon_history_loop moves it,
+    # then the Pokemon that are still up. The rollups get all of them at
+    # once, it's the same as db_updater adding them as they come.
+    def add_pokemon(self, points):
+        m = self.m
+        spawns = self.args.spawns_per_hour
+        added = []
+        for hour in xrange(self.args.days * 24, 0, -1):
+            start = self.now - timedelta(hours=hour)
+            rows = [self.sighting(p, start + timedelta(
+                seconds=(p['earliest_unseen'] + i * 3600 // spawns) % 3600))
+                for p in points for i in xrange(spawns)]
+            self.insert(m.Pokemon, rows)
+            added.extend(rows)
+
+        rows = [self.sighting(p, self.now + timedelta(
+            seconds=self.rnd.randint(60, 1800)))
+            for p in points if self.rnd.random() < 0.5]
+        self.insert(m.ActivePokemon, rows)
+        added.extend(rows)
+
+        for model in (m.PokemonHourlyCount, m.SpawnpointDailyCount,
+                      m.SpawnpointTimeCount):
+            m.update_rollup(model, added, self.db)
+
+    def add_forts(self, count, step):
+        m = self.m
+        center = (self.args.lat, self.args.lng)
+
+        stops = synthetic.pokestop_rows(count // 4, center, self.args.size,
+                                        seed=step)
+        m.add_s2cells(stops)
+        self.insert(m.Pokestop, stops)
+
+        scanned = synthetic.scanned_rows(count // 3, center, self.args.size,
+                                         seed=step)
+        m.add_s2cells(scanned)
+        self.insert(m.ScannedLocation, scanned)
+
+        gyms = synthetic.gym_rows(max(count // 20, 1), center,
+                                  self.args.size, seed=step).values()
+        details = []
+        members = []
+        pokemon = []
+        trainers = []
+        for gym in gyms:
+            details.append({'gym_id': gym['gym_id'],
+                            'name': gym.pop('name'), 'url': ''})
+            for p in gym.pop('pokemon'):
+                uid = '%x' % self.rnd.getrandbits(63)
+                members.append({'gym_id': gym['gym_id'], 'pokemon_uid': uid,
+                                'last_scanned': self.now})
+                pokemon.append({'pokemon_uid': uid,
+                                'pokemon_id': p['pokemon_id'],
+                                'cp': p['pokemon_cp'],
+                                'move_1': self.rnd.randint(200, 250),
+                                'move_2': self.rnd.randint(13, 140),
+                                'trainer_name': p['trainer_name']})
+                if p['trainer_name'] not in self.trainers:
+                    self.trainers.add(p['trainer_name'])
+                    trainers.append({'name': p['trainer_name'],
+                                     'team': gym['team_id'],
+                                     'level': p['trainer_level']})
+            gym['last_modified'] -= timedelta(minutes=5)
+        gyms = list(gyms)
+        m.add_s2cells(gyms)
+        self.insert(m.Gym, gyms)
+        self.insert(m.GymDetails, details)
+        self.insert(m.GymMember, members)
+        self.insert(m.GymPokemon, pokemon)
+        self.insert(m.Trainer, trainers)
+        self.gym_ids.extend(gym['gym_id'] for gym in gyms)
+
+
+# The helpers timed, as (name, function) pairs. Caches in front of the
+# database are cleared before each call.
+def helpers(m, city, args):
+    lat, lng = args.lat, args.lng
+    bounds = (lat - args.viewport / 2, lng - args.viewport,
+              lat + args.viewport / 2, lng + args.viewport)
+    moved = (bounds[0] + args.viewport / 4, bounds[1], bounds[2] +
+             args.viewport / 4, bounds[3])
+    since = int(time.mktime((city.now - timedelta(minutes=1)).timetuple()) *
+                1000)
+    center = (lat, lng)
+    gym_id = city.gym_ids[0]
+
+    return (
+        ('get_active', lambda: m.Pokemon.get_active(*bounds)),
+        ('get_active since', lambda: m.Pokemon.get_active(
+            *bounds, timestamp=since)),
+        ('get_active moved', lambda: m.Pokemon.get_active(
+            *moved, oSwLat=bounds[0], oSwLng=bounds[1], oNeLat=bounds[2],
+            oNeLng=bounds[3])),
+        ('get_stops', lambda: m.Pokestop.get_stops(*bounds)),
+        ('get_stops lured', lambda: m.Pokestop.get_stops(
+            *bounds, lured=True)),
+        ('get_gyms', lambda: m.Gym.get_gyms(*bounds)),
+        ('get_recent', lambda: m.ScannedLocation.get_recent(*bounds)),
+        ('get_seen', lambda: m.Pokemon.get_seen(timedelta(hours=6))),
+        ('get_appearances', lambda: m.Pokemon.get_appearances(
+            16, timedelta(days=1))),
+        ('get_spawnpoints', lambda: m.Pokemon.get_spawnpoints(*bounds)),
+        ('get_spawnpoints since', lambda: m.Pokemon.get_spawnpoints(
+            *bounds, timestamp=since)),
+        ('get_spawnpoints_in_hex', lambda: m.Pokemon.get_spawnpoints_in_hex(
+            center, args.steps)),
+        ('ScannedLocation.select_in_hex',
+         lambda: m.ScannedLocation.select_in_hex(center, args.steps)),
+        ('SpawnPoint.select_in_hex',
+         lambda: m.SpawnPoint.select_in_hex(center, args.steps)),
+        ('get_gym', lambda: m.Gym.get_gym(gym_id)),
+    )
+
+
+def clear_caches(m):
+    m.cache.clear()
+    m.gym_cache.details.clear()
+
+
+def result_size(result):
+    if isinstance(result, dict) and 'pokemon' in result:
+        return len(result['pokemon'])
+    if isinstance(result, dict) and 'gym_id' in result:
+        return 1
+    return len(result)
+
+
+# Return the plan of a SELECT as a list of (table, detail, full scan)
+# tuples.
+def explain(db, db_type, sql, params):
+    if db_type == 'mysql':
+        cursor = db.execute_sql('EXPLAIN ' + sql, params)
+        columns = [c[0] for c in cursor.description]
+        plan = []
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            table = row['table'] or ''
+            # Derived tables and subquery results are scanned in memory.
+            full = (row['type'] in ('ALL', 'index') and
+                    not table.startswith('<'))
+            plan.append((table, '{} key={} rows={} {}'.format(
+                row['type'], row['key'], row['rows'], row['Extra'] or ''),
+                full))
+        return plan
+
+    plan = []
+    for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params):
+        detail = row[-1]
+        match = re.match(r'(SCAN|SEARCH) (?:TABLE )?(\w+)', detail)
+        table = match.group(2) if match else ''
+        # Scans of subqueries and temporary b-trees don't touch the tables,
+        # automatic indexes are built from a scan of one.
+        full = bool(match) and table not in ('SUBQUERY', 'CONSTANT') and (
+            match.group(1) == 'SCAN' or 'AUTOMATIC' in detail)
+        plan.append((table, detail, full))
+    return plan
+
+
+def measure(m, db, query_log, name, fn, args):
+    clear_caches(m)
+    result, queries = query_log.capture(fn)
+
+    scans = []
+    plans = []
+    seen = set()
+    for sql, params in queries:
+        if not sql.lstrip().upper().startswith('SELECT') or sql in seen:
+            continue
+        seen.add(sql)
+        plan = explain(db, args.db_type, sql, params)
+        plans.append((sql, plan))
+        scans.extend(table for table, detail, full in plan
+                     if full and table not in args.allow_scan)
+
+    times = []
+    for i in xrange(args.repeat):
+        clear_caches(m)
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+
+    return {'name': name, 'rows': result_size(result),
+            'queries': len(queries), 'times': times, 'plans': plans,
+            'scans': sorted(set(scans))}
+
+
+def main():
+    args = parse_args()
+    if args.db_type == 'mysql' and not args.db_name:
+        print('--db-name is needed for MySQL.')
+        return 2
+    if args.db_type == 'sqlite':
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+
+    sys.argv = pogom_argv(args)
+    from flask import Flask
+    from pogom import config
+    from pogom import models as m
+    config['ROOT_PATH'] = synthetic.ROOT
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logging.getLogger('pogom').setLevel(logging.WARNING)
+    peewee_log = logging.getLogger('peewee')
+    peewee_log.propagate = False
+    peewee_log.setLevel(logging.DEBUG)
+    query_log = QueryLog()
+    peewee_log.addHandler(query_log)
+
+    db = m.init_database(Flask(__name__))
+    m.drop_tables(db)
+    m.create_tables(db)
+    city = City(m, db, args)
+
+    failed = []
+    for size in sorted(int(s) for s in args.spawnpoints.split(',')):
+        start = time.time()
+        city.grow(size)
+        print('\n{} spawnpoints, {} Pokemon, built in {:.1f} seconds'.format(
+            size, m.Pokemon.select().count() +
+            m.ActivePokemon.select().count(), time.time() - start))
+        print('{:<30} {:>7} {:>7} {:>9} {:>9}  {}'.format(
+            'helper', 'rows', 'queries', 'p50 ms', 'p95 ms', 'scans'))
+
+        for name, fn in helpers(m, city, args):
+            r = measure(m, db, query_log, name, fn, args)
+            print('{:<30} {:>7} {:>7} {:>9.2f} {:>9.2f}  {}'.format(
+                name, r['rows'], r['queries'],
+                percentile(r['times'], 50) * 1000,
+                percentile(r['times'], 95) * 1000,
+                ', '.join(r['scans'])))
+            if args.plans or r['scans']:
+                for sql, plan in r['plans']:
+                    print('    ' + sql)
+                    for table, detail, full in plan:
+                        print('      {} {}'.format('!' if full else ' ',
+                                                   detail))
+            if r['scans']:
+                failed.append((size, name, r['scans']))
+
+    if failed:
+        print('\nFull table scans:')
+        for size, name, tables in failed:
+            print('  {} at {} spawnpoints: {}'.format(
+                name, size, ', '.join(tables)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
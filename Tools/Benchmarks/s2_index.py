@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Compares viewport queries on a large synthetic Pokemon table using a
+# (latitude, longitude) index against looking rows up by S2 cell ranges.
+# The table is built in an SQLite file once and reused by later runs:
+#
+#   python Tools/Benchmarks/s2_index.py --rows 10000000 --db /tmp/s2.db
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+import synthetic
+
+sys.path.insert(0, synthetic.ROOT)
+from pogom import geoindex  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+# Fills the table in batches, the S2 cells computed like parse_map does.
+def build(db, args):
+    db.execute('CREATE TABLE pokemon (encounter_id INTEGER PRIMARY KEY, '
+               'pokemon_id INTEGER, latitude REAL, longitude REAL, '
+               's2cell BIGINT, disappear_time INTEGER)')
+    rnd = np.random.RandomState(1)
+    batch = 100000
+    for start in xrange(0, args.rows, batch):
+        count = min(batch, args.rows - start)
+        lats = args.lat + rnd.uniform(-args.size, args.size, count) / 2
+        lngs = args.lng + rnd.uniform(-args.size, args.size, count) / 2
+        db.executemany('INSERT INTO pokemon VALUES (?, ?, ?, ?, ?, ?)', zip(
+            xrange(start, start + count),
+            rnd.randint(1, 152, count).tolist(), lats.tolist(),
+            lngs.tolist(), geoindex.s2_leaves(lats, lngs).tolist(),
+            rnd.randint(0, 3600, count).tolist()))
+    db.execute('CREATE INDEX pokemon_latitude_longitude '
+               'ON pokemon (latitude, longitude)')
+    db.execute('CREATE INDEX pokemon_s2cell ON pokemon (s2cell)')
+    db.commit()
+
+
+def box_query(db, bounds):
+    return db.execute(
+        'SELECT * FROM pokemon INDEXED BY pokemon_latitude_longitude '
+        'WHERE latitude >= ? AND longitude >= ? '
+        'AND latitude <= ? AND longitude <= ?', bounds)
+
+
+# The box is still checked, on the rows of the covering. The unary plus
+# keeps SQLite off the latitude index, which the map's tables don't have.
+def s2_query(db, bounds):
+    ranges = geoindex.s2_ranges(*bounds)
+    sql = ('SELECT * FROM pokemon WHERE ({}) '
+           'AND +latitude >= ? AND +longitude >= ? '
+           'AND +latitude <= ? AND +longitude <= ?').format(
+               ' OR '.join(['s2cell BETWEEN ? AND ?'] * len(ranges)))
+    params = [v for r in ranges for v in r] + list(bounds)
+    return db.execute(sql, params)
+
+
+def run(db, query, viewports):
+    times = []
+    rows = 0
+    for bounds in viewports:
+        start = time.time()
+        rows += len(query(db, bounds).fetchall())
+        times.append(time.time() - start)
+    return times, rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='s2_index.db',
+                        help='SQLite file, built if it doesn\'t exist.')
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--lat', type=float, default=40.75)
+    parser.add_argument('--lng', type=float, default=-73.97)
+    parser.add_argument('--size', type=float, default=2.0,
+                        help='Degrees the Pokemon are spread over.')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='Viewports queried per size.')
+    args = parser.parse_args()
+
+    exists = os.path.exists(args.db)
+    db = sqlite3.connect(args.db)
+    if not exists:
+        start = time.time()
+        build(db, args)
+        print('built {} rows in {:.1f} seconds'.format(
+            args.rows, time.time() - start))
+    print('{} rows in {}'.format(
+        db.execute('SELECT COUNT(*) FROM pokemon').fetchone()[0], args.db))
+
+    rnd = random.Random(2)
+    print('{:>9} {:>9} {:>7} {:>12} {:>12} {:>12} {:>12}'.format(
+        'viewport', 'rows', 'ranges', 'box p50 ms', 'box p95 ms',
+        's2 p50 ms', 's2 p95 ms'))
+    for viewport in (0.005, 0.02, 0.05, 0.1, 0.2):
+        viewports = []
+        for i in xrange(args.queries):
+            lat = args.lat + rnd.uniform(-args.size, args.size) / 3
+            lng = args.lng + rnd.uniform(-args.size, args.size) / 3
+            viewports.append((lat - viewport / 2, lng - viewport,
+                              lat + viewport / 2, lng + viewport))
+        # Computing the coverings counts, they're new to the cache here.
+        box_times, box_rows = run(db, box_query, viewports)
+        s2_times, s2_rows = run(db, s2_query, viewports)
+        ranges = sum(len(geoindex.s2_ranges(*b)) for b in viewports)
+        if box_rows != s2_rows:
+            print('row counts differ: {} != {}'.format(box_rows, s2_rows))
+        print('{:>9} {:>9} {:>7} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f}'
+              .format(viewport, box_rows // len(viewports),
+                      ranges // len(viewports),
+                      percentile(box_times, 50) * 1000,
+                      percentile(box_times, 95) * 1000,
+                      percentile(s2_times, 50) * 1000,
+                      percentile(s2_times, 95) * 1000))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
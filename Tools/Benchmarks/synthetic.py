@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Synthetic map data for the benchmarks. Rows look like the ones the map
+# queries return, spread over a square area around a center location.
+
+import base64
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+
+def load_pokemon_data():
+    with open(os.path.join(ROOT, 'static', 'data', 'pokemon.json')) as f:
+        return json.load(f)
+
+
+def random_location(rnd, center, size):
+    return (center[0] + rnd.uniform(-size, size) / 2,
+            center[1] + rnd.uniform(-size, size) / 2)
+
+
+# Pokemon rows as returned by Pokemon.get_active(), with names, rarities
+# and types filled in.
+def pokemon_rows(count, center=(40.75, -73.97), size=0.2, seed=1):
+    rnd = random.Random(seed)
+    data = load_pokemon_data()
+    now = datetime.utcnow()
+    spawnpoints = max(count // 4, 1)
+
+    rows = []
+    for i in xrange(count):
+        pokemon_id = rnd.randint(1, 151)
+        info = data[str(pokemon_id)]
+        lat, lng = random_location(rnd, center, size)
+        encountered = rnd.random() < 0.3
+        rows.append({
+            'encounter_id': base64.b64encode(str(rnd.getrandbits(63))),
+            'spawnpoint_id': '%x' % (0x89c25 * 10 ** 6 +
+                                     rnd.randint(0, spawnpoints)),
+            'pokemon_id': pokemon_id,
+            'pokemon_name': info['name'],
+            'pokemon_rarity': info['rarity'],
+            'pokemon_types': info['types'],
+            'latitude': lat,
+            'longitude': lng,
+            'disappear_time': now + timedelta(seconds=rnd.randint(0, 3600)),
+            'last_modified': now,
+            'individual_attack': rnd.randint(0, 15) if encountered else None,
+            'individual_defense': rnd.randint(0, 15) if encountered else None,
+            'individual_stamina': rnd.randint(0, 15) if encountered else None,
+            'move_1': rnd.randint(200, 250) if encountered else None,
+            'move_2': rnd.randint(13, 140) if encountered else None,
+            'weight': rnd.uniform(1, 100) if encountered else None,
+            'height': rnd.uniform(0.2, 2) if encountered else None,
+            'gender': rnd.randint(1, 3) if encountered else None,
+        })
+
+    return rows
+
+
+# Pokestop rows as returned by Pokestop.get_stops().
+def pokestop_rows(count, center=(40.75, -73.97), size=0.2, seed=2):
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+
+    rows = []
+    for i in xrange(count):
+        lat, lng = random_location(rnd, center, size)
+        lured = rnd.random() < 0.1
+        rows.append({
+            'pokestop_id': '%032x.16' % rnd.getrandbits(128),
+            'enabled': True,
+            'latitude': lat,
+            'longitude': lng,
+            'last_modified': now,
+            'lure_expiration': now + timedelta(minutes=20) if lured else None,
+            'active_fort_modifier': 501 if lured else None,
+        })
+
+    return rows
+
+
+# Gyms as returned by Gym.get_gyms(), keyed by gym id.
+def gym_rows(count, center=(40.75, -73.97), size=0.2, seed=3):
+    rnd = random.Random(seed)
+    data = load_pokemon_data()
+    now = datetime.utcnow()
+
+    gyms = {}
+    for i in xrange(count):
+        gym_id = '%032x.16' % rnd.getrandbits(128)
+        lat, lng = random_location(rnd, center, size)
+        members = []
+        for j in xrange(rnd.randint(0, 6)):
+            pokemon_id = rnd.randint(1, 151)
+            members.append({
+                'gym_id': gym_id,
+                'pokemon_id': pokemon_id,
+                'pokemon_name': data[str(pokemon_id)]['name'],
+                'pokemon_cp': rnd.randint(10, 3000),
+                'trainer_name': 'trainer%d' % rnd.randint(0, 5000),
+                'trainer_level': rnd.randint(5, 40),
+            })
+        gyms[gym_id] = {
+            'gym_id': gym_id,
+            'team_id': rnd.randint(0, 3),
+            'guard_pokemon_id': rnd.randint(1, 151),
+            'gym_points': rnd.randint(0, 50000),
+            'enabled': True,
+            'latitude': lat,
+            'longitude': lng,
+            'last_modified': now,
+            'last_scanned': now,
+            'name': 'Gym %d' % i,
+            'pokemon': members,
+        }
+
+    return gyms
+
+
+# Scanned location rows as returned by ScannedLocation.get_recent().
+def scanned_rows(count, center=(40.75, -73.97), size=0.2, seed=4):
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+
+    rows = []
+    for i in xrange(count):
+        lat, lng = random_location(rnd, center, size)
+        row = {
+            'cellid': str(rnd.getrandbits(63)),
+            'latitude': lat,
+            'longitude': lng,
+            'last_modified': now - timedelta(seconds=rnd.randint(0, 900)),
+            'done': rnd.random() < 0.5,
+            'midpoint': 0,
+            'width': 0,
+        }
+        for band in xrange(1, 6):
+            row['band%d' % band] = rnd.randint(-1, 3599)
+        rows.append(row)
+
+    return rows
+
+
+# A raw_data payload for a full load of a city sized viewport.
+def map_payload(pokemon=5000, pokestops=2000, gyms=300, scanned=1000):
+    return {
+        'pokemons': pokemon_rows(pokemon),
+        'pokestops': pokestop_rows(pokestops),
+        'gyms': gym_rows(gyms),
+        'scanned': scanned_rows(scanned),
+        'lastpokemon': 'true',
+        'lastpokestops': 'true',
+        'lastgyms': 'true',
+        'lastslocs': 'true',
+        'timestamp': datetime.utcnow(),
+    }
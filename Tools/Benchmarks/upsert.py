@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Compares the upserts bulk_upsert used to do through peewee (REPLACE INTO
+# on MySQL, INSERT OR REPLACE on SQLite, in chunks of 250 and 50 rows)
+# against pogom.upsert, on the pokestop table: inserting new stops, then
+# rounds of updating all of them like the scanner does.
+#
+#   python Tools/Benchmarks/upsert.py --rows 20000
+#   python Tools/Benchmarks/upsert.py --db-type mysql --db-name scratch \
+#       --db-user root --db-pass secret
+#
+# The tables are dropped and created again, use a scratch database.
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+import synthetic
+from query_plans import pogom_argv
+
+sys.path.insert(0, synthetic.ROOT)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-type', default='sqlite',
+                        choices=('sqlite', 'mysql'))
+    parser.add_argument('--db', default='upsert.db',
+                        help='SQLite file, replaced on every run.')
+    parser.add_argument('--db-name')
+    parser.add_argument('--db-user')
+    parser.add_argument('--db-pass')
+    parser.add_argument('--db-host', default='127.0.0.1')
+    parser.add_argument('--db-port', type=int, default=3306)
+    parser.add_argument('--lat', type=float, default=40.75)
+    parser.add_argument('--lng', type=float, default=-73.97)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=500,
+                        help='Rows per upsert call.')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='Rounds of updating all stops.')
+    return parser.parse_args()
+
+
+# The bulk_upsert this replaced.
+def peewee_upsert(m, db, cls, rows):
+    step = 250 if m.args.db_type == 'mysql' else 50
+    with db.atomic():
+        for i in range(0, len(rows), step):
+            if m.args.db_type == 'mysql':
+                db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
+            m.InsertQuery(cls, rows=rows[i:i + step]).upsert().execute()
+            if m.args.db_type == 'mysql':
+                db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
+
+
+def native_upsert(m, db, cls, rows):
+    m.upsert(db, cls, rows)
+
+
+# Index churn: pages written to the WAL on SQLite (it isn't checkpointed
+# while the benchmark runs), row handler calls on MySQL.
+def churn(db, args):
+    if args.db_type == 'mysql':
+        cursor = db.execute_sql("SHOW SESSION STATUS WHERE Variable_name IN "
+                                "('Handler_write', 'Handler_update', "
+                                "'Handler_delete')")
+        return dict((k, int(v)) for k, v in cursor.fetchall())
+    page_size = db.execute_sql('PRAGMA page_size').fetchone()[0]
+    wal = args.db + '-wal'
+    size = os.path.getsize(wal) if os.path.exists(wal) else 0
+    return {'wal_pages': size // (page_size + 24)}
+
+
+def run(m, db, args, upsert, rounds):
+    rnd = random.Random(1)
+    stops = synthetic.pokestop_rows(args.rows, (args.lat, args.lng))
+    m.add_s2cells(stops)
+    results = []
+    for r in range(rounds + 1):
+        if r:
+            # The scanner passing by again, some lures changed.
+            for stop in stops:
+                stop['last_modified'] += timedelta(minutes=10)
+                if rnd.random() < 0.1:
+                    lured = stop['lure_expiration'] is None
+                    stop['lure_expiration'] = (
+                        stop['last_modified'] + timedelta(minutes=30)
+                        if lured else None)
+                    stop['active_fort_modifier'] = 501 if lured else None
+        before = churn(db, args)
+        start = time.time()
+        for i in range(0, len(stops), args.batch):
+            upsert(m, db, m.Pokestop, stops[i:i + args.batch])
+        elapsed = time.time() - start
+        after = churn(db, args)
+        results.append((elapsed, dict((k, after[k] - before[k])
+                                      for k in after)))
+    return results
+
+
+def main():
+    args = parse_args()
+    if args.db_type == 'mysql' and not args.db_name:
+        print('--db-name is needed for MySQL.')
+        return 2
+
+    sys.argv = pogom_argv(args)
+    from flask import Flask
+    from pogom import models as m
+
+    print('{:<8} {:<7} {:>10} {:>10}  {}'.format(
+        'upsert', 'round', 'seconds', 'rows/sec', 'churn'))
+    for name, upsert in (('peewee', peewee_upsert),
+                         ('native', native_upsert)):
+        if args.db_type == 'sqlite':
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(args.db + suffix):
+                    os.remove(args.db + suffix)
+        db = m.init_database(Flask(__name__))
+        m.drop_tables(db)
+        m.create_tables(db)
+        if args.db_type == 'sqlite':
+            db.execute_sql('PRAGMA wal_autocheckpoint=0')
+
+        for i, (elapsed, counts) in enumerate(run(m, db, args, upsert,
+                                                  args.rounds)):
+            print('{:<8} {:<7} {:>10.2f} {:>10.0f}  {}'.format(
+                name, 'insert' if i == 0 else 'update', elapsed,
+                args.rows / elapsed, ', '.join(
+                    '{}={}'.format(k, v) for k, v in sorted(counts.items()))))
+        db.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
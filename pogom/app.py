@@ -1,26 +1,83 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import calendar
+import base64
+import hashlib
 import logging
+import os
+import re
 
 from flask import Flask, abort, jsonify, render_template, request,\
-    make_response
+    make_response, json, stream_with_context
 from flask.json import JSONEncoder
 from flask_compress import Compress
 from datetime import datetime
-from s2sphere import LatLng
 from pogom.utils import get_args
 from datetime import timedelta
 from collections import OrderedDict
 from bisect import bisect_left
+from itertools import chain
+from threading import Lock
+from cachetools import TTLCache
 
 from . import config
 from .models import (Pokemon, Gym, Pokestop, ScannedLocation,
-                     MainWorker, WorkerStatus, Token)
-from .utils import now, dottedQuadToNum, get_blacklist
+                     MainWorker, WorkerStatus, Token, change_log,
+                     tile_versions, live_feed, iter_pages, write_stats)
+from .geoindex import (MAX_COVER_CELLS, TILE_ZOOMS, has_bounds, tile_range,
+                       range_size, range_bounds, inner_tile_range,
+                       range_difference)
+from .utils import now, dottedQuadToNum, get_blacklist, get_locale_tables, \
+    get_pokemon_name, add_pokemon_locale
+from .transform import transform_from_wgs_to_gcj
+from .cache import SingleFlight, SharedCache
+from .jsonstream import epoch_ms
+from .encoding import (JSON, choose_format, choose_encoding, iter_payload,
+                       iter_encoded)
 log = logging.getLogger(__name__)
-compress = Compress()
+
+
+# Flask-Compress, except for the map payloads. Those are compressed as
+# they're streamed, with an encoding the client accepts (or none).
+class MapCompress(Compress):
+
+    def after_request(self, response):
+        if getattr(response, 'encoded', False):
+            return response
+        return super(MapCompress, self).after_request(response)
+
+
+compress = MapCompress()
+
+# Seconds browsers and proxies may serve a map tile without revalidating.
+TILE_MAX_AGE = 5
+
+# Seconds a versioned map tile payload is cached at most. Tile versions only
+# follow the writes of this process, not those of other instances sharing
+# the database or of the cleanup.
+TILE_CACHE_MAX_AGE = 60
+
+# Pokemon listed on the mobile page when the client doesn't ask for a limit.
+MOBILE_LIST_LIMIT = 20
+
+# Kinds of map objects clients without a viewport get a page at a time.
+PAGED_KINDS = ('pokemons', 'pokestops', 'gyms')
+
+
+# Cursors for paging through all map objects hold the key each kind of
+# object left off at, for the kinds that have more pages.
+def encode_cursor(after):
+    return base64.urlsafe_b64encode(json.dumps(after))
+
+
+def decode_cursor(token):
+    try:
+        after = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        abort(400)
+    if not isinstance(after, dict) or not set(after) <= set(PAGED_KINDS):
+        abort(400)
+    return after
 
 
 class Pogom(Flask):
@@ -45,10 +102,33 @@ class Pogom(Flask):
             self.blacklist = []
             self.blacklist_keys = []
 
+        # Identical map queries from concurrent clients share one fetch, and
+        # with a shared cache so do the web server processes.
+        shared = None
+        if args.shared_cache_dir and args.coalesce_queries > 0:
+            shared = SharedCache(args.shared_cache_dir, args.coalesce_queries)
+        self.query_flight = SingleFlight(ttl=args.coalesce_queries,
+                                         grid=args.coalesce_grid,
+                                         shared=shared)
+
+        # Tile payloads shared between users. Without tile versions, entries
+        # expire as quickly as browsers revalidate.
+        self.tile_lock = Lock()
+        self.tile_cache = TTLCache(
+            maxsize=1024, ttl=TILE_CACHE_MAX_AGE if tile_versions.enabled
+            else TILE_MAX_AGE)
+
+        # Set by runserver, which feeds the db threads.
+        self.db_updates_queue = None
+
         # Routes
         self.json_encoder = CustomJSONEncoder
         self.route("/", methods=['GET'])(self.fullmap)
         self.route("/raw_data", methods=['GET'])(self.raw_data)
+        self.route("/export", methods=['GET'])(self.export_data)
+        self.route("/tiles/<int:z>/<int:x>/<int:y>", methods=['GET'])(
+            self.tile_data)
+        self.route("/stream", methods=['GET'])(self.stream)
         self.route("/loc", methods=['GET'])(self.loc)
         self.route("/next_loc", methods=['POST'])(self.next_loc)
         self.route("/mobile", methods=['GET'])(self.list_pokemon)
@@ -59,6 +139,7 @@ class Pogom(Flask):
         self.route("/status", methods=['GET'])(self.get_status)
         self.route("/status", methods=['POST'])(self.post_status)
         self.route("/gym_data", methods=['GET'])(self.get_gymdata)
+        self.route("/locale_data", methods=['GET'])(self.get_locale_data)
         self.route("/bookmarklet", methods=['GET'])(self.get_bookmarklet)
         self.route("/inject.js", methods=['GET'])(self.render_inject_js)
         self.route("/submit_token", methods=['POST'])(self.submit_token)
@@ -127,6 +208,14 @@ class Pogom(Flask):
     def set_location_queue(self, queue):
         self.location_queue = queue
 
+    def set_db_updates_queue(self, queue):
+        self.db_updates_queue = queue
+
+    def db_queue_stats(self):
+        if self.db_updates_queue is None:
+            return None
+        return self.db_updates_queue.stats()
+
     def set_current_location(self, location):
         self.current_location = location
 
@@ -182,8 +271,13 @@ class Pogom(Flask):
             self.search_control.clear()
         d = {}
 
-        # Request time of this request.
-        d['timestamp'] = datetime.utcnow()
+        # Request time of this request. Coalesced queries may be answered
+        # with results from the start of the current bucket.
+        if self.query_flight.enabled:
+            d['timestamp'] = datetime.utcfromtimestamp(
+                self.query_flight.bucket())
+        else:
+            d['timestamp'] = datetime.utcnow()
 
         # Request time of previous request.
         if request.args.get('timestamp'):
@@ -240,85 +334,186 @@ class Pogom(Flask):
         else:
             newArea = False
 
+        # With delta syncing, clients hold whole cells of the map and only
+        # get what changed since the last sequence number they saw, plus
+        # the cells that scrolled into view.
+        changes = None
+        new_tiles = []
+        if change_log.enabled and has_bounds(swLat, swLng, neLat, neLng):
+            # Read before querying, so nothing committed meanwhile is lost.
+            d['seq'] = change_log.seq
+            tiles = tile_range(swLat, swLng, neLat, neLng)
+            if range_size(tiles) <= MAX_COVER_CELLS:
+                swLat, swLng, neLat, neLng = range_bounds(tiles)
+                # Without a valid sequence number the viewport is sent
+                # whole, as for the first request.
+                since = request.args.get('since', type=int)
+                if (since is not None and
+                        has_bounds(oSwLat, oSwLng, oNeLat, oNeLng)):
+                    changes = change_log.since(since, tiles)
+                    new_tiles = range_difference(
+                        tiles, inner_tile_range(oSwLat, oSwLng,
+                                                oNeLat, oNeLng))
+
         # Pass current coords as old coords.
         d['oSwLat'] = swLat
         d['oSwLng'] = swLng
         d['oNeLat'] = neLat
         d['oNeLng'] = neLng
 
+        # Clients holding the /locale_data tables can do without names,
+        # rarities and types.
+        enrich = request.args.get('enrich', 'true') == 'true'
+
+        # Clients without a viewport get all Pokemon, pokestops and gyms, a
+        # page at a time. The cursor of a response gets the next page.
+        paged = not has_bounds(swLat, swLng, neLat, neLng)
+        if paged:
+            after = None
+            if request.args.get('cursor'):
+                after = decode_cursor(request.args.get('cursor'))
+            limit = request.args.get('limit', args.max_page_size, type=int)
+            if limit <= 0 or limit > args.max_page_size:
+                limit = args.max_page_size
+            next_after = {}
+
         if request.args.get('pokemon', 'true') == 'true':
-            if request.args.get('ids'):
+            if paged:
+                d['pokemons'] = self.map_page(
+                    'pokemons', Pokemon.get_active_page, 'encounter_id',
+                    after, limit, next_after, enrich=enrich)
+                if request.args.get('ids'):
+                    ids = set(int(x)
+                              for x in request.args.get('ids').split(','))
+                    d['pokemons'] = [p for p in d['pokemons']
+                                     if p['pokemon_id'] in ids]
+            elif request.args.get('ids'):
                 ids = [int(x) for x in request.args.get('ids').split(',')]
                 d['pokemons'] = Pokemon.get_active_by_id(ids, swLat, swLng,
-                                                         neLat, neLng)
+                                                         neLat, neLng,
+                                                         enrich=enrich)
             elif lastpokemon != 'true':
                 # If this is first request since switch on, load
                 # all pokemon on screen.
-                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng)
+                d['pokemons'] = self.map_query(Pokemon.get_active,
+                                               swLat, swLng, neLat, neLng,
+                                               enrich=enrich, stream=True)
+            elif changes is not None:
+                d['pokemons'] = Pokemon.get_active_by_encounter_id(
+                    changes.get('pokemon', ()), enrich=enrich)
+                for bounds in map(range_bounds, new_tiles):
+                    d['pokemons'] += Pokemon.get_active(*bounds,
+                                                        enrich=enrich)
             else:
                 # If map is already populated only request modified Pokemon
                 # since last request time.
-                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng,
-                                                   timestamp=timestamp)
+                d['pokemons'] = self.map_query(Pokemon.get_active,
+                                               swLat, swLng, neLat, neLng,
+                                               timestamp=timestamp,
+                                               enrich=enrich, stream=True)
                 if newArea:
                     # If screen is moved add newly uncovered Pokemon to the
                     # ones that were modified since last request time.
-                    d['pokemons'] = d['pokemons'] + (
-                        Pokemon.get_active(swLat, swLng, neLat, neLng,
-                                           oSwLat=oSwLat, oSwLng=oSwLng,
-                                           oNeLat=oNeLat, oNeLng=oNeLng))
+                    d['pokemons'] = chain(d['pokemons'], (
+                        self.map_query(Pokemon.get_active,
+                                       swLat, swLng, neLat, neLng,
+                                       oSwLat=oSwLat, oSwLng=oSwLng,
+                                       oNeLat=oNeLat, oNeLng=oNeLng,
+                                       enrich=enrich, stream=True)))
 
             if request.args.get('eids'):
                 # Exclude id's of pokemon that are hidden.
                 eids = [int(x) for x in request.args.get('eids').split(',')]
-                d['pokemons'] = [
-                    x for x in d['pokemons'] if x['pokemon_id'] not in eids]
+                d['pokemons'] = (
+                    x for x in d['pokemons'] if x['pokemon_id'] not in eids)
 
-            if request.args.get('reids'):
+            if request.args.get('reids') and not paged:
                 reids = [int(x) for x in request.args.get('reids').split(',')]
-                d['pokemons'] = d['pokemons'] + (
+                d['pokemons'] = chain(d['pokemons'], (
                     Pokemon.get_active_by_id(reids, swLat, swLng,
-                                             neLat, neLng))
+                                             neLat, neLng, enrich=enrich)))
                 d['reids'] = reids
 
         if request.args.get('pokestops', 'true') == 'true':
-            if lastpokestops != 'true':
-                d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng,
-                                                    lured=luredonly)
+            if paged:
+                d['pokestops'] = self.map_page(
+                    'pokestops', Pokestop.get_stops_page, 'pokestop_id',
+                    after, limit, next_after)
+            elif lastpokestops != 'true':
+                d['pokestops'] = self.map_query(Pokestop.get_stops,
+                                                swLat, swLng, neLat, neLng,
+                                                lured=luredonly, stream=True)
+            elif changes is not None:
+                d['pokestops'] = Pokestop.get_stops_by_id(
+                    changes.get('pokestop', ()), lured=luredonly)
+                for bounds in map(range_bounds, new_tiles):
+                    d['pokestops'] += Pokestop.get_stops(*bounds,
+                                                         lured=luredonly)
             else:
-                d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng,
-                                                    timestamp=timestamp)
+                d['pokestops'] = self.map_query(Pokestop.get_stops,
+                                                swLat, swLng, neLat, neLng,
+                                                timestamp=timestamp,
+                                                stream=True)
                 if newArea:
-                    d['pokestops'] = d['pokestops'] + (
-                        Pokestop.get_stops(swLat, swLng, neLat, neLng,
-                                           oSwLat=oSwLat, oSwLng=oSwLng,
-                                           oNeLat=oNeLat, oNeLng=oNeLng,
-                                           lured=luredonly))
+                    d['pokestops'] = chain(d['pokestops'], (
+                        self.map_query(Pokestop.get_stops,
+                                       swLat, swLng, neLat, neLng,
+                                       oSwLat=oSwLat, oSwLng=oSwLng,
+                                       oNeLat=oNeLat, oNeLng=oNeLng,
+                                       lured=luredonly, stream=True)))
 
         if request.args.get('gyms', 'true') == 'true':
-            if lastgyms != 'true':
-                d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng)
+            if paged:
+                d['gyms'] = OrderedDict(
+                    (g['gym_id'], g) for g in self.map_page(
+                        'gyms', Gym.get_gyms_page, 'gym_id', after, limit,
+                        next_after, enrich=enrich))
+            elif lastgyms != 'true':
+                d['gyms'] = self.map_query(Gym.get_gyms,
+                                           swLat, swLng, neLat, neLng,
+                                           enrich=enrich)
+            elif changes is not None:
+                d['gyms'] = Gym.get_gyms_by_id(changes.get('gym', ()),
+                                               enrich=enrich)
+                for bounds in map(range_bounds, new_tiles):
+                    d['gyms'].update(Gym.get_gyms(*bounds, enrich=enrich))
             else:
-                d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng,
-                                         timestamp=timestamp)
+                d['gyms'] = self.map_query(Gym.get_gyms,
+                                           swLat, swLng, neLat, neLng,
+                                           timestamp=timestamp,
+                                           enrich=enrich)
                 if newArea:
                     d['gyms'].update(
-                        Gym.get_gyms(swLat, swLng, neLat, neLng,
-                                     oSwLat=oSwLat, oSwLng=oSwLng,
-                                     oNeLat=oNeLat, oNeLng=oNeLng))
+                        self.map_query(Gym.get_gyms,
+                                       swLat, swLng, neLat, neLng,
+                                       oSwLat=oSwLat, oSwLng=oSwLng,
+                                       oNeLat=oNeLat, oNeLng=oNeLng,
+                                       enrich=enrich))
+
+        if paged and next_after:
+            d['cursor'] = encode_cursor(next_after)
 
         if request.args.get('scanned', 'true') == 'true':
             if lastslocs != 'true':
-                d['scanned'] = ScannedLocation.get_recent(swLat, swLng,
-                                                          neLat, neLng)
+                d['scanned'] = self.map_query(ScannedLocation.get_recent,
+                                              swLat, swLng, neLat, neLng,
+                                              stream=True)
+            elif changes is not None:
+                d['scanned'] = ScannedLocation.get_recent_by_cellids(
+                    changes.get('scannedlocation', ()))
+                for bounds in map(range_bounds, new_tiles):
+                    d['scanned'] += ScannedLocation.get_recent(*bounds)
             else:
-                d['scanned'] = ScannedLocation.get_recent(swLat, swLng,
-                                                          neLat, neLng,
-                                                          timestamp=timestamp)
+                d['scanned'] = self.map_query(ScannedLocation.get_recent,
+                                              swLat, swLng, neLat, neLng,
+                                              timestamp=timestamp,
+                                              stream=True)
                 if newArea:
-                    d['scanned'] = d['scanned'] + ScannedLocation.get_recent(
+                    d['scanned'] = chain(d['scanned'], self.map_query(
+                        ScannedLocation.get_recent,
                         swLat, swLng, neLat, neLng, oSwLat=oSwLat,
-                        oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng)
+                        oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng,
+                        stream=True))
 
         selected_duration = None
 
@@ -346,17 +541,18 @@ class Pogom(Flask):
         if request.args.get('spawnpoints', 'false') == 'true':
             if lastspawns != 'true':
                 d['spawnpoints'] = Pokemon.get_spawnpoints(
-                    swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng)
+                    swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng,
+                    stream=True)
             else:
                 d['spawnpoints'] = Pokemon.get_spawnpoints(
                     swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng,
-                    timestamp=timestamp)
+                    timestamp=timestamp, stream=True)
                 if newArea:
-                    d['spawnpoints'] = d['spawnpoints'] + (
+                    d['spawnpoints'] = chain(d['spawnpoints'], (
                         Pokemon.get_spawnpoints(
                             swLat, swLng, neLat, neLng,
                             oSwLat=oSwLat, oSwLng=oSwLng,
-                            oNeLat=oNeLat, oNeLng=oNeLng))
+                            oNeLat=oNeLat, oNeLng=oNeLng, stream=True)))
 
         if request.args.get('status', 'false') == 'true':
             args = get_args()
@@ -367,7 +563,202 @@ class Pogom(Flask):
                   args.status_page_password):
                 d['main_workers'] = MainWorker.get_all()
                 d['workers'] = WorkerStatus.get_all()
-        return jsonify(d)
+                d['query_coalescing'] = self.query_flight.stats()
+                d['db_writes'] = write_stats()
+                d['db_queue'] = self.db_queue_stats()
+        return self.map_response(d)
+
+    # One page of a kind of map objects for clients without a viewport,
+    # starting after the key the cursor holds for the kind. Kinds missing
+    # from the cursor have no more pages. If the page is full its last key
+    # goes into the next cursor.
+    def map_page(self, kind, fetch, key, after, limit, next_after,
+                 **kwargs):
+        if after is not None and kind not in after:
+            return []
+
+        rows = fetch(after=after and after[kind], limit=limit, **kwargs)
+        if len(rows) >= limit:
+            next_after[kind] = rows[-1][key]
+        return rows
+
+    # All active Pokemon, pokestops and gyms in one response. They're read
+    # from the database a page at a time and streamed as JSON, so exports
+    # of any size take little memory.
+    def export_data(self):
+        args = get_args()
+        enrich = request.args.get('enrich', 'true') == 'true'
+
+        d = OrderedDict()
+        if request.args.get('pokemon', 'true') == 'true':
+            d['pokemons'] = iter_pages(Pokemon.get_active_page,
+                                       'encounter_id', args.max_page_size,
+                                       enrich=enrich)
+        if request.args.get('pokestops', 'true') == 'true':
+            d['pokestops'] = iter_pages(Pokestop.get_stops_page,
+                                        'pokestop_id', args.max_page_size)
+        if request.args.get('gyms', 'true') == 'true':
+            d['gyms'] = iter_pages(Gym.get_gyms_page, 'gym_id',
+                                   args.max_page_size, enrich=enrich)
+
+        return self.map_response(d, JSON)
+
+    # Stream a map payload in the format the client asked for, either with
+    # the `format` parameter (json, columns or msgpack) or the Accept
+    # header. JSON rows are encoded as they are read from the database.
+    # It's compressed here because Flask-Compress would have to buffer the
+    # whole body first, and would gzip it for clients refusing gzip.
+    def map_response(self, d, mimetype=None):
+        if mimetype is None:
+            mimetype = choose_format(request.accept_mimetypes,
+                                     request.args.get('format'))
+        encoding = choose_encoding(request.accept_encodings)
+
+        headers = {'Vary': 'Accept, Accept-Encoding'}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        chunks = iter_encoded(iter_payload(d, mimetype), encoding)
+
+        response = self.response_class(stream_with_context(chunks),
+                                       mimetype=mimetype, headers=headers)
+        response.encoded = True
+        return response
+
+    # Run a map query through the coalescing layer. Viewports and timestamp
+    # are quantized first, so the result may hold a few extra rows.
+    def map_query(self, fetch, swLat, swLng, neLat, neLng, timestamp=0,
+                  oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None,
+                  **kwargs):
+        flight = self.query_flight
+        if not flight.enabled:
+            return fetch(swLat, swLng, neLat, neLng, timestamp=timestamp,
+                         oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat,
+                         oNeLng=oNeLng, **kwargs)
+
+        # Shared results have to be lists.
+        kwargs.pop('stream', None)
+        bounds = flight.quantize(swLat, swLng, neLat, neLng)
+        old_bounds = flight.quantize(oSwLat, oSwLng, oNeLat, oNeLng,
+                                     inner=True)
+        if timestamp > 0:
+            step = flight.ttl * 1000
+            timestamp = timestamp // step * step
+
+        key = (fetch.__name__, bounds, old_bounds, timestamp,
+               tuple(sorted(kwargs.items())), flight.bucket())
+        return flight.do(key, lambda: fetch(
+            *bounds, timestamp=timestamp, oSwLat=old_bounds[0],
+            oSwLng=old_bounds[1], oNeLat=old_bounds[2], oNeLng=old_bounds[3],
+            **kwargs))
+
+    # Map objects inside a slippy map tile. Everyone looking at an area
+    # asks for the same tiles, so payloads are cached and conditional
+    # requests are answered with the tile's ETag. A cached payload is built
+    # again when the tile's version changes, when something in it expires
+    # and, since other writers aren't seen, after a while regardless.
+    def tile_data(self, z, x, y):
+        if z not in TILE_ZOOMS or x >= (1 << z) or y >= (1 << z):
+            abort(404)
+
+        version = None
+        if tile_versions.enabled:
+            version = tile_versions.etag(z, x, y)
+        now_date = datetime.utcnow()
+
+        with self.tile_lock:
+            cached = self.tile_cache.get((z, x, y))
+
+        if cached is None or cached[0] != version or (
+                cached[1] is not None and cached[1] <= now_date):
+            swLat, swLng, neLat, neLng = range_bounds((x, y, x, y), z)
+            d = {'pokemons': Pokemon.get_active(swLat, swLng, neLat, neLng),
+                 'pokestops': Pokestop.get_stops(swLat, swLng, neLat, neLng),
+                 'gyms': Gym.get_gyms(swLat, swLng, neLat, neLng),
+                 'scanned': ScannedLocation.get_recent(swLat, swLng,
+                                                       neLat, neLng)}
+            body = json.dumps(d)
+            # The ETag follows the payload, so it changes when objects
+            # expire or other writers change the tile, not only with the
+            # version.
+            cached = (version, tile_expiry(d, now_date),
+                      hashlib.md5(body).hexdigest(), body)
+            with self.tile_lock:
+                self.tile_cache[(z, x, y)] = cached
+
+        etag, body = cached[2:]
+        if request.if_none_match.contains_weak(etag):
+            return self.tile_response(etag, '', 304)
+
+        return self.tile_response(etag, body)
+
+    def tile_response(self, etag, body, status=200):
+        r = self.response_class(body, status=status,
+                                mimetype='application/json')
+        r.set_etag(etag, weak=True)
+        r.headers['Cache-Control'] = 'public, max-age=%d' % TILE_MAX_AGE
+        return r
+
+    # Server-sent events with the map objects scanned inside a viewport.
+    # Events are named after the kind of object ('pokemon', 'pokestop' or
+    # 'gym') and carry {'op': 'update' or 'expired', 'items': [...]}. A
+    # 'resync' event means updates were dropped and the viewport has to be
+    # reloaded from raw_data.
+    def stream(self):
+        if not live_feed.enabled:
+            abort(404)
+
+        bounds = [request.args.get(k, type=float)
+                  for k in ('swLat', 'swLng', 'neLat', 'neLng')]
+        if None in bounds:
+            abort(400)
+        tiles = tile_range(*bounds)
+        if range_size(tiles) > MAX_COVER_CELLS:
+            abort(400)
+
+        subscriber = live_feed.subscribe(tiles)
+        if subscriber is None:
+            abort(503)
+
+        def events():
+            try:
+                yield 'retry: 5000\n\n'
+                while True:
+                    live_feed.expire()
+                    messages = subscriber.get(timeout=15)
+                    if not messages:
+                        # Keeps proxies from closing the connection, and
+                        # notices clients that went away.
+                        yield ': keepalive\n\n'
+                    for kind, op, rows in messages:
+                        yield 'event: {}\ndata: {}\n\n'.format(
+                            kind, json.dumps({'op': op,
+                                              'items': self.live_rows(
+                                                  kind, op, rows)}))
+            finally:
+                live_feed.unsubscribe(subscriber)
+
+        return self.response_class(
+            stream_with_context(events()), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache',
+                     'X-Accel-Buffering': 'no'})
+
+    # Fill in what the map queries would add to rows from the live feed.
+    # Rows are shared between subscribers, so they're copied first.
+    def live_rows(self, kind, op, rows):
+        args = get_args()
+        rows = [dict(row) for row in rows]
+        for row in rows:
+            row.pop('s2cell', None)
+            if kind == 'pokemon' and op == 'update':
+                add_pokemon_locale(row)
+            elif kind == 'gym':
+                for p in row.get('pokemon', []):
+                    p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+            if args.china:
+                row['latitude'], row['longitude'] = \
+                    transform_from_wgs_to_gcj(row['latitude'],
+                                              row['longitude'])
+        return rows
 
     def loc(self):
         d = {}
@@ -401,40 +792,35 @@ class Pogom(Flask):
     def list_pokemon(self):
         # todo: Check if client is Android/iOS/Desktop for geolink, currently
         # only supports Android.
+        args = get_args()
         pokemon_list = []
 
         # Allow client to specify location.
         lat = request.args.get('lat', self.current_location[0], type=float)
         lon = request.args.get('lon', self.current_location[1], type=float)
-        origin_point = LatLng.from_degrees(lat, lon)
-
-        for pokemon in Pokemon.get_active(None, None, None, None):
-            pokemon_point = LatLng.from_degrees(pokemon['latitude'],
-                                                pokemon['longitude'])
-            diff = pokemon_point - origin_point
-            diff_lat = diff.lat().degrees
-            diff_lng = diff.lng().degrees
-            direction = (('N' if diff_lat >= 0 else 'S')
-                         if abs(diff_lat) > 1e-4 else '') +\
-                        (('E' if diff_lng >= 0 else 'W')
-                         if abs(diff_lng) > 1e-4 else '')
+        # Number of Pokemon to list and how far away they may be, in meters.
+        limit = request.args.get('limit', MOBILE_LIST_LIMIT, type=int)
+        radius = request.args.get('radius', None, type=float)
+        if limit <= 0 or limit > args.max_page_size:
+            limit = args.max_page_size
+
+        now_date = datetime.utcnow()
+        for pokemon, distance, direction in Pokemon.get_nearest(
+                lat, lon, limit=limit, radius=radius):
             entry = {
                 'id': pokemon['pokemon_id'],
                 'name': pokemon['pokemon_name'],
                 'card_dir': direction,
-                'distance': int(origin_point.get_distance(
-                    pokemon_point).radians * 6366468.241830914),
+                'distance': int(distance),
                 'time_to_disappear': '%d min %d sec' % (divmod(
-                    (pokemon['disappear_time'] - datetime.utcnow()).seconds,
-                    60)),
+                    (pokemon['disappear_time'] - now_date).seconds, 60)),
                 'disappear_time': pokemon['disappear_time'],
                 'disappear_sec': (
-                    pokemon['disappear_time'] - datetime.utcnow()).seconds,
+                    pokemon['disappear_time'] - now_date).seconds,
                 'latitude': pokemon['latitude'],
                 'longitude': pokemon['longitude']
             }
-            pokemon_list.append((entry, entry['distance']))
-        pokemon_list = [y[0] for y in sorted(pokemon_list, key=lambda x: x[1])]
+            pokemon_list.append(entry)
         return render_template('mobile_list.html',
                                pokemon_list=pokemon_list,
                                origin_lat=lat,
@@ -531,11 +917,36 @@ class Pogom(Flask):
                                valid_input=self.get_valid_stat_input()
                                )
 
+    # Details of a gym, or of every gym in a viewport by gym id.
     def get_gymdata(self):
         gym_id = request.args.get('id')
-        gym = Gym.get_gym(gym_id)
+        if gym_id is not None:
+            return jsonify(Gym.get_gym(gym_id))
 
-        return jsonify(gym)
+        swLat = request.args.get('swLat')
+        swLng = request.args.get('swLng')
+        neLat = request.args.get('neLat')
+        neLng = request.args.get('neLng')
+        if not has_bounds(swLat, swLng, neLat, neLng):
+            abort(400)
+
+        return jsonify(Gym.get_gym_details(swLat=swLat, swLng=swLng,
+                                           neLat=neLat, neLng=neLng))
+
+    # Localized Pokemon and move tables, for clients requesting raw_data
+    # with enrich=false.
+    def get_locale_data(self):
+        locale = request.args.get('locale', config['LOCALE'])
+        if not re.match(r'^[A-Za-z_-]+$', locale):
+            abort(400)
+        if locale not in ('en', config['LOCALE']) and not os.path.isfile(
+                os.path.join(config['ROOT_PATH'], config['LOCALES_DIR'],
+                             '{}.min.json'.format(locale))):
+            abort(404)
+
+        r = make_response(jsonify(get_locale_tables(locale)))
+        r.headers['Cache-Control'] = 'public, max-age=86400'
+        return r
 
     def get_status(self):
         args = get_args()
@@ -554,23 +965,32 @@ class Pogom(Flask):
             d['login'] = 'ok'
             d['main_workers'] = MainWorker.get_all()
             d['workers'] = WorkerStatus.get_all()
+            d['query_coalescing'] = self.query_flight.stats()
+            d['db_writes'] = write_stats()
+            d['db_queue'] = self.db_queue_stats()
         else:
             d['login'] = 'failed'
         return jsonify(d)
 
 
+# The earliest time something in a tile payload expires: a Pokemon
+# despawns, a lure runs out or a scanned location is no longer recent.
+# None if nothing in it does.
+def tile_expiry(d, now_date):
+    times = [p['disappear_time'] for p in d['pokemons']]
+    times += [p['lure_expiration'] for p in d['pokestops']
+              if p['lure_expiration'] is not None]
+    times += [s['last_modified'] + timedelta(minutes=15)
+              for s in d['scanned'] if s['last_modified'] is not None]
+    return min([t for t in times if t > now_date] or [None])
+
+
 class CustomJSONEncoder(JSONEncoder):
 
     def default(self, obj):
         try:
             if isinstance(obj, datetime):
-                if obj.utcoffset() is not None:
-                    obj = obj - obj.utcoffset()
-                millis = int(
-                    calendar.timegm(obj.timetuple()) * 1000 +
-                    obj.microsecond / 1000
-                )
-                return millis
+                return epoch_ms(obj)
             iterable = iter(obj)
         except TypeError:
             pass
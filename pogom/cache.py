@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import cPickle as pickle
+import errno
+import hashlib
+import logging
+import math
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from copy import copy
+from threading import Event, Lock
+
+from cachetools import TTLCache
+
+log = logging.getLogger(__name__)
+
+# Locking the shared cache between processes needs fcntl, without it (on
+# Windows) processes may fetch the same key at the same time.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Gym row fields that are part of the gym details.
+GYM_FIELDS = ('team_id', 'guard_pokemon_id', 'gym_points', 'last_modified')
+
+
+# Coalesces identical map queries. Callers asking for a key that is already
+# being fetched wait for that fetch and share its result, and results are
+# kept for `ttl` seconds. Viewports and timestamps are quantized so that
+# close enough requests end up with the same key.
+class SingleFlight(object):
+
+    def __init__(self, ttl=0, grid=0.005, maxsize=4096, shared=None):
+        self.ttl = ttl
+        self.grid = grid
+        self.enabled = ttl > 0
+        self.lock = Lock()
+        self.results = TTLCache(maxsize=maxsize, ttl=max(ttl, 1))
+        # Optional SharedCache, to share results with other processes.
+        self.shared = shared
+        # key -> [Event, result, ok]
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.shared_hits = 0
+
+    # Return the start of the current time bucket, in seconds. Results are
+    # shared within a bucket, so clients should treat the bucket start as the
+    # time of their request.
+    def bucket(self, now=None):
+        now = time.time() if now is None else now
+        return int(now // self.ttl * self.ttl)
+
+    # Snap a viewport to the grid. Outer viewports grow, inner ones (the old
+    # viewport of an incremental update) shrink, so the snapped query always
+    # returns a superset of the original one.
+    def quantize(self, swLat, swLng, neLat, neLng, inner=False):
+        if not (swLat and swLng and neLat and neLng):
+            return (swLat, swLng, neLat, neLng)
+
+        if inner:
+            sw_round, ne_round = math.ceil, math.floor
+        else:
+            sw_round, ne_round = math.floor, math.ceil
+
+        grid = self.grid
+        return (round(sw_round(float(swLat) / grid) * grid, 6),
+                round(sw_round(float(swLng) / grid) * grid, 6),
+                round(ne_round(float(neLat) / grid) * grid, 6),
+                round(ne_round(float(neLng) / grid) * grid, 6))
+
+    # Return the result of fetch() for a key, running it at most once at a
+    # time and at most once per ttl. Lists and dicts are copied, so callers
+    # may extend them.
+    def do(self, key, fetch):
+        if not self.enabled:
+            return fetch()
+
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                return copy(self.results[key])
+
+            flight = self.inflight.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self.inflight[key] = [Event(), None, False]
+                leader = True
+            else:
+                self.waits += 1
+                leader = False
+
+        if not leader:
+            flight[0].wait()
+            if flight[2]:
+                return copy(flight[1])
+            # The fetch failed, try on our own.
+            return fetch()
+
+        try:
+            flight[1] = self.fetch_shared(key, fetch)
+            flight[2] = True
+            with self.lock:
+                self.results[key] = flight[1]
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight[0].set()
+
+        return copy(flight[1])
+
+    # Return the result for a key from the shared cache, fetching and
+    # storing it there if no other process did already.
+    def fetch_shared(self, key, fetch):
+        if self.shared is None:
+            return fetch()
+
+        with self.shared.lock(key):
+            found, result = self.shared.get(key)
+            if found:
+                with self.lock:
+                    self.shared_hits += 1
+                return result
+
+            result = fetch()
+            self.shared.set(key, result)
+            return result
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'waits': self.waits, 'shared_hits': self.shared_hits,
+                    'cached': len(self.results)}
+
+
+# Cache shared by the web server processes of a host, kept as files in a
+# directory (a tmpfs like /dev/shm is best). It stands in for a shared store
+# like memcached or redis: values are pickled, replaced atomically and
+# expire after ttl seconds. Processes fetching the same key are serialized
+# with lock(), so only one of them has to query the database.
+class SharedCache(object):
+
+    def __init__(self, path, ttl, stripes=64):
+        self.path = path
+        self.ttl = ttl
+        self.stripes = stripes
+        self.last_sweep = time.time()
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _name(self, key):
+        return hashlib.md5(repr(key)).hexdigest()
+
+    # Return (True, value) for a cached key, (False, None) otherwise.
+    def get(self, key):
+        filename = os.path.join(self.path, self._name(key) + '.cache')
+        try:
+            with open(filename, 'rb') as f:
+                if time.time() - os.fstat(f.fileno()).st_mtime > self.ttl:
+                    return False, None
+                return True, pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def set(self, key, value):
+        filename = os.path.join(self.path, self._name(key) + '.cache')
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp, filename)
+        except (IOError, OSError) as e:
+            log.warning('Unable to write to the shared cache: %s', repr(e))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+        if time.time() - self.last_sweep > max(self.ttl, 60):
+            self.sweep()
+
+    # Remove expired entries.
+    def sweep(self):
+        self.last_sweep = time.time()
+        for name in os.listdir(self.path):
+            if not name.endswith(('.cache', '.tmp')):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                if self.last_sweep - os.path.getmtime(filename) > self.ttl:
+                    os.remove(filename)
+            except OSError:
+                pass
+
+    # Hold a lock on a key across processes. Keys share a fixed number of
+    # lock files.
+    @contextmanager
+    def lock(self, key):
+        if fcntl is None:
+            yield
+            return
+
+        stripe = int(self._name(key)[:8], 16) % self.stripes
+        with open(os.path.join(self.path, '{}.lock'.format(stripe)),
+                  'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# Return True if a Gym row differs from the gym's details. MySQL drops the
+# milliseconds of the modification time.
+def gym_changed(details, gym):
+    for key in GYM_FIELDS:
+        old, new = details[key], gym[key]
+        if key == 'last_modified':
+            old, new = old.replace(microsecond=0), new.replace(microsecond=0)
+        if old != new:
+            return True
+    return False
+
+
+# Gym details (with their defenders) by gym id. parse_gyms writes the
+# details it parsed through to the cache as it queues their database writes,
+# so reads don't have to wait for the writes to land. Details read from the
+# database are only stored if nothing was written while they were read, a
+# slow read can't replace newer details with older ones.
+class GymCache(object):
+
+    def __init__(self, ttl=600, maxsize=4096):
+        self.lock = Lock()
+        self.details = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.generation = 0
+
+    # Return ({gym_id: details} of the cached gyms, generation). Pass the
+    # generation to fill() with the details of the others. The details are
+    # shared, callers mustn't change them.
+    def get(self, gym_ids):
+        found = {}
+        with self.lock:
+            for gym_id in gym_ids:
+                details = self.details.get(gym_id)
+                if details is not None:
+                    found[gym_id] = details
+            return found, self.generation
+
+    # Store details read from the database, unless something was written
+    # since get() returned generation.
+    def fill(self, details, generation):
+        with self.lock:
+            if generation == self.generation:
+                self.details.update(details)
+
+    # Store details of freshly parsed gyms.
+    def refresh(self, details):
+        with self.lock:
+            self.generation += 1
+            self.details.update(details)
+
+    # Drop the gyms whose committed Gym row differs from their cached
+    # details.
+    def update(self, gyms):
+        with self.lock:
+            self.generation += 1
+            for gym in gyms:
+                details = self.details.get(gym['gym_id'])
+                if details is None:
+                    continue
+                if gym_changed(details, gym):
+                    del self.details[gym['gym_id']]
+
+    def __len__(self):
+        return len(self.details)
@@ -0,0 +1,495 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import cPickle as pickle
+import logging
+import tempfile
+import time
+from collections import Counter, OrderedDict, deque
+from threading import Condition, Lock
+from queue import Empty, Full
+
+from cachetools import TTLCache
+
+log = logging.getLogger(__name__)
+
+# Priority classes of UpdateQueue, highest first.
+HIGH, NORMAL, LOW = range(3)
+
+# What UpdateQueue does with a new item when it's full.
+FULL_POLICIES = ('block', 'drop', 'spill')
+
+
+# The queue of database updates, (model, rows by key) items, between the
+# parsers and db_updater. Items come out by the priority class of their
+# model (NORMAL unless given in `priorities`), in order within a class.
+#
+# It holds `maxsize` items at most, 0 for no limit. When it's full, the
+# `policy` decides: 'block' waits for room, 'drop' drops the oldest item of
+# the lowest class that isn't above the new item's (the new item if they
+# all are), 'spill' writes new items to a temporary file, from which they
+# are read back in order as room frees up.
+#
+# Items of the models in `collapse` are merged into the item of the model
+# that is queued already, rows by the fields `key(model)` returns, so the
+# latest status updates take one place per model (outside the limit).
+#
+# With a Journal, the other items of models with a key (which are upserted,
+# so writing them again does no harm) are appended to it before put()
+# returns. get_entry() hands out their journal token along with them, for
+# committing once they're written.
+class UpdateQueue(object):
+
+    def __init__(self, maxsize=0, policy='block', priorities=None,
+                 collapse=(), key=None, journal=None):
+        if policy not in FULL_POLICIES:
+            raise ValueError('Unknown policy: {}'.format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.priorities = priorities or {}
+        self.collapse = set(collapse)
+        self.key = key
+        self.journal = journal
+        self.mutex = Lock()
+        self.not_empty = Condition(self.mutex)
+        self.not_full = Condition(self.mutex)
+        self.all_tasks_done = Condition(self.mutex)
+        self.unfinished_tasks = 0
+
+        # An item list for each class, the queued items of collapsed models.
+        self.items = [deque() for _ in range(LOW + 1)]
+        self.collapsed = {}
+        # Items counting against maxsize.
+        self.size = 0
+        self.spill = None
+        self.spill_read = 0
+        self.spilled = Counter()
+
+        self.dropped = Counter()
+        self.merged = 0
+        self.spills = 0
+        self.blocked = 0
+
+    def qsize(self):
+        with self.mutex:
+            return (self.size + len(self.collapsed) +
+                    sum(self.spilled.values()))
+
+    def empty(self):
+        return not self.qsize()
+
+    def full(self):
+        with self.mutex:
+            return self.is_full()
+
+    def is_full(self):
+        return 0 < self.maxsize <= self.size
+
+    def put(self, item, block=True, timeout=None):
+        model, data = item
+        with self.not_full:
+            if model in self.collapse:
+                queued = self.collapsed.get(model)
+                if queued is not None:
+                    self.merge(queued, model, data)
+                    self.merged += len(data)
+                    return
+                queued = (model, OrderedDict(), None)
+                self.merge(queued, model, data)
+                self.collapsed[model] = queued
+                self.append(queued, counted=False)
+                return
+
+            # Once spilling, new items go after the spilled ones.
+            spill = self.spilled or self.policy == 'spill' and self.is_full()
+            if not spill and self.is_full():
+                if self.policy == 'drop':
+                    if not self.drop_below(self.priority(model)):
+                        self.dropped[model.__name__] += 1
+                        return
+                else:
+                    self.blocked += 1
+                    self.wait_for(self.not_full, self.is_full, block,
+                                  timeout, Full)
+
+            token = None
+            if self.journal is not None and self.key(model) is not None:
+                token = self.journal.append(item)
+            if spill:
+                self.spill_item((model, data, token))
+            else:
+                self.append((model, data, token))
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def get(self, block=True, timeout=None):
+        return self.get_entry(block, timeout)[:2]
+
+    # Like get(), returning (model, rows by key, journal token).
+    def get_entry(self, block=True, timeout=None):
+        with self.not_empty:
+            self.wait_for(self.not_empty,
+                          lambda: not any(self.items), block, timeout, Empty)
+            for items in self.items:
+                if items:
+                    item = items.popleft()
+                    break
+            if self.collapsed.get(item[0]) is item:
+                del self.collapsed[item[0]]
+            else:
+                self.size -= 1
+                self.refill()
+                self.not_full.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        with self.all_tasks_done:
+            if self.unfinished_tasks <= 0:
+                raise ValueError('task_done() called too many times')
+            self.unfinished_tasks -= 1
+            if not self.unfinished_tasks:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+    # Queue the items the journal has from an earlier run, returning how
+    # many there were. Call it once db_updater is running, it waits for room.
+    def replay_journal(self):
+        count = 0
+        if self.journal is not None:
+            for item in self.journal.replay():
+                self.put(item)
+                count += 1
+        if count:
+            log.info('Queued %d database updates from the journal.', count)
+        return count
+
+    # Queued items by model name, spilled ones included.
+    def depth(self):
+        with self.mutex:
+            depth = Counter(self.spilled)
+            for items in self.items:
+                depth.update(item[0].__name__ for item in items)
+            return dict(depth)
+
+    def stats(self):
+        depth = self.depth()
+        with self.mutex:
+            return {'depth': depth,
+                    'size': sum(depth.values()),
+                    'maxsize': self.maxsize,
+                    'policy': self.policy,
+                    'dropped': dict(self.dropped),
+                    'spilled': self.spills,
+                    'spilled_pending': sum(self.spilled.values()),
+                    'merged_rows': self.merged,
+                    'blocked_puts': self.blocked,
+                    'journal': self.journal.stats()
+                    if self.journal is not None else None}
+
+    # The methods below are called with the mutex held.
+
+    def priority(self, model):
+        return self.priorities.get(model, NORMAL)
+
+    def append(self, item, counted=True):
+        self.items[self.priority(item[0])].append(item)
+        if counted:
+            self.size += 1
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+    def merge(self, queued, model, data):
+        fields = self.key(model)
+        for row in data.itervalues():
+            queued[1][tuple(row[f] for f in fields)] = row
+
+    # Drop the oldest item of the lowest class, down to `priority`, counting
+    # against the limit. Returns whether one was dropped.
+    def drop_below(self, priority):
+        for items in reversed(self.items[priority:]):
+            for item in items:
+                if self.collapsed.get(item[0]) is not item:
+                    items.remove(item)
+                    self.size -= 1
+                    self.unfinished_tasks -= 1
+                    self.dropped[item[0].__name__] += 1
+                    if item[2] is not None:
+                        self.journal.commit([item[2]])
+                    return True
+        return False
+
+    def spill_item(self, item):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(prefix='dbqueue-')
+        self.spill.seek(0, 2)
+        pickle.dump(item, self.spill, pickle.HIGHEST_PROTOCOL)
+        self.spilled[item[0].__name__] += 1
+        self.spills += 1
+
+    # Read spilled items back while there's room.
+    def refill(self):
+        while self.spilled and not self.is_full():
+            self.spill.seek(self.spill_read)
+            item = pickle.load(self.spill)
+            self.spill_read = self.spill.tell()
+            name = item[0].__name__
+            self.spilled[name] -= 1
+            if not self.spilled[name]:
+                del self.spilled[name]
+            self.append(item)
+        if not self.spilled and self.spill_read:
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.spill_read = 0
+
+    def wait_for(self, condition, waiting, block, timeout, error):
+        if not block:
+            if waiting():
+                raise error
+        elif timeout is None:
+            while waiting():
+                condition.wait()
+        else:
+            end = time.time() + timeout
+            while waiting():
+                remaining = end - time.time()
+                if remaining <= 0:
+                    raise error
+                condition.wait(remaining)
+
+
+# Write-behind stage of db_updater. The rows queued for a model are merged
+# by primary key, the last write winning, so repeated updates of the same
+# rows (worker status, scanned locations) are written once. Rows are handed
+# out for writing a model at a time once `max_rows` are pending or the
+# oldest has waited `max_delay` seconds. A model is only handed out to one
+# writer at a time, so rows of the same key are written in order. The
+# journal tokens rows come with are given back by done() once the rows (or
+# the ones they were merged into) have been written.
+class WriteBuffer(object):
+
+    def __init__(self, max_rows=1000, max_delay=1.0):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.lock = Lock()
+        # model -> OrderedDict(key -> row)
+        self.pending = OrderedDict()
+        self.writing = set()
+        # model -> journal tokens of the queue entries of the pending rows,
+        # of the rows taken (None for entries that weren't journaled).
+        self.tokens = {}
+        self.taken_tokens = {}
+        # Queue entries whose rows were written since finished() was called.
+        self.finished_entries = 0
+        self.size = 0
+        self.oldest = None
+        # Rows without a key are kept under a key of their own.
+        self.unkeyed = 0
+        # Rows were put back after a failed write, and none were written
+        # since.
+        self.failing = False
+
+        self.rows_in = 0
+        self.rows_out = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+
+    # Add rows (dicts) of a model, merged by the values of the key fields.
+    # Pass None as key_fields for models without a primary key.
+    def add(self, model, rows, key_fields, now=None, token=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.tokens.setdefault(model, []).append(token)
+            pending = self.pending.setdefault(model, OrderedDict())
+            for row in rows:
+                try:
+                    key = tuple(row[f] for f in key_fields)
+                except (KeyError, TypeError):
+                    self.unkeyed += 1
+                    key = ('unkeyed', self.unkeyed)
+                if key in pending:
+                    # The latest row goes to the end, like a new one.
+                    del pending[key]
+                else:
+                    self.size += 1
+                pending[key] = row
+                self.rows_in += 1
+            if self.oldest is None and self.size:
+                self.oldest = now
+
+    # Seconds until the pending rows are due to be written, None if there
+    # are none that aren't already being written by someone else (who takes
+    # the rows of the model again when done).
+    def wait(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.oldest is None or self.writing.issuperset(self.pending):
+                return None
+            if self.size >= self.max_rows:
+                return 0
+            return max(self.oldest + self.max_delay - now, 0)
+
+    # Take the rows of a model to write, if they are due: returns (model,
+    # batches) with the rows in dicts by key, a batch for each set of
+    # columns (a multi-row insert has one column list), or None. Call done()
+    # once they're written.
+    def take(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.oldest is None or (
+                    not self.failing and self.size < self.max_rows and
+                    now - self.oldest < self.max_delay):
+                return None
+            for model in self.pending:
+                if model not in self.writing:
+                    break
+            else:
+                return None
+
+            rows = self.pending.pop(model)
+            self.taken_tokens[model] = self.tokens.pop(model, [])
+            self.writing.add(model)
+            self.size -= len(rows)
+            if not self.size:
+                self.oldest = None
+
+        batches = OrderedDict()
+        for key, row in rows.iteritems():
+            columns = tuple(sorted(row))
+            batches.setdefault(columns, OrderedDict())[key] = row
+        return model, batches.values()
+
+    # The rows of a model handed out by take() have been written (or given
+    # up on), in `elapsed` seconds. Returns the journal tokens of the rows.
+    def done(self, model, count, elapsed):
+        with self.lock:
+            tokens = self.taken_tokens.pop(model, [])
+            self.finished_entries += len(tokens)
+            self.writing.discard(model)
+            self.failing = False
+            self.rows_out += count
+            self.flushes += 1
+            self.flush_time += elapsed
+            self.max_flush_time = max(self.max_flush_time, elapsed)
+            return [token for token in tokens if token is not None]
+
+    # The number of queue entries whose rows were written since the last
+    # call, to mark them done in the queue.
+    def finished(self):
+        with self.lock:
+            count = self.finished_entries
+            self.finished_entries = 0
+            return count
+
+    # The rows of a model handed out by take() couldn't be written: put
+    # them back with their journal tokens, to be taken again right away.
+    # Rows added since are newer and win over the ones put back.
+    def restore(self, model, batches):
+        with self.lock:
+            rows = OrderedDict()
+            for batch in batches:
+                rows.update(batch)
+            pending = self.pending.pop(model, OrderedDict())
+            for key in pending:
+                rows.pop(key, None)
+            self.size += len(rows)
+            rows.update(pending)
+            self.pending[model] = rows
+            self.tokens[model] = (self.taken_tokens.pop(model, []) +
+                                  self.tokens.get(model, []))
+            self.writing.discard(model)
+            if self.oldest is None and self.size:
+                self.oldest = time.time()
+            self.failing = True
+            self.failed_flushes += 1
+
+    # Whether as many rows are pending as are written at once, or the last
+    # write failed, in which case db_updater writes before it takes more
+    # from the queue.
+    def full(self):
+        return self.failing or self.size >= max(self.max_rows, 1)
+
+    def __len__(self):
+        return self.size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': self.size,
+                'rows_in': self.rows_in,
+                'rows_written': self.rows_out,
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+                # Rows queued per row written.
+                'coalescing_ratio': round(
+                    float(self.rows_in - self.size) / self.rows_out, 2)
+                if self.rows_out else None,
+                'avg_flush_ms': round(
+                    self.flush_time / self.flushes * 1000, 1)
+                if self.flushes else None,
+                'max_flush_ms': round(self.max_flush_time * 1000, 1)}
+
+
+# The rows last written to a table, by key, so writes of rows that haven't
+# changed can be skipped and changed rows only update the columns that did.
+# Rows are forgotten `ttl` seconds after they were last written whole, and
+# then written whole again. That bounds how long a change made by someone
+# else (another instance, a cleanup) can hide a write, and keeps columns
+# that are only written with their defaults, like the time a row was last
+# scanned, at most `ttl` seconds behind.
+class LastWritten(object):
+
+    def __init__(self, ttl=3600, maxsize=200000, timer=time.time):
+        self.lock = Lock()
+        self.rows = TTLCache(maxsize=maxsize, ttl=ttl, timer=timer)
+        self.unchanged = 0
+        self.changed = 0
+        self.new = 0
+
+    # Split rows (dicts by key) into the ones to write, grouped by the
+    # columns that changed: returns [(columns, rows by key)], columns None
+    # for rows that weren't written before. Unchanged rows are left out.
+    def split(self, data):
+        groups = OrderedDict()
+        with self.lock:
+            for key, row in data.iteritems():
+                last = self.rows.get(key)
+                if last is None:
+                    columns = None
+                    self.new += 1
+                else:
+                    columns = tuple(sorted(
+                        c for c, v in row.iteritems()
+                        if c not in last or last[c] != v))
+                    if not columns:
+                        self.unchanged += 1
+                        continue
+                    self.changed += 1
+                groups.setdefault(columns, OrderedDict())[key] = row
+        return groups.items()
+
+    # Remember rows (dicts by key) as written. Only rows that weren't
+    # remembered start a new time to live, changes are added to the rows.
+    def store(self, data):
+        with self.lock:
+            for key, row in data.iteritems():
+                last = self.rows.get(key)
+                if last is None:
+                    self.rows[key] = dict(row)
+                else:
+                    last.update(row)
+
+    def stats(self):
+        with self.lock:
+            return {'unchanged': self.unchanged, 'changed': self.changed,
+                    'new': self.new, 'remembered': len(self.rows)}
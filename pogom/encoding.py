@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+from datetime import datetime
+
+from .jsonstream import epoch_ms, iter_json, iter_gzip
+
+log = logging.getLogger(__name__)
+
+# msgpack and brotli are optional, the formats they provide are only offered
+# when they're installed.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON = 'application/json'
+# Same document as JSON, but every list of rows is turned into columns.
+COLUMNS = 'application/vnd.rocketmap.columns+json'
+MSGPACK = 'application/x-msgpack'
+
+# Short names accepted in the `format` query parameter.
+FORMATS = {'json': JSON, 'columns': COLUMNS, 'msgpack': MSGPACK}
+
+
+# Return the payload formats that can be produced, preferred first.
+def available_formats():
+    formats = [JSON, COLUMNS]
+    if msgpack is not None:
+        formats.append(MSGPACK)
+    return formats
+
+
+# Pick the payload format for a request. An explicit `format` parameter
+# wins over the Accept header.
+def choose_format(accept_mimetypes, requested=None):
+    formats = available_formats()
+    if requested:
+        mimetype = FORMATS.get(requested)
+        if mimetype in formats:
+            return mimetype
+    return accept_mimetypes.best_match(formats, default=JSON) or JSON
+
+
+# Pick the content encoding for a request from its parsed Accept-Encoding
+# header (request.accept_encodings), or None to send it as is. Codings with
+# a quality of 0 are refused, a coding named explicitly counts over `*`.
+# Brotli wins ties.
+def choose_encoding(accept_encodings):
+    qualities = dict((value.lower(), quality)
+                     for value, quality in accept_encodings)
+    codings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best, best_quality = None, 0
+    for coding in codings:
+        quality = qualities.get(coding, qualities.get('*', 0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+# Dictionary encode a column if it has few distinct values: returns
+# {'values': [distinct values], 'index': [position in values per row]}.
+# Otherwise the column is returned as is.
+def _encode_column(values):
+    if not any(isinstance(v, (basestring, dict, list)) for v in values):
+        return values
+
+    positions = {}
+    distinct = []
+    index = []
+    # Lists and dicts aren't hashable, they're compared by their JSON. Rows
+    # usually share them (like the types of a Pokemon), so the JSON of each
+    # object is only built once.
+    keys = {}
+    for value in values:
+        key = value
+        if isinstance(value, (dict, list)):
+            key = keys.get(id(value))
+            if key is None:
+                key = keys[id(value)] = json.dumps(
+                    value, sort_keys=True, default=epoch_ms)
+        position = positions.get(key)
+        if position is None:
+            position = positions[key] = len(distinct)
+            distinct.append(value)
+        index.append(position)
+
+    if len(distinct) * 2 > len(values):
+        return values
+    return {'values': distinct, 'index': index}
+
+
+# Turn rows into {'count': n, 'columns': {field: column}}. Fields missing
+# from a row are null in its column.
+def to_columns(rows):
+    rows = list(rows)
+    fields = []
+    seen = set()
+    for row in rows:
+        for field in row:
+            if field not in seen:
+                seen.add(field)
+                fields.append(field)
+
+    columns = {}
+    for field in fields:
+        columns[field] = _encode_column([row.get(field) for row in rows])
+
+    return {'count': len(rows), 'columns': columns}
+
+
+# Return a copy of a map payload with every list (or dict) of rows turned
+# into columns. Anything else, like lists of plain values or the stats of
+# the status page, is left alone.
+def columnar(d):
+    result = {}
+    for key, value in d.iteritems():
+        if isinstance(value, dict):
+            if all(isinstance(row, dict) for row in value.itervalues()):
+                value = to_columns(value.values())
+        elif hasattr(value, '__iter__'):
+            value = list(value)
+            if all(isinstance(row, dict) for row in value):
+                value = to_columns(value)
+        result[key] = value
+    return result
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime):
+        return epoch_ms(obj)
+    if hasattr(obj, '__iter__'):
+        return list(obj)
+    raise TypeError(repr(obj) + ' is not msgpack serializable')
+
+
+# Return the chunks of a map payload in a format.
+def iter_payload(d, mimetype):
+    if mimetype == MSGPACK:
+        return iter([msgpack.packb(d, default=_msgpack_default,
+                                   use_bin_type=False)])
+    if mimetype == COLUMNS:
+        d = columnar(d)
+    return iter_json(d)
+
+
+def _iter_brotli(chunks, quality=5):
+    compressor = brotli.Compressor(quality=quality)
+    for chunk in chunks:
+        data = compressor.process(chunk)
+        if data:
+            yield data
+
+    yield compressor.finish()
+
+
+# Compress chunks with a content encoding from choose_encoding().
+def iter_encoded(chunks, encoding):
+    if encoding == 'br':
+        return _iter_brotli(chunks)
+    if encoding == 'gzip':
+        return iter_gzip(chunks)
+    return chunks
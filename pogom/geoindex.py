@@ -0,0 +1,711 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import deque
+from datetime import datetime
+from threading import Lock
+
+import numpy as np
+from cachetools import LRUCache, cached
+from s2sphere.sphere import LOOKUP_POS
+
+log = logging.getLogger(__name__)
+
+# Map objects are bucketed into slippy map tiles at this zoom level. Zoom 14
+# tiles are about 2.4km wide at the equator and get narrower towards the
+# poles.
+CELL_ZOOM = 14
+
+# Viewports that would need more cells than this are answered with a full
+# scan instead, it's cheaper than walking the buckets one by one.
+MAX_COVER_CELLS = 2048
+
+# Web mercator can't represent the poles.
+MAX_LATITUDE = 85.05112878
+
+# Zoom levels served by the map tile endpoint.
+TILE_ZOOMS = (12, 13, 14, 15)
+
+# Earth radius in meters used for distances.
+EARTH_RADIUS = 6366468.241830914
+
+# Deepest S2 cell level, the one of the cells stored with map objects.
+S2_MAX_LEVEL = 30
+
+# Smallest width and largest diagonal of S2 cells at level 0 in radians,
+# halving with every level.
+S2_MIN_WIDTH = 2 * math.sqrt(2) / 3
+S2_MAX_DIAG = 2.438654594434021
+
+
+# Return the (x, y) slippy map tile of a location at a zoom level.
+def tile_xy(lat, lng, zoom=CELL_ZOOM):
+    n = 1 << zoom
+    lat = max(min(float(lat), MAX_LATITUDE), -MAX_LATITUDE)
+    lat_rad = math.radians(lat)
+    x = int((float(lng) + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) /
+             math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+# Return the integer id of the cell a location falls in.
+def cell_id(lat, lng, zoom=CELL_ZOOM):
+    x, y = tile_xy(lat, lng, zoom)
+    return (x << zoom) | y
+
+
+# Return the (min_x, min_y, max_x, max_y) range of tiles covering a viewport.
+def tile_range(swLat, swLng, neLat, neLng, zoom=CELL_ZOOM):
+    # Tile y grows towards the south.
+    min_x, max_y = tile_xy(swLat, swLng, zoom)
+    max_x, min_y = tile_xy(neLat, neLng, zoom)
+    return (min_x, min_y, max_x, max_y)
+
+
+# Return the number of tiles in a tile range.
+def range_size(tiles):
+    return (tiles[2] - tiles[0] + 1) * (tiles[3] - tiles[1] + 1)
+
+
+# Return True if a cell id falls inside a tile range.
+def in_range(cell, tiles, zoom=CELL_ZOOM):
+    x, y = cell >> zoom, cell & ((1 << zoom) - 1)
+    return tiles[0] <= x <= tiles[2] and tiles[1] <= y <= tiles[3]
+
+
+# Return the latitude/longitude of the north west corner of a tile.
+def tile_corner(x, y, zoom=CELL_ZOOM):
+    n = float(1 << zoom)
+    lng = x / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lat, lng
+
+
+# Return the (swLat, swLng, neLat, neLng) viewport of a tile range.
+def range_bounds(tiles, zoom=CELL_ZOOM):
+    neLat, swLng = tile_corner(tiles[0], tiles[1], zoom)
+    swLat, neLng = tile_corner(tiles[2] + 1, tiles[3] + 1, zoom)
+    return (swLat, swLng, neLat, neLng)
+
+
+# Return the range of tiles that lie completely inside a viewport. Edges that
+# are within margin degrees of a tile boundary count as on it, so viewports
+# snapped to range_bounds() map back to the same range. The range is empty
+# (min > max) if no tile fits.
+def inner_tile_range(swLat, swLng, neLat, neLng, zoom=CELL_ZOOM,
+                     margin=1e-7):
+    swLat, swLng, neLat, neLng = map(float, (swLat, swLng, neLat, neLng))
+    min_x, min_y, max_x, max_y = tile_range(
+        swLat + margin, swLng + margin, neLat - margin, neLng - margin, zoom)
+
+    south, west, north, east = range_bounds((min_x, min_y, max_x, max_y),
+                                            zoom)
+    if west < swLng - margin:
+        min_x += 1
+    if east > neLng + margin:
+        max_x -= 1
+    if north > neLat + margin:
+        min_y += 1
+    if south < swLat - margin:
+        max_y -= 1
+
+    return (min_x, min_y, max_x, max_y)
+
+
+# Return a list of tile ranges holding the tiles of range a that aren't in
+# range b. At most four ranges are returned.
+def range_difference(a, b):
+    ax0, ay0, ax1, ay1 = a
+    bx0, by0, bx1, by1 = b
+    if bx0 > bx1 or by0 > by1:
+        return [a]
+    if bx0 > ax1 or bx1 < ax0 or by0 > ay1 or by1 < ay0:
+        return [a]
+
+    ranges = []
+    # Full height strips to the west and east of b.
+    if ax0 < bx0:
+        ranges.append((ax0, ay0, bx0 - 1, ay1))
+    if ax1 > bx1:
+        ranges.append((bx1 + 1, ay0, ax1, ay1))
+    # What's left north and south of b.
+    mx0, mx1 = max(ax0, bx0), min(ax1, bx1)
+    if ay0 < by0:
+        ranges.append((mx0, ay0, mx1, by0 - 1))
+    if ay1 > by1:
+        ranges.append((mx0, by1 + 1, mx1, ay1))
+
+    return ranges
+
+
+# Return the set of cell ids covering a viewport, or None if the viewport
+# would need more than max_cells cells.
+def cover_bounds(swLat, swLng, neLat, neLng, zoom=CELL_ZOOM,
+                 max_cells=MAX_COVER_CELLS):
+    min_x, min_y, max_x, max_y = tile_range(swLat, swLng, neLat, neLng, zoom)
+    if (max_x - min_x + 1) * (max_y - min_y + 1) > max_cells:
+        return None
+
+    return set((x << zoom) | y
+               for x in xrange(min_x, max_x + 1)
+               for y in xrange(min_y, max_y + 1))
+
+
+# Return True if all four corners of a viewport are set.
+def has_bounds(swLat, swLng, neLat, neLng):
+    return bool(swLat and swLng and neLat and neLng)
+
+
+# Return True if a location is inside a viewport.
+def in_bounds(lat, lng, swLat, swLng, neLat, neLng):
+    return swLat <= lat <= neLat and swLng <= lng <= neLng
+
+
+# Return the viewport of the square around a location reaching radius meters
+# in every direction.
+def radius_bounds(lat, lng, radius):
+    lat, lng = float(lat), float(lng)
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    cos_lat = math.cos(math.radians(min(abs(lat) + dlat, MAX_LATITUDE)))
+    dlng = min(math.degrees(radius / (EARTH_RADIUS * cos_lat)), 180.0)
+    return (max(lat - dlat, -MAX_LATITUDE), max(lng - dlng, -180.0),
+            min(lat + dlat, MAX_LATITUDE), min(lng + dlng, 180.0))
+
+
+# Return the cells at Chebyshev distance `ring` from tile (x, y): the tile
+# itself for ring 0, the 8 around it for ring 1 and so on.
+def ring_cells(x, y, ring, zoom=CELL_ZOOM):
+    n = 1 << zoom
+    if ring == 0:
+        tiles = [(x, y)]
+    else:
+        tiles = []
+        for dx in xrange(-ring, ring + 1):
+            tiles.append((x + dx, y - ring))
+            tiles.append((x + dx, y + ring))
+        for dy in xrange(-ring + 1, ring):
+            tiles.append((x - ring, y + dy))
+            tiles.append((x + ring, y + dy))
+
+    return [(tx << zoom) | ty for tx, ty in tiles
+            if 0 <= tx < n and 0 <= ty < n]
+
+
+# Return the distance in meters from a location to the nearest edge of a
+# tile range it is in, so anything further away is outside the range.
+def range_reach(lat, lng, tiles, zoom=CELL_ZOOM):
+    south, west, north, east = range_bounds(tiles, zoom)
+    lat_reach = math.radians(min(north - lat, lat - south))
+    # Distance along the great circle that meets the meridian at a right
+    # angle.
+    lng_reach = math.asin(min(1.0, math.sin(math.radians(
+        min(east - lng, lng - west, 90.0))) * math.cos(math.radians(lat))))
+    return max(min(lat_reach, lng_reach), 0.0) * EARTH_RADIUS
+
+
+# Return an array of the distances in meters from a location to arrays of
+# latitudes and longitudes.
+def distances(lat, lng, lats, lngs):
+    lat1 = math.radians(float(lat))
+    lats = np.radians(np.asarray(lats, dtype=float))
+    dlat = lats - lat1
+    dlng = np.radians(np.asarray(lngs, dtype=float) - float(lng))
+    a = (np.sin(dlat / 2) ** 2 +
+         math.cos(lat1) * np.cos(lats) * np.sin(dlng / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+# Return the compass directions ('N', 'SE', ...) from a location to arrays of
+# latitudes and longitudes. Differences under 1e-4 degrees (about 10m) are
+# ignored, so objects right next to the location have no direction.
+def directions(lat, lng, lats, lngs):
+    dlat = np.asarray(lats, dtype=float) - float(lat)
+    dlng = np.asarray(lngs, dtype=float) - float(lng)
+    north_south = np.where(np.abs(dlat) > 1e-4,
+                           np.where(dlat >= 0, 'N', 'S'), '')
+    east_west = np.where(np.abs(dlng) > 1e-4,
+                         np.where(dlng >= 0, 'E', 'W'), '')
+    return list(np.core.defchararray.add(north_south, east_west))
+
+
+# Rank rows by their distance from a location. Returns (row, distance in
+# meters, direction) tuples, nearest first, for the rows within radius
+# meters, at most limit of them.
+def nearest(rows, lat, lng, limit=None, radius=None):
+    rows = list(rows)
+    if not rows:
+        return []
+
+    lats = np.fromiter((row['latitude'] for row in rows), float, len(rows))
+    lngs = np.fromiter((row['longitude'] for row in rows), float, len(rows))
+    dist = distances(lat, lng, lats, lngs)
+
+    order = np.arange(len(rows))
+    if radius is not None:
+        order = order[dist <= radius]
+    # Only sort the rows that make the cut.
+    if limit is not None and limit < len(order):
+        order = order[np.argpartition(dist[order], limit - 1)[:limit]]
+    order = order[np.argsort(dist[order], kind='mergesort')]
+
+    dirs = directions(lat, lng, lats[order], lngs[order])
+    return [(rows[i], float(dist[i]), str(d))
+            for i, d in itertools.izip(order, dirs)]
+
+
+# Hilbert curve positions of 4x4 blocks of cells, by orientation.
+_S2_LOOKUP_POS = np.array(LOOKUP_POS, dtype=np.int64)
+_S2_MAX_SIZE = 1 << S2_MAX_LEVEL
+
+
+# Return the cube faces and (i, j) leaf cell coordinates on them of arrays
+# of locations. Same as CellId.from_lat_lng(), minus the Hilbert curve.
+def _s2_face_ij(lats, lngs):
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lng = np.radians(np.asarray(lngs, dtype=float))
+    x = np.cos(lat) * np.cos(lng)
+    y = np.cos(lat) * np.sin(lng)
+    z = np.sin(lat)
+
+    # The cube face is the one of the largest component, then (u, v) is
+    # the location's projection on it.
+    ax, ay, az = np.abs(x), np.abs(y), np.abs(z)
+    face = np.where(ax > ay, np.where(ax > az, 0, 2),
+                    np.where(ay > az, 1, 2))
+    face += 3 * (np.choose(face, (x, y, z)) < 0)
+    # Every face's projection is computed, only the right one is kept.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = np.choose(face, (y / x, -x / y, -x / z, z / x, z / y, -y / z))
+        v = np.choose(face, (z / x, z / y, -y / z, y / x, -x / y, -x / z))
+
+        # Quadratic projection to (s, t), then to leaf cell coordinates.
+        i, j = [np.clip(np.floor(_S2_MAX_SIZE * np.where(
+            w >= 0, 0.5 * np.sqrt(1 + 3 * w), 1 - 0.5 * np.sqrt(1 - 3 * w))),
+            0, _S2_MAX_SIZE - 1).astype(np.int64) for w in (u, v)]
+
+    return face.astype(np.int64), i, j
+
+
+# Return the (lat, lng) in degrees of (i, j) leaf cell coordinates, or
+# cell corners, on cube faces.
+def _s2_latlng(face, i, j):
+    u, v = [np.where(s >= 0.5, (4 * s * s - 1) / 3.0,
+                     (1 - 4 * (1 - s) * (1 - s)) / 3.0)
+            for s in (i / float(_S2_MAX_SIZE), j / float(_S2_MAX_SIZE))]
+    one = np.ones_like(u)
+    x = np.choose(face, (one, -u, -u, -one, v, v))
+    y = np.choose(face, (u, one, -v, -v, -one, u))
+    z = np.choose(face, (v, v, one, -u, -u, -one))
+    return (np.degrees(np.arctan2(z, np.hypot(x, y))),
+            np.degrees(np.arctan2(y, x)))
+
+
+# Return the S2 leaf cells of (i, j) leaf cell coordinates on cube faces.
+def _s2_leaf_ids(face, i, j):
+    # Walk down the Hilbert curve 4 levels at a time.
+    pos = face << 60
+    bits = face & 1
+    for k in range(7, -1, -1):
+        bits = bits + (((i >> (k * 4)) & 15) << 6)
+        bits += ((j >> (k * 4)) & 15) << 2
+        bits = _S2_LOOKUP_POS[bits]
+        pos |= (bits >> 2) << (k * 8)
+        bits &= 3
+
+    # Database columns are signed, S2 cell ids aren't. Ids on the last two
+    # faces wrap around to negative numbers, but keep their order within a
+    # face, so a cell is still a range of leaf cells.
+    return (pos.astype(np.uint64) * 2 + 1).view(np.int64)
+
+
+# Return the S2 leaf cells of locations, as stored in the s2cell columns.
+# Same as CellId.from_lat_lng(), for arrays of locations at once.
+def s2_leaves(lats, lngs):
+    return _s2_leaf_ids(*_s2_face_ij(lats, lngs))
+
+
+# Return the S2 leaf cell of a location, as stored in the s2cell columns.
+def s2_leaf(lat, lng):
+    return int(s2_leaves([lat], [lng])[0])
+
+
+# Return sorted, non overlapping (first, last) ranges of s2_leaf() values
+# that cover a viewport, with a bit to spare around it. Map clients ask for
+# the same viewports again and again, so recent ones are kept.
+@cached(LRUCache(maxsize=1024), lock=Lock())
+def s2_ranges(swLat, swLng, neLat, neLng):
+    swLng, neLng = float(swLng), float(neLng)
+    swLat, neLat = [max(min(float(lat), MAX_LATITUDE), -MAX_LATITUDE)
+                    for lat in (swLat, neLat)]
+    lat = math.radians((swLat + neLat) / 2)
+    extent = max(math.radians(neLat - swLat),
+                 math.radians(neLng - swLng) * math.cos(lat))
+    # Cells about an eighth of the viewport's size, a few dozen of them.
+    level = S2_MAX_LEVEL
+    if extent > 0:
+        level = min(max(int(math.log(math.pi / extent, 2)) + 2, 0),
+                    S2_MAX_LEVEL)
+
+    # Find the cells from the ones of a grid of locations, in and around
+    # the viewport. Any cell touching the viewport lies within a cell
+    # diagonal of it, and has a point of the grid inside it: the grid is
+    # finer than the smallest circle that fits in a cell.
+    step = S2_MIN_WIDTH / (1 << level) / 4
+    pad = S2_MAX_DIAG / (1 << level)
+    near = min(abs(swLat), abs(neLat)) if swLat * neLat > 0 else 0
+    far = min(max(abs(swLat), abs(neLat)) + math.degrees(pad), MAX_LATITUDE)
+    lat_step = math.degrees(step)
+    lng_step = lat_step / math.cos(math.radians(near))
+    lat_pad = math.degrees(pad)
+    lng_pad = min(lat_pad / math.cos(math.radians(far)), 180)
+    lats = np.arange(swLat - lat_pad, neLat + lat_pad + lat_step, lat_step)
+    lngs = np.arange(swLng - lng_pad, neLng + lng_pad + lng_step, lng_step)
+    lats, lngs = np.meshgrid(np.clip(lats, -90, 90), lngs)
+    face, i, j = _s2_face_ij(lats.ravel(), lngs.ravel())
+
+    shift = S2_MAX_LEVEL - level
+    cells = np.unique((face << 60) | ((i >> shift) << 30) | (j >> shift))
+    face = cells >> 60
+    i = ((cells >> 30) & (_S2_MAX_SIZE - 1)) << shift
+    j = (cells & (_S2_MAX_SIZE - 1)) << shift
+
+    # Then drop the ones around the viewport. Cell edges are great circles,
+    # they only stray from the corners' bounds towards the poles. Cells on
+    # the poles or across the antimeridian are kept.
+    if level > 1:
+        size = 1 << shift
+        corners = _s2_latlng(np.tile(face, 4),
+                             np.concatenate((i, i + size, i, i + size)),
+                             np.concatenate((j, j, j + size, j + size)))
+        lat, lng = [c.reshape(4, len(cells)) for c in corners]
+        bulge = np.degrees(pad * pad / 8 * np.tan(np.radians(
+            np.minimum(np.abs(lat).max(axis=0), 89.9))))
+        keep = ((lat.max(axis=0) + bulge >= swLat) &
+                (lat.min(axis=0) - bulge <= neLat) &
+                (((lng.max(axis=0) >= swLng) & (lng.min(axis=0) <= neLng)) |
+                 (lng.max(axis=0) - lng.min(axis=0) > 180)))
+        face, i, j = face[keep], i[keep], j[keep]
+
+    # A cell's leaf cells are the range around its id.
+    size = 1 << (2 * shift + 1)
+    first = (_s2_leaf_ids(face, i, j) & ~(size - 1)) + 1
+    cells = sorted(itertools.izip(first.tolist(),
+                                  (first + (size - 2)).tolist()))
+
+    ranges = []
+    for first, last in cells:
+        # Leaf cell ids are odd, neighbouring cells are 2 apart.
+        if ranges and first <= ranges[-1][1] + 2:
+            ranges[-1] = (ranges[-1][0], last)
+        else:
+            ranges.append((first, last))
+
+    return tuple(ranges)
+
+
+# In-memory index of unexpired Pokemon, bucketed by cell. Rows are the same
+# dicts that get written to the Pokemon table, so queries can be answered
+# without a database round trip.
+class PokemonIndex(object):
+
+    def __init__(self, zoom=CELL_ZOOM, enabled=False):
+        self.zoom = zoom
+        self.enabled = enabled
+        self.loaded = False
+        self.lock = Lock()
+        self.load_lock = Lock()
+        # cell id -> {encounter_id: row}
+        self.cells = {}
+        # encounter_id -> cell id
+        self.pokemon = {}
+        # Heap of (disappear_time, encounter_id), used to drop despawns.
+        self.expiry = []
+
+    def __len__(self):
+        return len(self.pokemon)
+
+    # Fill the index from the database on a cold start. The loader is only
+    # called once, and rows already added by the scanner are kept.
+    def ensure_loaded(self, loader):
+        if self.loaded:
+            return
+
+        with self.load_lock:
+            if self.loaded:
+                return
+
+            rows = loader()
+            with self.lock:
+                for row in rows:
+                    if row['encounter_id'] not in self.pokemon:
+                        self._add(row)
+                self.loaded = True
+
+            log.info('Loaded %d active Pokemon into the map index.',
+                     len(self.pokemon))
+
+    # Add or update rows. last_modified is set to the time the index learned
+    # about a change, so clients polling with a timestamp don't miss rows
+    # that reached the index late.
+    def add(self, rows):
+        now_date = datetime.utcnow()
+        with self.lock:
+            for row in rows:
+                if row['disappear_time'] <= now_date:
+                    continue
+                # S2 cells are for database lookups only.
+                row = dict(row)
+                row.pop('s2cell', None)
+                if self._unchanged(row):
+                    continue
+                row['last_modified'] = now_date
+                self._add(row)
+
+            self._remove_expired(now_date)
+
+    def remove_expired(self, now_date=None):
+        with self.lock:
+            return self._remove_expired(now_date or datetime.utcnow())
+
+    # Return copies of the active Pokemon in a viewport. Without a viewport
+    # all active Pokemon are returned.
+    #   since: only return Pokemon modified after this datetime.
+    #   exclude: viewport tuple, skip Pokemon inside it.
+    #   ids: only return these Pokemon ids.
+    def query(self, swLat=None, swLng=None, neLat=None, neLng=None,
+              since=None, exclude=None, ids=None):
+        now_date = datetime.utcnow()
+        bounded = has_bounds(swLat, swLng, neLat, neLng)
+        if bounded:
+            swLat, swLng, neLat, neLng = map(
+                float, (swLat, swLng, neLat, neLng))
+        if exclude is not None:
+            exclude = map(float, exclude)
+        if ids is not None:
+            ids = set(ids)
+
+        with self.lock:
+            self._remove_expired(now_date)
+
+            cells = None
+            if bounded:
+                cells = cover_bounds(swLat, swLng, neLat, neLng, self.zoom)
+
+            if cells is None:
+                buckets = self.cells.values()
+            else:
+                buckets = [self.cells[c] for c in cells if c in self.cells]
+
+            result = []
+            for bucket in buckets:
+                for row in bucket.itervalues():
+                    if ids is not None and row['pokemon_id'] not in ids:
+                        continue
+                    if since is not None and row['last_modified'] <= since:
+                        continue
+                    lat, lng = row['latitude'], row['longitude']
+                    if bounded and not in_bounds(lat, lng, swLat, swLng,
+                                                 neLat, neLng):
+                        continue
+                    if exclude is not None and in_bounds(lat, lng, *exclude):
+                        continue
+                    result.append(dict(row))
+
+        return result
+
+    # Return copies of the active Pokemon with these encounter ids.
+    def get(self, encounter_ids):
+        now_date = datetime.utcnow()
+        result = []
+        with self.lock:
+            for encounter_id in encounter_ids:
+                row = self._get(encounter_id)
+                if row is not None and row['disappear_time'] > now_date:
+                    result.append(dict(row))
+
+        return result
+
+    # Return copies of the active Pokemon that can be among the `limit`
+    # nearest to a location within radius meters. Cells are searched in
+    # rings around the location until the rows found are known to include
+    # the nearest ones, rank them with nearest().
+    def nearest(self, lat, lng, limit=None, radius=None):
+        now_date = datetime.utcnow()
+        lat, lng = float(lat), float(lng)
+        x, y = tile_xy(lat, lng, self.zoom)
+        mask = (1 << self.zoom) - 1
+
+        with self.lock:
+            self._remove_expired(now_date)
+            if not self.cells:
+                return []
+
+            # Rings past the furthest cell with Pokemon are empty.
+            xs = [cell >> self.zoom for cell in self.cells]
+            ys = [cell & mask for cell in self.cells]
+            max_ring = max(x - min(xs), max(xs) - x, y - min(ys), max(ys) - y)
+            if radius is not None:
+                tiles = tile_range(*radius_bounds(lat, lng, radius),
+                                   zoom=self.zoom)
+                max_ring = min(max_ring, max(x - tiles[0], tiles[2] - x,
+                                             y - tiles[1], tiles[3] - y))
+
+            rows = []
+            for ring in xrange(max_ring + 1):
+                for cell in ring_cells(x, y, ring, self.zoom):
+                    bucket = self.cells.get(cell)
+                    if bucket:
+                        rows.extend(dict(row) for row in bucket.itervalues())
+
+                if limit is None or len(rows) < limit:
+                    continue
+                # Pokemon outside the rings searched so far are further
+                # away than reach, stop once enough of them are closer.
+                reach = range_reach(lat, lng, (x - ring, y - ring, x + ring,
+                                               y + ring), self.zoom)
+                dist = distances(lat, lng, [row['latitude'] for row in rows],
+                                 [row['longitude'] for row in rows])
+                if (dist <= reach).sum() >= limit:
+                    break
+
+        return rows
+
+    def _get(self, encounter_id):
+        cell = self.pokemon.get(encounter_id)
+        if cell is None:
+            return None
+        return self.cells[cell][encounter_id]
+
+    def _unchanged(self, row):
+        old = self._get(row['encounter_id'])
+        if old is None:
+            return False
+        for key, value in row.iteritems():
+            if key != 'last_modified' and old.get(key) != value:
+                return False
+        return True
+
+    def _add(self, row):
+        encounter_id = row['encounter_id']
+        cell = cell_id(row['latitude'], row['longitude'], self.zoom)
+
+        old = self._get(encounter_id)
+        if old is not None and self.pokemon[encounter_id] != cell:
+            self._discard(encounter_id)
+
+        self.cells.setdefault(cell, {})[encounter_id] = row
+        self.pokemon[encounter_id] = cell
+        if old is None or old['disappear_time'] != row['disappear_time']:
+            heapq.heappush(self.expiry,
+                           (row['disappear_time'], encounter_id))
+
+    def _discard(self, encounter_id):
+        cell = self.pokemon.pop(encounter_id, None)
+        if cell is None:
+            return
+
+        bucket = self.cells[cell]
+        del bucket[encounter_id]
+        if not bucket:
+            del self.cells[cell]
+
+    def _remove_expired(self, now_date):
+        removed = 0
+        while self.expiry and self.expiry[0][0] <= now_date:
+            disappear_time, encounter_id = heapq.heappop(self.expiry)
+            cell = self.pokemon.get(encounter_id)
+            if cell is None:
+                continue
+            # The Pokemon might have been re-added with a later despawn.
+            if self.cells[cell][encounter_id]['disappear_time'] > now_date:
+                continue
+            self._discard(encounter_id)
+            removed += 1
+
+        return removed
+
+
+# Sequence numbered log of the rows committed to the database, so map clients
+# can ask for exactly the changes made after the last sequence number they
+# saw. Only the last `size` changes are kept, older sequence numbers have to
+# reload their viewport.
+class ChangeLog(object):
+
+    def __init__(self, size=100000, zoom=CELL_ZOOM, enabled=False):
+        self.zoom = zoom
+        self.enabled = enabled
+        self.lock = Lock()
+        self.changes = deque(maxlen=size)
+        # Start from the clock so sequence numbers handed out by a previous
+        # run are never mistaken for ours.
+        self.base = int(time.time()) * 1000000
+        self.seq = self.base
+
+    # Record changed rows of a kind, rows are (key, latitude, longitude).
+    def record(self, kind, rows):
+        with self.lock:
+            for key, lat, lng in rows:
+                self.seq += 1
+                self.changes.append(
+                    (self.seq, kind, cell_id(lat, lng, self.zoom), key))
+
+            return self.seq
+
+    # Return {kind: set of keys} changed after seq, limited to a tile range.
+    # Returns None if the changes since seq are no longer known.
+    def since(self, seq, tiles=None):
+        with self.lock:
+            if seq < self.base or seq > self.seq:
+                return None
+            if self.changes and self.changes[0][0] > seq + 1:
+                return None
+
+            entries = []
+            for entry in reversed(self.changes):
+                if entry[0] <= seq:
+                    break
+                entries.append(entry)
+
+        changed = {}
+        for _, kind, cell, key in entries:
+            if tiles is None or in_range(cell, tiles, self.zoom):
+                changed.setdefault(kind, set()).add(key)
+
+        return changed
+
+
+# Per tile version numbers, bumped whenever a map object inside the tile is
+# written. Versions are only meaningful for the lifetime of the process, so
+# they're combined with the start time when used as an ETag.
+class TileVersions(object):
+
+    def __init__(self, zooms=TILE_ZOOMS, enabled=False):
+        self.zooms = zooms
+        self.max_zoom = max(zooms)
+        self.enabled = enabled
+        self.lock = Lock()
+        self.boot = int(time.time())
+        self.version = 0
+        # (zoom, x, y) -> version
+        self.versions = {}
+
+    # Bump the tiles holding these (latitude, longitude) locations.
+    def bump(self, locations):
+        with self.lock:
+            self.version += 1
+            for lat, lng in locations:
+                x, y = tile_xy(lat, lng, self.max_zoom)
+                for zoom in self.zooms:
+                    shift = self.max_zoom - zoom
+                    self.versions[(zoom, x >> shift, y >> shift)] = \
+                        self.version
+
+    # Return the ETag of a tile.
+    def etag(self, zoom, x, y):
+        return '%d-%d' % (self.boot, self.versions.get((zoom, x, y), 0))
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import cPickle as pickle
+import errno
+import logging
+import os
+import struct
+import time
+import zlib
+from collections import Counter
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+# Record header: length and CRC32 of the pickled record.
+HEADER = struct.Struct('>II')
+
+SEGMENT_SUFFIX = '.journal'
+
+
+# Append-only journal of the database updates that aren't in the database
+# yet, kept as numbered segment files in a directory. Every update is
+# appended before it is queued, and the segment number it went to is its
+# token: once the updates of all the tokens of a segment are committed, the
+# segment is removed. A segment is closed when it reaches `segment_size`
+# bytes, or when everything in it is committed.
+#
+# Records are flushed to the OS as they're appended, so they survive the
+# process crashing, and synced to disk every `sync_interval` seconds and
+# when their segment is closed. A record cut short by a crash ends the
+# replay of its segment.
+#
+# Segments left by an earlier run are replayed with replay(), and removed
+# once their updates have been appended again.
+class Journal(object):
+
+    def __init__(self, path, segment_size=4 * 1024 * 1024, sync_interval=1.0):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.lock = Lock()
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.old = sorted(self.segments())
+        self.number = self.old[-1] if self.old else 0
+        self.current = None
+        # Segment -> records appended to it and not committed yet.
+        self.outstanding = Counter()
+        self.last_sync = time.time()
+
+        self.appended = 0
+        self.committed = 0
+        self.replayed = 0
+        self.corrupt = 0
+
+    def segments(self):
+        for name in os.listdir(self.path):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    yield int(name[:-len(SEGMENT_SUFFIX)])
+                except ValueError:
+                    pass
+
+    def filename(self, number):
+        return os.path.join(self.path,
+                            '{:012d}{}'.format(number, SEGMENT_SUFFIX))
+
+    # Yield the records of the segments of an earlier run, in order. They
+    # are removed when all have been yielded, the caller appends them again
+    # (by queueing them).
+    def replay(self):
+        for number in self.old:
+            with open(self.filename(number), 'rb') as f:
+                while True:
+                    header = f.read(HEADER.size)
+                    if not header:
+                        break
+                    data = ''
+                    if len(header) == HEADER.size:
+                        length, crc = HEADER.unpack(header)
+                        data = f.read(length)
+                    if (len(header) < HEADER.size or len(data) < length or
+                            zlib.crc32(data) & 0xffffffff != crc):
+                        log.warning('Journal segment %d is cut short, '
+                                    'replaying the records before.', number)
+                        self.corrupt += 1
+                        break
+                    self.replayed += 1
+                    yield pickle.loads(data)
+
+        for number in self.old:
+            self.remove(number)
+        self.old = []
+
+    # Append a record, returning its token.
+    def append(self, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.current is None:
+                self.number += 1
+                self.current = open(self.filename(self.number), 'ab')
+            self.current.write(HEADER.pack(len(data),
+                                           zlib.crc32(data) & 0xffffffff))
+            self.current.write(data)
+            self.current.flush()
+            number = self.number
+            self.outstanding[number] += 1
+            self.appended += 1
+
+            now = time.time()
+            if self.current.tell() >= self.segment_size:
+                self.close_current()
+            elif now - self.last_sync >= self.sync_interval:
+                os.fsync(self.current.fileno())
+                self.last_sync = now
+            return number
+
+    # The records of the tokens are in the database.
+    def commit(self, tokens):
+        with self.lock:
+            for number in tokens:
+                self.outstanding[number] -= 1
+                self.committed += 1
+                if not self.outstanding[number]:
+                    del self.outstanding[number]
+                    if self.current is not None and number == self.number:
+                        # Nothing in it to keep, the next record starts
+                        # a new one.
+                        self.current.close()
+                        self.current = None
+                    self.remove(number)
+
+    def close(self):
+        with self.lock:
+            if self.current is not None:
+                self.close_current()
+
+    def stats(self):
+        with self.lock:
+            return {'segments': len(self.outstanding) + len(self.old),
+                    'pending': sum(self.outstanding.values()),
+                    'appended': self.appended,
+                    'committed': self.committed,
+                    'replayed': self.replayed,
+                    'corrupt_segments': self.corrupt}
+
+    # Called with the lock held.
+    def close_current(self):
+        os.fsync(self.current.fileno())
+        self.current.close()
+        self.current = None
+        self.last_sync = time.time()
+        if not self.outstanding[self.number]:
+            del self.outstanding[self.number]
+            self.remove(self.number)
+
+    def remove(self, number):
+        try:
+            os.remove(self.filename(number))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                log.warning('Unable to remove journal segment %d: %s',
+                            number, repr(e))
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import zlib
+from datetime import datetime
+
+EPOCH = datetime(1970, 1, 1)
+
+
+# Return a datetime as milliseconds since the epoch. Naive datetimes are
+# taken to be UTC. Plain arithmetic, calendar.timegm() is a lot slower.
+def epoch_ms(dt):
+    offset = dt.utcoffset()
+    if offset is not None:
+        dt = dt.replace(tzinfo=None) - offset
+    delta = dt - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000 +
+            delta.microseconds // 1000)
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return epoch_ms(obj)
+    if hasattr(obj, '__iter__'):
+        return list(obj)
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+
+_encode = json.JSONEncoder(default=_default, separators=(',', ':')).encode
+
+
+def _encode_key(key):
+    if not isinstance(key, basestring):
+        key = str(key)
+    return _encode(key)
+
+
+def _iter_parts(d):
+    yield '{'
+    for i, (key, value) in enumerate(d.iteritems()):
+        yield (',' if i else '') + _encode_key(key) + ':'
+        if isinstance(value, dict):
+            yield '{'
+            for j, (k, v) in enumerate(value.iteritems()):
+                yield (',' if j else '') + _encode_key(k) + ':' + _encode(v)
+            yield '}'
+        elif hasattr(value, '__iter__'):
+            yield '['
+            for j, row in enumerate(value):
+                yield (',' if j else '') + _encode(row)
+            yield ']'
+        else:
+            yield _encode(value)
+    yield '}'
+
+
+# Generate the JSON of a dict in chunks of about chunk_size bytes. Lists,
+# generators and dicts at the top level are encoded one element at a time,
+# so rows can be produced by a database cursor while the response is sent
+# and only one chunk is held in memory.
+def iter_json(d, chunk_size=65536):
+    parts = []
+    size = 0
+    for part in _iter_parts(d):
+        parts.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+
+    if parts:
+        yield ''.join(parts)
+
+
+# Gzip a stream of chunks.
+def iter_gzip(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+from collections import deque
+from datetime import datetime
+from threading import Condition, Lock
+
+from .geoindex import CELL_ZOOM, cell_id, in_range
+
+log = logging.getLogger(__name__)
+
+# Message telling a subscriber it missed updates and has to reload its
+# viewport.
+RESYNC = ('resync', 'resync', [])
+
+
+# One connected map client, listening to the cells of a tile range. Messages
+# are buffered until the client reads them. A client that falls more than
+# `size` messages behind loses its buffer and gets a single RESYNC instead,
+# so publishing never has to wait for it.
+class Subscriber(object):
+
+    def __init__(self, tiles, size):
+        self.tiles = tiles
+        self.size = size
+        self.queue = deque()
+        self.overflow = False
+        self.cond = Condition(Lock())
+
+    def put(self, message):
+        with self.cond:
+            if self.overflow:
+                return
+            if len(self.queue) >= self.size:
+                self.queue.clear()
+                self.overflow = True
+            else:
+                self.queue.append(message)
+            self.cond.notify()
+
+    # Return the buffered messages, waiting up to timeout seconds for one.
+    def get(self, timeout):
+        with self.cond:
+            if not self.queue and not self.overflow:
+                self.cond.wait(timeout)
+
+            if self.overflow:
+                self.overflow = False
+                return [RESYNC]
+
+            messages = list(self.queue)
+            self.queue.clear()
+            return messages
+
+
+# Fans out map object updates from the scanner to the subscribers whose
+# cells they fall in. Messages are (kind, op, rows), with op 'update' for
+# new or changed objects and 'expired' for despawned Pokemon.
+class LiveFeed(object):
+
+    def __init__(self, zoom=CELL_ZOOM, buffer_size=1000, max_subscribers=200,
+                 enabled=False):
+        self.zoom = zoom
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self.enabled = enabled
+        self.lock = Lock()
+        self.subscribers = set()
+        # Heap of (disappear_time, encounter_id) and the latest disappear
+        # time of each published Pokemon, used to announce despawns.
+        self.expiry = []
+        self.pokemon = {}
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    # Return a new subscriber for a tile range, or None if there are too
+    # many already.
+    def subscribe(self, tiles):
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            subscriber = Subscriber(tiles, self.buffer_size)
+            self.subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            # Nobody left to tell about despawns.
+            if not self.subscribers:
+                self.expiry = []
+                self.pokemon = {}
+
+    # Send rows of a kind to everyone subscribed to their cells. Rows need a
+    # latitude and longitude and are copied, so callers may keep using them.
+    def publish(self, kind, rows, op='update'):
+        with self.lock:
+            subscribers = list(self.subscribers)
+            if not subscribers:
+                return
+            if kind == 'pokemon' and op == 'update':
+                for row in rows:
+                    self._track(row)
+
+        cells = {}
+        for row in rows:
+            cell = cell_id(row['latitude'], row['longitude'], self.zoom)
+            cells.setdefault(cell, []).append(dict(row))
+
+        for subscriber in subscribers:
+            matched = []
+            for cell, cell_rows in cells.iteritems():
+                if in_range(cell, subscriber.tiles, self.zoom):
+                    matched.extend(cell_rows)
+            if matched:
+                subscriber.put((kind, op, matched))
+
+    # Announce the Pokemon that despawned since the last call.
+    def expire(self, now_date=None):
+        now_date = now_date or datetime.utcnow()
+        expired = []
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now_date:
+                disappear_time, encounter_id = heapq.heappop(self.expiry)
+                row = self.pokemon.get(encounter_id)
+                # Skip Pokemon that were republished with a later despawn.
+                if row is None or row['disappear_time'] != disappear_time:
+                    continue
+                del self.pokemon[encounter_id]
+                expired.append(row)
+
+        if expired:
+            self.publish('pokemon', expired, op='expired')
+
+    def _track(self, row):
+        old = self.pokemon.get(row['encounter_id'])
+        if old is not None and old['disappear_time'] == row['disappear_time']:
+            return
+
+        self.pokemon[row['encounter_id']] = {
+            'encounter_id': row['encounter_id'],
+            'latitude': row['latitude'],
+            'longitude': row['longitude'],
+            'disappear_time': row['disappear_time']}
+        heapq.heappush(self.expiry,
+                       (row['disappear_time'], row['encounter_id']))
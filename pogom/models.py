@@ -10,11 +10,15 @@ import gc
 import time
 import geopy
 import math
+import operator
+import numpy as np
+from threading import Lock
 from peewee import InsertQuery, \
     Check, CompositeKey, ForeignKeyField, \
-    SmallIntegerField, IntegerField, CharField, DoubleField, BooleanField, \
-    DateTimeField, fn, DeleteQuery, FloatField, SQL, TextField, JOIN, \
-    OperationalError
+    SmallIntegerField, IntegerField, BigIntegerField, CharField, \
+    DoubleField, BooleanField, DateTimeField, fn, DeleteQuery, FloatField, \
+    TextField, JOIN, OperationalError, MySQLDatabase
+from peewee import mysql as mysql_driver
 from playhouse.flask_utils import FlaskDB
 from playhouse.pool import PooledMySQLDatabase
 from playhouse.shortcuts import RetryOperationalError, case
@@ -25,12 +29,20 @@ from base64 import b64encode
 from cachetools import TTLCache
 from cachetools import cached
 from timeit import default_timer
+from queue import Empty
 
 from . import config
-from .utils import get_pokemon_name, get_pokemon_rarity, get_pokemon_types, \
-    get_args, cellid, in_radius, date_secs, clock_between, secs_between, \
-    get_move_name, get_move_damage, get_move_energy, get_move_type
+from .utils import get_pokemon_name, get_args, cellid, in_radius, \
+    date_secs, clock_between, secs_between, get_move_name, get_move_damage, \
+    get_move_energy, get_move_type, add_pokemon_locale
 from .transform import transform_from_wgs_to_gcj, get_new_coords
+from .geoindex import PokemonIndex, ChangeLog, TileVersions, nearest, \
+    radius_bounds, s2_leaf, s2_leaves, s2_ranges
+from .livefeed import LiveFeed
+from .cache import GymCache, gym_changed
+from .dbqueue import UpdateQueue, WriteBuffer, LastWritten, HIGH, LOW
+from .journal import Journal
+from .upsert import upsert
 from .customLog import printPokemon
 from .account import tutorial_pokestop_spin
 log = logging.getLogger(__name__)
@@ -39,7 +51,31 @@ args = get_args()
 flaskDb = FlaskDB()
 cache = TTLCache(maxsize=100, ttl=60 * 5)
 
-db_schema_version = 16
+# Active Pokemon served to the map, fed by parse_map.
+pokemon_index = PokemonIndex(enabled=args.pokemon_index)
+
+# Map object changes committed by db_updater, for delta syncing map clients.
+change_log = ChangeLog(enabled=args.delta_sync)
+
+# Versions of the map tiles, only known when this instance does the writing.
+tile_versions = TileVersions(enabled=not args.only_server)
+
+# Map object updates pushed to map clients as they're parsed.
+live_feed = LiveFeed(enabled=args.live_feed)
+
+# Gym details for /gym_data. Instances that don't parse gyms can't keep them
+# fresh, so they only keep them briefly.
+gym_cache = GymCache(ttl=60 if args.only_server else 600)
+
+# Updates queued for db_updater, merged until they're written.
+write_buffer = WriteBuffer(max_rows=args.db_buffer_rows,
+                           max_delay=args.db_buffer_delay)
+
+db_schema_version = 23
+
+# Square sizes in meters tried by Pokemon.get_nearest() before it gives up
+# and looks at all active Pokemon.
+NEAREST_SEARCH_RADII = (1000, 4000, 16000)
 
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
@@ -76,8 +112,114 @@ def init_database(app):
     return db
 
 
+# Split a list into chunks, to keep IN () lists under the SQLite parameter
+# limit.
+def chunks(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Start of the stats rollup bucket a time falls in. Buckets are `size`
+# seconds long and aligned to the epoch.
+def bucket_start(dt, size):
+    secs = calendar.timegm(dt.timetuple())
+    return datetime.utcfromtimestamp(secs - secs % size)
+
+
+# Split a stats duration into the part before the first whole rollup bucket
+# and the buckets: returns (cutoff, start), with the Pokemon seen after
+# cutoff and before start to be counted from the Pokemon table. Both are
+# None for the map lifetime.
+def stats_window(timediff, size):
+    if not timediff:
+        return None, None
+    cutoff = datetime.utcnow() - timediff
+    return cutoff, bucket_start(cutoff, size) + timedelta(seconds=size)
+
+
+# Add a rollup row (or an aggregate of them) to the totals under key,
+# keeping the location of the latest sighting if the rows have one.
+def merge_sightings(totals, key, row):
+    total = totals.get(key)
+    if total is None:
+        totals[key] = dict(row)
+        return
+    total['count'] += row['count']
+    last_seen = row.get('last_seen')
+    if last_seen is not None and last_seen > total['last_seen']:
+        total.update(last_seen=row['last_seen'], latitude=row['latitude'],
+                     longitude=row['longitude'])
+
+
+# Iterate over the rows of a query without keeping them in the query, so big
+# results can be streamed. The query only runs once iteration starts. Plain
+# lists are iterated as they are.
+#
+# MySQL drivers read the whole result before handing out the first row, so
+# there the rows are read with an unbuffered (server side) cursor. Until the
+# last row is read the connection can't run other queries: callers must not
+# query the database while they iterate.
+def iter_rows(query):
+    if not hasattr(query, 'iterator'):
+        for row in query:
+            yield row
+        return
+    if not isinstance(query.database, MySQLDatabase):
+        for row in query.iterator():
+            yield row
+        return
+
+    sql, params = query.sql()
+    cursor = query.database.get_conn().cursor(mysql_driver.cursors.SSCursor)
+    try:
+        cursor.execute(sql, params)
+        wrapper = query._get_result_wrapper()(
+            query.model_class, cursor, query.get_query_meta())
+        for row in wrapper.iterator():
+            yield row
+    finally:
+        cursor.close()
+
+
+# A page of the rows of a query, ordered by a unique field and starting
+# after the key the previous page ended with. Seeking to the key keeps pages
+# deep into a table as cheap as the first one, unlike OFFSET.
+def keyset_page(query, field, after=None, limit=1000):
+    if after is not None:
+        query = query.where(field > after)
+    return list(query.order_by(field).limit(limit).dicts())
+
+
+# All rows of a page function like Pokemon.get_active_page, one page after
+# the other. Only one page is held in memory at a time.
+def iter_pages(fetch, key, limit=1000, **kwargs):
+    after = None
+    while True:
+        rows = fetch(after=after, limit=limit, **kwargs)
+        for row in rows:
+            yield row
+        if len(rows) < limit:
+            return
+        after = rows[-1][key]
+
+
+# Convert map object locations for China, if needed.
+def transform_rows(rows):
+    for p in rows:
+        if args.china:
+            p['latitude'], p['longitude'] = \
+                transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
+        yield p
+
+
 class BaseModel(flaskDb.Model):
 
+    # Fields sent to the map, S2 cells are only used to look rows up.
+    @classmethod
+    def map_fields(cls):
+        return [f for f in cls._meta.sorted_fields if f.name != 's2cell']
+
     @classmethod
     def get_all(cls):
         results = [m for m in cls.select().dicts()]
@@ -89,6 +231,9 @@ class BaseModel(flaskDb.Model):
         return results
 
 
+# Pokemon sightings. Pokemon that haven't disappeared yet are written to
+# ActivePokemon and moved here once they disappear, the map's queries for
+# active Pokemon below read that table.
 class Pokemon(BaseModel):
     # We are base64 encoding the ids delivered by the api
     # because they are too big for sqlite to handle.
@@ -97,6 +242,7 @@ class Pokemon(BaseModel):
     pokemon_id = SmallIntegerField(index=True)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2cell = BigIntegerField(null=True, index=True)
     disappear_time = DateTimeField(index=True)
     individual_attack = SmallIntegerField(null=True)
     individual_defense = SmallIntegerField(null=True)
@@ -109,93 +255,116 @@ class Pokemon(BaseModel):
     last_modified = DateTimeField(
         null=True, index=True, default=datetime.utcnow)
 
-    class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
-
     @staticmethod
     def get_active(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                   oSwLng=None, oNeLat=None, oNeLng=None):
+                   oSwLng=None, oNeLat=None, oNeLng=None, enrich=True,
+                   stream=False):
         now_date = datetime.utcnow()
-        query = Pokemon.select()
-        if not (swLat and swLng and neLat and neLng):
+        query = ActivePokemon.select(*ActivePokemon.map_fields())
+        if pokemon_index.enabled:
+            query = Pokemon.query_index(swLat, swLng, neLat, neLng,
+                                        timestamp=timestamp, oSwLat=oSwLat,
+                                        oSwLng=oSwLng, oNeLat=oNeLat,
+                                        oNeLng=oNeLng)
+        elif not (swLat and swLng and neLat and neLng):
             query = (query
-                     .where(Pokemon.disappear_time > now_date)
+                     .where(ActivePokemon.disappear_time > now_date)
                      .dicts())
         elif timestamp > 0:
             # If timestamp is known only load modified Pokemon.
             query = (query
-                     .where(((Pokemon.last_modified >
+                     .where(((ActivePokemon.last_modified >
                               datetime.utcfromtimestamp(timestamp / 1000)) &
-                             (Pokemon.disappear_time > now_date)) &
-                            ((Pokemon.latitude >= swLat) &
-                             (Pokemon.longitude >= swLng) &
-                             (Pokemon.latitude <= neLat) &
-                             (Pokemon.longitude <= neLng)))
+                             (ActivePokemon.disappear_time > now_date)) &
+                            in_bounds(ActivePokemon, swLat, swLng, neLat,
+                                      neLng))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send Pokemon in view but exclude those within old boundaries.
             # Only send newly uncovered Pokemon.
             query = (query
-                     .where(((Pokemon.disappear_time > now_date) &
-                             (((Pokemon.latitude >= swLat) &
-                               (Pokemon.longitude >= swLng) &
-                               (Pokemon.latitude <= neLat) &
-                               (Pokemon.longitude <= neLng))) &
-                             ~((Pokemon.disappear_time > now_date) &
-                               (Pokemon.latitude >= oSwLat) &
-                               (Pokemon.longitude >= oSwLng) &
-                               (Pokemon.latitude <= oNeLat) &
-                               (Pokemon.longitude <= oNeLng))))
+                     .where(((ActivePokemon.disappear_time > now_date) &
+                             in_bounds(ActivePokemon, swLat, swLng, neLat,
+                                       neLng) &
+                             ~((ActivePokemon.disappear_time > now_date) &
+                               box(ActivePokemon, oSwLat, oSwLng, oNeLat,
+                                   oNeLng))))
                      .dicts())
         else:
-            query = (Pokemon
-                     .select()
+            query = (ActivePokemon
+                     .select(*ActivePokemon.map_fields())
                      # Add 1 hour buffer to include spawnpoints that persist
                      # after tth, like shsh.
-                     .where((Pokemon.disappear_time > now_date) &
-                            (((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))))
+                     .where((ActivePokemon.disappear_time > now_date) &
+                            in_bounds(ActivePokemon, swLat, swLng, neLat,
+                                      neLng))
                      .dicts())
 
+        if stream:
+            return Pokemon.prepare_rows(iter_rows(query), enrich)
+
         # Performance:  disable the garbage collector prior to creating a
         # (potentially) large dict with append().
         gc.disable()
 
-        pokemon = []
-        for p in list(query):
-
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokemon.append(p)
+        pokemon = list(Pokemon.prepare_rows(query, enrich))
 
         # Re-enable the GC.
         gc.enable()
 
         return pokemon
 
+    # Return the active Pokemon nearest to a location, as (row, distance in
+    # meters, compass direction) tuples, nearest first. Only Pokemon within
+    # radius meters are returned, at most limit of them.
     @staticmethod
-    def get_active_by_id(ids, swLat, swLng, neLat, neLng):
-        if not (swLat and swLng and neLat and neLng):
-            query = (Pokemon
-                     .select()
-                     .where((Pokemon.pokemon_id << ids) &
-                            (Pokemon.disappear_time > datetime.utcnow()))
+    def get_nearest(lat, lng, limit=None, radius=None):
+        if pokemon_index.enabled:
+            pokemon_index.ensure_loaded(Pokemon.get_active_rows)
+            rows = Pokemon.prepare_rows(
+                pokemon_index.nearest(lat, lng, limit, radius))
+            return nearest(rows, lat, lng, limit, radius)
+
+        # Without a radius, look in growing squares around the location
+        # until enough Pokemon are found, then fall back to all of them.
+        radii = [radius] if radius else []
+        if limit and not radius:
+            radii = NEAREST_SEARCH_RADII
+        for search_radius in radii:
+            rows = Pokemon.get_active(*radius_bounds(lat, lng, search_radius))
+            result = nearest(rows, lat, lng, limit, search_radius)
+            if radius or len(result) >= limit:
+                return result
+
+        return nearest(Pokemon.get_active(None, None, None, None), lat, lng,
+                       limit, radius)
+
+    # Add the fields the map needs to Pokemon rows.
+    @staticmethod
+    def prepare_rows(rows, enrich=True):
+        for p in transform_rows(rows):
+            if enrich:
+                add_pokemon_locale(p)
+            yield p
+
+    @staticmethod
+    def get_active_by_id(ids, swLat, swLng, neLat, neLng, enrich=True):
+        if pokemon_index.enabled:
+            query = Pokemon.query_index(swLat, swLng, neLat, neLng, ids=ids)
+        elif not (swLat and swLng and neLat and neLng):
+            query = (ActivePokemon
+                     .select(*ActivePokemon.map_fields())
+                     .where((ActivePokemon.pokemon_id << ids) &
+                            (ActivePokemon.disappear_time > datetime.utcnow()))
                      .dicts())
         else:
-            query = (Pokemon
-                     .select()
-                     .where((Pokemon.pokemon_id << ids) &
-                            (Pokemon.disappear_time > datetime.utcnow()) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.latitude <= neLat) &
-                            (Pokemon.longitude <= neLng))
+            query = (ActivePokemon
+                     .select(*ActivePokemon.map_fields())
+                     .where((ActivePokemon.pokemon_id << ids) &
+                            (ActivePokemon.disappear_time >
+                             datetime.utcnow()) &
+                            in_bounds(ActivePokemon, swLat, swLng, neLat,
+                                      neLng))
                      .dicts())
 
         # Performance:  disable the garbage collector prior to creating a
@@ -204,9 +373,8 @@ class Pokemon(BaseModel):
 
         pokemon = []
         for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
+            if enrich:
+                add_pokemon_locale(p)
             if args.china:
                 p['latitude'], p['longitude'] = \
                     transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
@@ -217,50 +385,151 @@ class Pokemon(BaseModel):
 
         return pokemon
 
-    @classmethod
-    @cached(cache)
-    def get_seen(cls, timediff):
-        if timediff:
-            timediff = datetime.utcnow() - timediff
-        pokemon_count_query = (Pokemon
-                               .select(Pokemon.pokemon_id,
-                                       fn.COUNT(Pokemon.pokemon_id).alias(
-                                           'count'),
-                                       fn.MAX(Pokemon.disappear_time).alias(
-                                           'lastappeared')
-                                       )
-                               .where(Pokemon.disappear_time > timediff)
-                               .group_by(Pokemon.pokemon_id)
-                               .alias('counttable')
-                               )
-        query = (Pokemon
-                 .select(Pokemon.pokemon_id,
-                         Pokemon.disappear_time,
-                         Pokemon.latitude,
-                         Pokemon.longitude,
-                         pokemon_count_query.c.count)
-                 .join(pokemon_count_query,
-                       on=(Pokemon.pokemon_id ==
-                           pokemon_count_query.c.pokemon_id))
-                 .distinct()
-                 .where(Pokemon.disappear_time ==
-                        pokemon_count_query.c.lastappeared)
-                 .dicts()
-                 )
+    # Same arguments as get_active, but answered from the in-memory index.
+    # The database is only hit to fill the index on a cold start.
+    @staticmethod
+    def query_index(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
+                    oSwLng=None, oNeLat=None, oNeLng=None, ids=None):
+        pokemon_index.ensure_loaded(Pokemon.get_active_rows)
 
-        # Performance:  disable the garbage collector prior to creating a
-        # (potentially) large dict with append().
-        gc.disable()
+        if not (swLat and swLng and neLat and neLng):
+            return pokemon_index.query(ids=ids)
+
+        since = None
+        exclude = None
+        if timestamp > 0:
+            since = datetime.utcfromtimestamp(timestamp / 1000)
+        elif oSwLat and oSwLng and oNeLat and oNeLng:
+            exclude = (oSwLat, oSwLng, oNeLat, oNeLng)
+
+        return pokemon_index.query(swLat, swLng, neLat, neLng, since=since,
+                                   exclude=exclude, ids=ids)
+
+    @staticmethod
+    def get_active_by_encounter_id(encounter_ids, enrich=True):
+        if pokemon_index.enabled:
+            pokemon_index.ensure_loaded(Pokemon.get_active_rows)
+            query = pokemon_index.get(encounter_ids)
+        else:
+            query = []
+            for ids in chunks(encounter_ids):
+                query += list(ActivePokemon
+                              .select(*ActivePokemon.map_fields())
+                              .where((ActivePokemon.encounter_id << ids) &
+                                     (ActivePokemon.disappear_time >
+                                      datetime.utcnow()))
+                              .dicts())
 
         pokemon = []
-        total = 0
         for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+            if enrich:
+                add_pokemon_locale(p)
+            if args.china:
+                p['latitude'], p['longitude'] = \
+                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
             pokemon.append(p)
-            total += p['count']
 
-        # Re-enable the GC.
-        gc.enable()
+        return pokemon
+
+    # A page of all active Pokemon, by encounter id, for clients that don't
+    # look at a viewport.
+    @staticmethod
+    def get_active_page(after=None, limit=1000, enrich=True):
+        query = (ActivePokemon
+                 .select(*ActivePokemon.map_fields())
+                 .where(ActivePokemon.disappear_time > datetime.utcnow()))
+        rows = keyset_page(query, ActivePokemon.encounter_id, after, limit)
+        return list(Pokemon.prepare_rows(rows, enrich))
+
+    # Raw rows of all active Pokemon, used to fill the in-memory index.
+    @staticmethod
+    def get_active_rows(modified_since=None):
+        query = (ActivePokemon
+                 .select(*ActivePokemon.map_fields())
+                 .where(ActivePokemon.disappear_time > datetime.utcnow()))
+        if modified_since:
+            query = query.where(ActivePokemon.last_modified > modified_since)
+
+        return list(query.dicts())
+
+    @classmethod
+    @cached(cache)
+    def get_seen(cls, timediff):
+        # Whole hours are summed from the rollup, the hour the window starts
+        # in is counted from the Pokemon table.
+        cutoff, start = stats_window(timediff, PokemonHourlyCount.bucket_size)
+        seen = {}
+        if cutoff:
+            # Pokemon that just disappeared may not be moved yet.
+            rows = itertools.chain.from_iterable(
+                model.select(model.pokemon_id, model.disappear_time,
+                             model.latitude, model.longitude)
+                .where((model.disappear_time > cutoff) &
+                       (model.disappear_time < start))
+                .dicts()
+                for model in (Pokemon, ActivePokemon))
+            for p in rollup_sightings(PokemonHourlyCount, rows).values():
+                merge_sightings(seen, p['pokemon_id'], p)
+
+        if start:
+            # The hours of the window are few enough to merge here, which
+            # keeps the query on the hour index.
+            query = (PokemonHourlyCount
+                     .select(PokemonHourlyCount.pokemon_id,
+                             PokemonHourlyCount.count,
+                             PokemonHourlyCount.last_seen,
+                             PokemonHourlyCount.latitude,
+                             PokemonHourlyCount.longitude)
+                     .where(PokemonHourlyCount.hour >= start)
+                     .dicts())
+            for p in query:
+                merge_sightings(seen, p['pokemon_id'], p)
+            totals = []
+        else:
+            totals = list(PokemonHourlyCount
+                          .select(PokemonHourlyCount.pokemon_id,
+                                  fn.SUM(PokemonHourlyCount.count).alias(
+                                      'count'),
+                                  fn.MAX(PokemonHourlyCount.last_seen).alias(
+                                      'last_seen'))
+                          .group_by(PokemonHourlyCount.pokemon_id)
+                          .dicts())
+
+        # The last sighting is in the hour it falls in, look up its location
+        # there.
+        last_hours = {}
+        for p in totals:
+            hour = bucket_start(p['last_seen'],
+                                PokemonHourlyCount.bucket_size)
+            last_hours.setdefault(hour, []).append(p['pokemon_id'])
+        locations = {}
+        for hour, pokemon_ids in last_hours.iteritems():
+            for ids in chunks(pokemon_ids):
+                query = (PokemonHourlyCount
+                         .select(PokemonHourlyCount.pokemon_id,
+                                 PokemonHourlyCount.latitude,
+                                 PokemonHourlyCount.longitude)
+                         .where((PokemonHourlyCount.hour == hour) &
+                                (PokemonHourlyCount.pokemon_id << ids))
+                         .dicts())
+                for p in query:
+                    locations[p['pokemon_id']] = p
+        for p in totals:
+            p.update(locations.get(p['pokemon_id'],
+                                   {'latitude': None, 'longitude': None}))
+            merge_sightings(seen, p['pokemon_id'], p)
+
+        pokemon = []
+        total = 0
+        for p in seen.itervalues():
+            pokemon.append({
+                'pokemon_id': p['pokemon_id'],
+                'pokemon_name': get_pokemon_name(p['pokemon_id']),
+                'count': int(p['count']),
+                'disappear_time': p['last_seen'],
+                'latitude': p['latitude'],
+                'longitude': p['longitude']})
+            total += int(p['count'])
 
         return {'pokemon': pokemon, 'total': total}
 
@@ -271,22 +540,43 @@ class Pokemon(BaseModel):
         :param timediff: limiting period of the selection
         :return: list of Pokemon appearances over a selected period
         '''
-        if timediff:
-            timediff = datetime.utcnow() - timediff
-        query = (Pokemon
-                 .select(Pokemon.latitude, Pokemon.longitude,
-                         Pokemon.pokemon_id,
-                         fn.Count(Pokemon.spawnpoint_id).alias('count'),
-                         Pokemon.spawnpoint_id)
-                 .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
-                 .group_by(Pokemon.latitude, Pokemon.longitude,
-                           Pokemon.pokemon_id, Pokemon.spawnpoint_id)
-                 .dicts()
-                 )
+        cutoff, start = stats_window(timediff,
+                                     SpawnpointDailyCount.bucket_size)
+        appearances = {}
+        if cutoff:
+            rows = itertools.chain.from_iterable(
+                model.select(model.pokemon_id, model.spawnpoint_id,
+                             model.disappear_time, model.latitude,
+                             model.longitude)
+                .where((model.pokemon_id == pokemon_id) &
+                       (model.disappear_time > cutoff) &
+                       (model.disappear_time < start))
+                .dicts()
+                for model in (Pokemon, ActivePokemon))
+            for p in rollup_sightings(SpawnpointDailyCount, rows).values():
+                merge_sightings(appearances, p['spawnpoint_id'], p)
+
+        query = (SpawnpointDailyCount
+                 .select(SpawnpointDailyCount.spawnpoint_id,
+                         SpawnpointDailyCount.latitude,
+                         SpawnpointDailyCount.longitude,
+                         fn.SUM(SpawnpointDailyCount.count).alias('count'))
+                 .where(SpawnpointDailyCount.pokemon_id == pokemon_id)
+                 .group_by(SpawnpointDailyCount.spawnpoint_id,
+                           SpawnpointDailyCount.latitude,
+                           SpawnpointDailyCount.longitude)
+                 .dicts())
+        if start:
+            query = query.where(SpawnpointDailyCount.day >= start)
+        for p in query:
+            merge_sightings(appearances, p['spawnpoint_id'], p)
 
-        return list(query)
+        return [{'pokemon_id': int(pokemon_id),
+                 'spawnpoint_id': p['spawnpoint_id'],
+                 'latitude': p['latitude'],
+                 'longitude': p['longitude'],
+                 'count': int(p['count'])}
+                for p in appearances.itervalues()]
 
     @classmethod
     def get_appearances_times_by_spawnpoint(cls, pokemon_id,
@@ -299,17 +589,19 @@ class Pokemon(BaseModel):
         '''
         if timediff:
             timediff = datetime.utcnow() - timediff
-        query = (Pokemon
-                 .select(Pokemon.disappear_time)
-                 .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.spawnpoint_id == spawnpoint_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
-                 .order_by(Pokemon.disappear_time.asc())
-                 .tuples()
-                 )
-
-        return list(itertools.chain(*query))
+        times = []
+        for model in (Pokemon, ActivePokemon):
+            query = (model
+                     .select(model.disappear_time)
+                     .where((model.pokemon_id == pokemon_id) &
+                            (model.spawnpoint_id == spawnpoint_id) &
+                            (model.disappear_time > timediff)
+                            )
+                     .tuples()
+                     )
+            times.extend(itertools.chain(*query))
+
+        return sorted(times)
 
     @classmethod
     def get_spawn_time(cls, disappear_time):
@@ -317,45 +609,41 @@ class Pokemon(BaseModel):
 
     @classmethod
     def get_spawnpoints(cls, swLat, swLng, neLat, neLng, timestamp=0,
-                        oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
-        query = (Pokemon
-                 .select(Pokemon.latitude, Pokemon.longitude,
-                         Pokemon.spawnpoint_id,
-                         (date_secs(Pokemon.disappear_time)).alias('time'),
-                         fn.Count(Pokemon.spawnpoint_id).alias('count')))
+                        oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None,
+                        stream=False):
+        # Sightings are counted per time as they're written.
+        query = (SpawnpointTimeCount
+                 .select(SpawnpointTimeCount.latitude,
+                         SpawnpointTimeCount.longitude,
+                         SpawnpointTimeCount.spawnpoint_id,
+                         SpawnpointTimeCount.time,
+                         SpawnpointTimeCount.count))
 
         if timestamp > 0:
-            query = (query
-                     .where(((Pokemon.last_modified >
-                              datetime.utcfromtimestamp(timestamp / 1000))) &
-                            ((Pokemon.latitude >= swLat) &
-                             (Pokemon.longitude >= swLng) &
-                             (Pokemon.latitude <= neLat) &
-                             (Pokemon.longitude <= neLng)))
-                     .dicts())
+            # All times of the spawnpoints seen since, so their most common
+            # time is right.
+            seen = (SpawnpointTimeCount
+                    .select(SpawnpointTimeCount.spawnpoint_id)
+                    .where((SpawnpointTimeCount.last_seen >
+                            datetime.utcfromtimestamp(timestamp / 1000)) &
+                           in_bounds(SpawnpointTimeCount, swLat, swLng,
+                                     neLat, neLng)))
+            query = query.where(SpawnpointTimeCount.spawnpoint_id << seen)
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send spawnpoints in view but exclude those within old boundaries.
             # Only send newly uncovered spawnpoints.
-            query = (query
-                     .where((((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))) &
-                            ~((Pokemon.latitude >= oSwLat) &
-                              (Pokemon.longitude >= oSwLng) &
-                              (Pokemon.latitude <= oNeLat) &
-                              (Pokemon.longitude <= oNeLng)))
-                     .dicts())
+            query = query.where(
+                in_bounds(SpawnpointTimeCount, swLat, swLng, neLat, neLng) &
+                ~box(SpawnpointTimeCount, oSwLat, oSwLng, oNeLat, oNeLng))
         elif swLat and swLng and neLat and neLng:
-            query = (query
-                     .where((Pokemon.latitude <= neLat) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.longitude <= neLng)
-                            ))
+            query = query.where(in_bounds(SpawnpointTimeCount, swLat, swLng,
+                                          neLat, neLng))
 
-        query = query.group_by(Pokemon.latitude, Pokemon.longitude,
-                               Pokemon.spawnpoint_id, SQL('time'))
+        if stream:
+            # Rows of a spawnpoint come in together, so each spawnpoint can
+            # be sent as soon as the next one starts.
+            query = query.order_by(SpawnpointTimeCount.spawnpoint_id)
+            return cls.merge_spawnpoints(iter_rows(query.dicts()))
 
         queryDict = query.dicts()
         spawnpoints = {}
@@ -380,30 +668,57 @@ class Pokemon(BaseModel):
 
         return list(spawnpoints.values())
 
+    # Same as the merging in get_spawnpoints, for rows sorted by spawnpoint.
+    @classmethod
+    def merge_spawnpoints(cls, rows):
+        current = None
+        for sp in rows:
+            disappear_time = cls.get_spawn_time(sp.pop('time'))
+            count = int(sp['count'])
+
+            if current is None or sp['spawnpoint_id'] != current[
+                    'spawnpoint_id']:
+                if current is not None:
+                    del current['count']
+                    yield current
+                current = sp
+                current['time'] = disappear_time
+                current['count'] = count
+                continue
+
+            current['special'] = True
+            if count >= current['count']:
+                current['time'] = disappear_time
+                current['count'] = count
+
+        if current is not None:
+            del current['count']
+            yield current
+
     @classmethod
     def get_spawnpoints_in_hex(cls, center, steps):
         log.info('Finding spawnpoints {} steps away.'.format(steps))
 
         n, e, s, w = hex_bounds(center, steps)
 
-        query = (Pokemon
-                 .select(Pokemon.latitude.alias('lat'),
-                         Pokemon.longitude.alias('lng'),
-                         (date_secs(Pokemon.disappear_time)).alias('time'),
-                         Pokemon.spawnpoint_id
-                         ))
-        query = (query.where((Pokemon.latitude <= n) &
-                             (Pokemon.latitude >= s) &
-                             (Pokemon.longitude >= w) &
-                             (Pokemon.longitude <= e)
-                             ))
-        # Sqlite doesn't support distinct on columns.
-        if args.db_type == 'mysql':
-            query = query.distinct(Pokemon.spawnpoint_id)
-        else:
-            query = query.group_by(Pokemon.spawnpoint_id)
-
-        s = list(query.dicts())
+        # The spawnpoints come from the time rollup rather than the
+        # sightings, with the time they were seen at most.
+        query = (SpawnpointTimeCount
+                 .select(SpawnpointTimeCount.latitude.alias('lat'),
+                         SpawnpointTimeCount.longitude.alias('lng'),
+                         SpawnpointTimeCount.time,
+                         SpawnpointTimeCount.spawnpoint_id,
+                         SpawnpointTimeCount.count)
+                 .where(in_bounds(SpawnpointTimeCount, s, w, n, e))
+                 .dicts())
+        spawnpoints = {}
+        for sp in query:
+            known = spawnpoints.get(sp['spawnpoint_id'])
+            if known is None or sp['count'] > known['count']:
+                spawnpoints[sp['spawnpoint_id']] = sp
+        s = spawnpoints.values()
+        for sp in s:
+            del sp['count']
 
         # The distance between scan circles of radius 70 in a hex is 121.2436
         # steps - 1 to account for the center circle then add 70 for the edge.
@@ -428,23 +743,112 @@ class Pokemon(BaseModel):
         return filtered
 
 
+# The Pokemon that haven't disappeared yet, in a small table of their own
+# with only the indexes the map and the scanner need. It takes the writes
+# of the scanner, pokemon_history_loop moves the Pokemon to the history
+# in batches once they've disappeared.
+class ActivePokemon(Pokemon):
+    spawnpoint_id = CharField()
+    pokemon_id = SmallIntegerField()
+
+    class Meta:
+        indexes = ((('latitude', 'longitude'), False),)
+
+
+# Pokemon sightings counted per Pokemon and hour, kept up to date by
+# db_updater so /stats doesn't have to scan the Pokemon table. The last
+# sighting of the hour is kept with its location.
+class PokemonHourlyCount(BaseModel):
+    pokemon_id = SmallIntegerField()
+    hour = DateTimeField(index=True)
+    count = IntegerField(default=0)
+    last_seen = DateTimeField()
+    latitude = DoubleField()
+    longitude = DoubleField()
+
+    bucket_size = 3600
+    key_fields = ('pokemon_id', 'hour')
+
+    class Meta:
+        primary_key = CompositeKey('pokemon_id', 'hour')
+
+    @classmethod
+    def bucket(cls, dt):
+        return bucket_start(dt, cls.bucket_size)
+
+
+# Pokemon sightings counted per spawnpoint, Pokemon and day, for the
+# appearances on the stats page.
+class SpawnpointDailyCount(BaseModel):
+    spawnpoint_id = CharField(max_length=50)
+    pokemon_id = SmallIntegerField()
+    day = DateTimeField()
+    count = IntegerField(default=0)
+    last_seen = DateTimeField()
+    latitude = DoubleField()
+    longitude = DoubleField()
+
+    bucket_size = 86400
+    key_fields = ('spawnpoint_id', 'pokemon_id', 'day')
+
+    class Meta:
+        primary_key = CompositeKey('spawnpoint_id', 'pokemon_id', 'day')
+        indexes = ((('pokemon_id', 'day'), False),)
+
+    @classmethod
+    def bucket(cls, dt):
+        return bucket_start(dt, cls.bucket_size)
+
+
+# Pokemon sightings counted per spawnpoint and the second of the hour they
+# disappeared at, for the spawnpoint map layer. It shows each spawnpoint
+# with its most common time, without going through the sightings.
+class SpawnpointTimeCount(BaseModel):
+    spawnpoint_id = CharField(max_length=50)
+    time = SmallIntegerField()
+    count = IntegerField(default=0)
+    last_seen = DateTimeField(index=True)
+    latitude = DoubleField()
+    longitude = DoubleField()
+    s2cell = BigIntegerField(null=True, index=True)
+
+    key_fields = ('spawnpoint_id', 'time')
+
+    class Meta:
+        primary_key = CompositeKey('spawnpoint_id', 'time')
+
+    @classmethod
+    def bucket(cls, dt):
+        return date_secs(dt)
+
+
 class Pokestop(BaseModel):
     pokestop_id = CharField(primary_key=True, max_length=50)
     enabled = BooleanField()
     latitude = DoubleField()
     longitude = DoubleField()
+    s2cell = BigIntegerField(null=True, index=True)
     last_modified = DateTimeField(index=True)
     lure_expiration = DateTimeField(null=True, index=True)
-    active_fort_modifier = CharField(max_length=50, null=True, index=True)
+    active_fort_modifier = CharField(max_length=50, null=True)
     last_updated = DateTimeField(
         null=True, index=True, default=datetime.utcnow)
 
     class Meta:
         indexes = ((('latitude', 'longitude'), False),)
 
+    # Expression matching the pokestops with an active lure. Lured stops are
+    # looked up by the lure expiration index only, so the cost goes with
+    # the number of lures rather than stops, and the viewport is checked on
+    # those rows.
+    @staticmethod
+    def lured():
+        return Pokestop.lure_expiration > datetime.utcnow()
+
     @staticmethod
     def get_stops(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                  oSwLng=None, oNeLat=None, oNeLng=None, lured=False):
+                  oSwLng=None, oNeLat=None, oNeLng=None, lured=False,
+                  stream=False):
 
         query = Pokestop.select(Pokestop.active_fort_modifier,
                                 Pokestop.enabled, Pokestop.latitude,
@@ -458,72 +862,80 @@ class Pokestop(BaseModel):
             query = (query
                      .where(((Pokestop.last_updated >
                               datetime.utcfromtimestamp(timestamp / 1000))) &
-                            (Pokestop.latitude >= swLat) &
-                            (Pokestop.longitude >= swLng) &
-                            (Pokestop.latitude <= neLat) &
-                            (Pokestop.longitude <= neLng))
+                            in_bounds(Pokestop, swLat, swLng, neLat, neLng))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng and lured:
             query = (query
-                     .where((((Pokestop.latitude >= swLat) &
-                              (Pokestop.longitude >= swLng) &
-                              (Pokestop.latitude <= neLat) &
-                              (Pokestop.longitude <= neLng)) &
-                             (Pokestop.active_fort_modifier.is_null(False))) &
-                            ~((Pokestop.latitude >= oSwLat) &
-                              (Pokestop.longitude >= oSwLng) &
-                              (Pokestop.latitude <= oNeLat) &
-                              (Pokestop.longitude <= oNeLng)) &
-                             (Pokestop.active_fort_modifier.is_null(False)))
+                     .where(Pokestop.lured() &
+                            box(Pokestop, swLat, swLng, neLat, neLng) &
+                            ~box(Pokestop, oSwLat, oSwLng, oNeLat, oNeLng))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send stops in view but exclude those within old boundaries. Only
             # send newly uncovered stops.
             query = (query
-                     .where(((Pokestop.latitude >= swLat) &
-                             (Pokestop.longitude >= swLng) &
-                             (Pokestop.latitude <= neLat) &
-                             (Pokestop.longitude <= neLng)) &
-                            ~((Pokestop.latitude >= oSwLat) &
-                              (Pokestop.longitude >= oSwLng) &
-                              (Pokestop.latitude <= oNeLat) &
-                              (Pokestop.longitude <= oNeLng)))
+                     .where(in_bounds(Pokestop, swLat, swLng, neLat, neLng) &
+                            ~box(Pokestop, oSwLat, oSwLng, oNeLat, oNeLng))
                      .dicts())
         elif lured:
             query = (query
-                     .where(((Pokestop.last_updated >
-                              datetime.utcfromtimestamp(timestamp / 1000))) &
-                            ((Pokestop.latitude >= swLat) &
-                             (Pokestop.longitude >= swLng) &
-                             (Pokestop.latitude <= neLat) &
-                             (Pokestop.longitude <= neLng)) &
-                            (Pokestop.active_fort_modifier.is_null(False)))
+                     .where(Pokestop.lured() &
+                            box(Pokestop, swLat, swLng, neLat, neLng))
                      .dicts())
 
         else:
             query = (query
-                     .where((Pokestop.latitude >= swLat) &
-                            (Pokestop.longitude >= swLng) &
-                            (Pokestop.latitude <= neLat) &
-                            (Pokestop.longitude <= neLng))
+                     .where(in_bounds(Pokestop, swLat, swLng, neLat, neLng))
                      .dicts())
 
+        if stream:
+            return transform_rows(iter_rows(query))
+
         # Performance:  disable the garbage collector prior to creating a
         # (potentially) large dict with append().
         gc.disable()
 
-        pokestops = []
-        for p in query:
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokestops.append(p)
+        pokestops = list(transform_rows(query))
 
         # Re-enable the GC.
         gc.enable()
 
         return pokestops
 
+    # A page of all pokestops, by pokestop id.
+    @staticmethod
+    def get_stops_page(after=None, limit=1000):
+        query = Pokestop.select(Pokestop.active_fort_modifier,
+                                Pokestop.enabled, Pokestop.latitude,
+                                Pokestop.longitude, Pokestop.last_modified,
+                                Pokestop.lure_expiration, Pokestop.pokestop_id)
+        rows = keyset_page(query, Pokestop.pokestop_id, after, limit)
+        return list(transform_rows(rows))
+
+    @staticmethod
+    def get_stops_by_id(pokestop_ids, lured=False):
+        pokestops = []
+        for ids in chunks(pokestop_ids):
+            condition = Pokestop.pokestop_id << ids
+            if lured:
+                condition &= Pokestop.lured()
+            query = (Pokestop
+                     .select(Pokestop.active_fort_modifier,
+                             Pokestop.enabled, Pokestop.latitude,
+                             Pokestop.longitude, Pokestop.last_modified,
+                             Pokestop.lure_expiration, Pokestop.pokestop_id)
+                     .where(condition)
+                     .dicts())
+
+            for p in query:
+                if args.china:
+                    p['latitude'], p['longitude'] = \
+                        transform_from_wgs_to_gcj(p['latitude'],
+                                                  p['longitude'])
+                pokestops.append(p)
+
+        return pokestops
+
 
 class Gym(BaseModel):
     UNCONTESTED = 0
@@ -538,6 +950,7 @@ class Gym(BaseModel):
     enabled = BooleanField()
     latitude = DoubleField()
     longitude = DoubleField()
+    s2cell = BigIntegerField(null=True, index=True)
     last_modified = DateTimeField(index=True)
     last_scanned = DateTimeField(default=datetime.utcnow, index=True)
 
@@ -546,44 +959,38 @@ class Gym(BaseModel):
 
     @staticmethod
     def get_gyms(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                 oSwLng=None, oNeLat=None, oNeLng=None):
-        if not (swLat and swLng and neLat and neLng):
+                 oSwLng=None, oNeLat=None, oNeLng=None, ids=None,
+                 enrich=True):
+        if ids is not None:
+            results = (Gym
+                       .select(*Gym.map_fields())
+                       .where(Gym.gym_id << ids)
+                       .dicts())
+        elif not (swLat and swLng and neLat and neLng):
             results = (Gym
-                       .select()
+                       .select(*Gym.map_fields())
                        .dicts())
         elif timestamp > 0:
             # If timestamp is known only send last scanned Gyms.
             results = (Gym
-                       .select()
+                       .select(*Gym.map_fields())
                        .where(((Gym.last_scanned >
                                 datetime.utcfromtimestamp(timestamp / 1000)) &
-                               (Gym.latitude >= swLat) &
-                               (Gym.longitude >= swLng) &
-                               (Gym.latitude <= neLat) &
-                               (Gym.longitude <= neLng)))
+                               in_bounds(Gym, swLat, swLng, neLat, neLng)))
                        .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send gyms in view but exclude those within old boundaries. Only
             # send newly uncovered gyms.
             results = (Gym
-                       .select()
-                       .where(((Gym.latitude >= swLat) &
-                               (Gym.longitude >= swLng) &
-                               (Gym.latitude <= neLat) &
-                               (Gym.longitude <= neLng)) &
-                              ~((Gym.latitude >= oSwLat) &
-                                (Gym.longitude >= oSwLng) &
-                                (Gym.latitude <= oNeLat) &
-                                (Gym.longitude <= oNeLng)))
+                       .select(*Gym.map_fields())
+                       .where(in_bounds(Gym, swLat, swLng, neLat, neLng) &
+                              ~box(Gym, oSwLat, oSwLng, oNeLat, oNeLng))
                        .dicts())
 
         else:
             results = (Gym
-                       .select()
-                       .where((Gym.latitude >= swLat) &
-                              (Gym.longitude >= swLng) &
-                              (Gym.latitude <= neLat) &
-                              (Gym.longitude <= neLng))
+                       .select(*Gym.map_fields())
+                       .where(in_bounds(Gym, swLat, swLng, neLat, neLng))
                        .dicts())
 
         # Performance:  disable the garbage collector prior to creating a
@@ -618,7 +1025,8 @@ class Gym(BaseModel):
                        .dicts())
 
             for p in pokemon:
-                p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+                if enrich:
+                    p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
                 gyms[p['gym_id']]['pokemon'].append(p)
 
             details = (GymDetails
@@ -636,72 +1044,127 @@ class Gym(BaseModel):
 
         return gyms
 
+    # A page of all gyms, by gym id.
+    @staticmethod
+    def get_gyms_page(after=None, limit=1000, enrich=True):
+        ids = [g['gym_id'] for g in keyset_page(Gym.select(Gym.gym_id),
+                                                Gym.gym_id, after, limit)]
+        gyms = Gym.get_gyms_by_id(ids, enrich=enrich)
+        return [gyms[gym_id] for gym_id in ids if gym_id in gyms]
+
+    @staticmethod
+    def get_gyms_by_id(gym_ids, enrich=True):
+        gyms = {}
+        for ids in chunks(gym_ids):
+            gyms.update(Gym.get_gyms(None, None, None, None, ids=ids,
+                                     enrich=enrich))
+
+        return gyms
+
     @staticmethod
     def get_gym(id):
-        result = (Gym
-                  .select(Gym.gym_id,
-                          Gym.team_id,
-                          GymDetails.name,
-                          GymDetails.description,
-                          Gym.guard_pokemon_id,
-                          Gym.gym_points,
-                          Gym.latitude,
-                          Gym.longitude,
-                          Gym.last_modified,
-                          Gym.last_scanned)
-                  .join(GymDetails, JOIN.LEFT_OUTER,
-                        on=(Gym.gym_id == GymDetails.gym_id))
-                  .where(Gym.gym_id == id)
-                  .dicts()
-                  .get())
-
-        result['guard_pokemon_name'] = get_pokemon_name(
-            result['guard_pokemon_id']) if result['guard_pokemon_id'] else ''
-        result['pokemon'] = []
-
-        pokemon = (GymMember
-                   .select(GymPokemon.cp.alias('pokemon_cp'),
-                           GymPokemon.pokemon_id,
-                           GymPokemon.pokemon_uid,
-                           GymPokemon.move_1,
-                           GymPokemon.move_2,
-                           GymPokemon.iv_attack,
-                           GymPokemon.iv_defense,
-                           GymPokemon.iv_stamina,
-                           Trainer.name.alias('trainer_name'),
-                           Trainer.level.alias('trainer_level'))
-                   .join(Gym, on=(GymMember.gym_id == Gym.gym_id))
-                   .join(GymPokemon,
-                         on=(GymMember.pokemon_uid == GymPokemon.pokemon_uid))
-                   .join(Trainer, on=(GymPokemon.trainer_name == Trainer.name))
-                   .where(GymMember.gym_id == id)
-                   .where(GymMember.last_scanned > Gym.last_modified)
-                   .order_by(GymPokemon.cp.desc())
-                   .distinct()
-                   .dicts())
-
-        for p in pokemon:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-
-            p['move_1_name'] = get_move_name(p['move_1'])
-            p['move_1_damage'] = get_move_damage(p['move_1'])
-            p['move_1_energy'] = get_move_energy(p['move_1'])
-            p['move_1_type'] = get_move_type(p['move_1'])
-
-            p['move_2_name'] = get_move_name(p['move_2'])
-            p['move_2_damage'] = get_move_damage(p['move_2'])
-            p['move_2_energy'] = get_move_energy(p['move_2'])
-            p['move_2_type'] = get_move_type(p['move_2'])
-
-            result['pokemon'].append(p)
+        gym = Gym.get_gym_details([id]).get(id)
+        if gym is None:
+            raise Gym.DoesNotExist('Gym {} does not exist.'.format(id))
 
-        return result
+        return gym
+
+    # Return the details of gyms and their defenders, by gym id, for the
+    # gyms with these ids or in a viewport. Details are served from the gym
+    # cache, the ones that aren't cached yet are read in two queries.
+    @staticmethod
+    def get_gym_details(ids=None, swLat=None, swLng=None, neLat=None,
+                        neLng=None):
+        if ids is None:
+            ids = [g['gym_id'] for g in (Gym
+                                         .select(Gym.gym_id)
+                                         .where(in_bounds(Gym, swLat, swLng,
+                                                          neLat, neLng))
+                                         .dicts())]
+
+        gyms, generation = gym_cache.get(ids)
+        missing = [gym_id for gym_id in ids if gym_id not in gyms]
+        if not missing:
+            return gyms
+
+        details = {}
+        for part in chunks(missing):
+            query = (Gym
+                     .select(Gym.gym_id,
+                             Gym.team_id,
+                             GymDetails.name,
+                             GymDetails.description,
+                             Gym.guard_pokemon_id,
+                             Gym.gym_points,
+                             Gym.latitude,
+                             Gym.longitude,
+                             Gym.last_modified,
+                             Gym.last_scanned)
+                     .join(GymDetails, JOIN.LEFT_OUTER,
+                           on=(Gym.gym_id == GymDetails.gym_id))
+                     .where(Gym.gym_id << part)
+                     .dicts())
+            for g in query:
+                g['guard_pokemon_name'] = get_pokemon_name(
+                    g['guard_pokemon_id']) if g['guard_pokemon_id'] else ''
+                g['pokemon'] = []
+                details[g['gym_id']] = g
+
+        for part in chunks(details.keys()):
+            pokemon = (GymMember
+                       .select(GymMember.gym_id,
+                               GymPokemon.cp.alias('pokemon_cp'),
+                               GymPokemon.pokemon_id,
+                               GymPokemon.pokemon_uid,
+                               GymPokemon.move_1,
+                               GymPokemon.move_2,
+                               GymPokemon.iv_attack,
+                               GymPokemon.iv_defense,
+                               GymPokemon.iv_stamina,
+                               Trainer.name.alias('trainer_name'),
+                               Trainer.level.alias('trainer_level'))
+                       .join(Gym, on=(GymMember.gym_id == Gym.gym_id))
+                       .join(GymPokemon, on=(GymMember.pokemon_uid ==
+                                             GymPokemon.pokemon_uid))
+                       .join(Trainer,
+                             on=(GymPokemon.trainer_name == Trainer.name))
+                       .where(GymMember.gym_id << part)
+                       .where(GymMember.last_scanned > Gym.last_modified)
+                       .order_by(GymPokemon.cp.desc())
+                       .distinct()
+                       .dicts())
+
+            for p in pokemon:
+                gym_id = p.pop('gym_id')
+                details[gym_id]['pokemon'].append(Gym.add_member_locale(p))
+
+        gym_cache.fill(details, generation)
+        gyms.update(details)
+        return gyms
+
+    # Add Pokemon and move names and stats to a gym defender.
+    @staticmethod
+    def add_member_locale(p):
+        p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+
+        p['move_1_name'] = get_move_name(p['move_1'])
+        p['move_1_damage'] = get_move_damage(p['move_1'])
+        p['move_1_energy'] = get_move_energy(p['move_1'])
+        p['move_1_type'] = get_move_type(p['move_1'])
+
+        p['move_2_name'] = get_move_name(p['move_2'])
+        p['move_2_damage'] = get_move_damage(p['move_2'])
+        p['move_2_energy'] = get_move_energy(p['move_2'])
+        p['move_2_type'] = get_move_type(p['move_2'])
+
+        return p
 
 
 class LocationAltitude(BaseModel):
     cellid = CharField(primary_key=True, max_length=50)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2cell = BigIntegerField(null=True, index=True)
     last_modified = DateTimeField(index=True, default=datetime.utcnow,
                                   null=True)
     altitude = DoubleField()
@@ -715,6 +1178,7 @@ class LocationAltitude(BaseModel):
         return {'cellid': cellid(loc),
                 'latitude': loc[0],
                 'longitude': loc[1],
+                's2cell': s2_leaf(loc[0], loc[1]),
                 'altitude': altitude}
 
     # find a nearby altitude from the db
@@ -726,10 +1190,7 @@ class LocationAltitude(BaseModel):
         # Get all location altitudes in that box.
         query = (cls
                  .select()
-                 .where((cls.latitude <= n) &
-                        (cls.latitude >= s) &
-                        (cls.longitude >= w) &
-                        (cls.longitude <= e))
+                 .where(in_bounds(cls, s, w, n, e))
                  .dicts())
 
         altitude = None
@@ -747,6 +1208,7 @@ class ScannedLocation(BaseModel):
     cellid = CharField(primary_key=True, max_length=50)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2cell = BigIntegerField(null=True, index=True)
     last_modified = DateTimeField(
         index=True, default=datetime.utcnow, null=True)
     # Marked true when all five bands have been completed.
@@ -786,53 +1248,58 @@ class ScannedLocation(BaseModel):
 
     @staticmethod
     def get_recent(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                   oSwLng=None, oNeLat=None, oNeLng=None):
+                   oSwLng=None, oNeLat=None, oNeLng=None, stream=False):
         activeTime = (datetime.utcnow() - timedelta(minutes=15))
+        query = ScannedLocation.select(*ScannedLocation.map_fields())
         if timestamp > 0:
-            query = (ScannedLocation
-                     .select()
+            query = (query
                      .where(((ScannedLocation.last_modified >=
                               datetime.utcfromtimestamp(timestamp / 1000))) &
-                            (ScannedLocation.latitude >= swLat) &
-                            (ScannedLocation.longitude >= swLng) &
-                            (ScannedLocation.latitude <= neLat) &
-                            (ScannedLocation.longitude <= neLng))
+                            in_bounds(ScannedLocation, swLat, swLng, neLat,
+                                      neLng))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send scannedlocations in view but exclude those within old
             # boundaries. Only send newly uncovered scannedlocations.
-            query = (ScannedLocation
-                     .select()
+            query = (query
                      .where((((ScannedLocation.last_modified >= activeTime)) &
-                             (ScannedLocation.latitude >= swLat) &
-                             (ScannedLocation.longitude >= swLng) &
-                             (ScannedLocation.latitude <= neLat) &
-                             (ScannedLocation.longitude <= neLng)) &
+                             in_bounds(ScannedLocation, swLat, swLng, neLat,
+                                       neLng)) &
                             ~(((ScannedLocation.last_modified >= activeTime)) &
-                              (ScannedLocation.latitude >= oSwLat) &
-                              (ScannedLocation.longitude >= oSwLng) &
-                              (ScannedLocation.latitude <= oNeLat) &
-                              (ScannedLocation.longitude <= oNeLng)))
+                              box(ScannedLocation, oSwLat, oSwLng, oNeLat,
+                                  oNeLng)))
                      .dicts())
         else:
-            query = (ScannedLocation
-                     .select()
+            query = (query
                      .where((ScannedLocation.last_modified >= activeTime) &
-                            (ScannedLocation.latitude >= swLat) &
-                            (ScannedLocation.longitude >= swLng) &
-                            (ScannedLocation.latitude <= neLat) &
-                            (ScannedLocation.longitude <= neLng))
+                            in_bounds(ScannedLocation, swLat, swLng, neLat,
+                                      neLng))
                      .order_by(ScannedLocation.last_modified.asc())
                      .dicts())
 
+        if stream:
+            return iter_rows(query)
+
         return list(query)
 
+    @staticmethod
+    def get_recent_by_cellids(cellids):
+        scanned = []
+        for ids in chunks(cellids):
+            scanned += list(ScannedLocation
+                            .select()
+                            .where(ScannedLocation.cellid << ids)
+                            .dicts())
+
+        return scanned
+
     # DB format of a new location.
     @staticmethod
     def new_loc(loc):
         return {'cellid': cellid(loc),
                 'latitude': loc[0],
                 'longitude': loc[1],
+                's2cell': s2_leaf(loc[0], loc[1]),
                 'done': False,
                 'band1': -1,
                 'band2': -1,
@@ -1046,41 +1513,7 @@ class ScannedLocation(BaseModel):
 
     @classmethod
     def select_in_hex(cls, center, steps):
-        # There should be a way to delegate this to SpawnPoint.select_in_hex,
-        # but w/e.
-
-        R = 6378.1  # KM radius of the earth
-        hdist = ((steps * 120.0) - 50.0) / 1000.0
-        n, e, s, w = hex_bounds(center, steps)
-
-        # Get all spawns in that box.
-        sp = list(cls
-                  .select()
-                  .where((cls.latitude <= n) &
-                         (cls.latitude >= s) &
-                         (cls.longitude >= w) &
-                         (cls.longitude <= e))
-                  .dicts())
-
-        # For each spawn work out if it is in the hex (clipping the diagonals).
-        in_hex = []
-        for spawn in sp:
-            # Get the offset from the center of each spawn in km.
-            offset = [math.radians(spawn['latitude'] - center[0]) * R,
-                      math.radians(spawn['longitude'] - center[1]) *
-                      (R * math.cos(math.radians(center[0])))]
-            # Check against the 4 lines that make up the diagonals.
-            if (offset[1] + (offset[0] * 0.5)) > hdist:  # Too far NE.
-                continue
-            if (offset[1] - (offset[0] * 0.5)) > hdist:  # Too far SE
-                continue
-            if ((offset[0] * 0.5) - offset[1]) > hdist:  # Too far NW
-                continue
-            if ((0 - offset[1]) - (offset[0] * 0.5)) > hdist:  # Too far SW
-                continue
-            # If it gets to here it's a good spawn.
-            in_hex.append(spawn)
-        return in_hex
+        return rows_in_hex(cls, center, steps)
 
 
 class MainWorker(BaseModel):
@@ -1195,6 +1628,7 @@ class SpawnPoint(BaseModel):
     id = CharField(primary_key=True, max_length=50)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2cell = BigIntegerField(null=True, index=True)
     last_scanned = DateTimeField(index=True)
     # kind gives the four quartiles of the spawn, as 's' for seen
     # or 'h' for hidden.  For example, a 30 minute spawn is 'hhss'.
@@ -1242,6 +1676,7 @@ class SpawnPoint(BaseModel):
             'id': id,
             'latitude': latitude,
             'longitude': longitude,
+            's2cell': s2_leaf(latitude, longitude),
             'last_scanned': None,  # Null value used as new flag.
             'kind': 'hhhs',
             'links': '????',
@@ -1337,38 +1772,7 @@ class SpawnPoint(BaseModel):
 
     @classmethod
     def select_in_hex(cls, center, steps):
-        R = 6378.1  # KM radius of the earth
-        hdist = ((steps * 120.0) - 50.0) / 1000.0
-        n, e, s, w = hex_bounds(center, steps)
-
-        # Get all spawns in that box.
-        sp = list(cls
-                  .select()
-                  .where((cls.latitude <= n) &
-                         (cls.latitude >= s) &
-                         (cls.longitude >= w) &
-                         (cls.longitude <= e))
-                  .dicts())
-
-        # For each spawn work out if it is in the hex (clipping the diagonals).
-        in_hex = []
-        for spawn in sp:
-            # Get the offset from the center of each spawn in km.
-            offset = [math.radians(spawn['latitude'] - center[0]) * R,
-                      math.radians(spawn['longitude'] - center[1]) *
-                      (R * math.cos(math.radians(center[0])))]
-            # Check against the 4 lines that make up the diagonals.
-            if (offset[1] + (offset[0] * 0.5)) > hdist:  # Too far NE
-                continue
-            if (offset[1] - (offset[0] * 0.5)) > hdist:  # Too far SE
-                continue
-            if ((offset[0] * 0.5) - offset[1]) > hdist:  # Too far NW
-                continue
-            if ((0 - offset[1]) - (offset[0] * 0.5)) > hdist:  # Too far SW
-                continue
-            # If it gets to here it's a good spawn.
-            in_hex.append(spawn)
-        return in_hex
+        return rows_in_hex(cls, center, steps)
 
 
 class ScanSpawnPoint(BaseModel):
@@ -1682,6 +2086,97 @@ def hex_bounds(center, steps=None, radius=None):
     return (n, e, s, w)
 
 
+# Expression matching the rows of a model whose S2 cell is in a viewport.
+# The cells cover a bit more than the viewport, it's meant to narrow down
+# the rows by index before the exact location checks.
+def s2_within(cls, swLat, swLng, neLat, neLng):
+    return reduce(operator.or_,
+                  [cls.s2cell.between(first, last)
+                   for first, last in s2_ranges(swLat, swLng, neLat, neLng)])
+
+
+# Expression matching the rows of a model in a viewport.
+def box(cls, swLat, swLng, neLat, neLng):
+    return ((cls.latitude >= swLat) & (cls.longitude >= swLng) &
+            (cls.latitude <= neLat) & (cls.longitude <= neLng))
+
+
+# Same as box(), but the rows are looked up by S2 cell. Rows without one
+# yet, written before their table had S2 cells or by an older instance,
+# are looked up by location.
+def in_bounds(cls, swLat, swLng, neLat, neLng):
+    return ((s2_within(cls, swLat, swLng, neLat, neLng) |
+             (cls.s2cell >> None)) &
+            box(cls, swLat, swLng, neLat, neLng))
+
+
+# Return the rows of a model (dicts) in the hex scanned around center with
+# the given number of steps. The rows are looked up as by in_bounds(), the
+# distance checks are done here.
+def rows_in_hex(cls, center, steps):
+    n, e, s, w = hex_bounds(center, steps)
+    rows = list(cls
+                .select()
+                .where(in_bounds(cls, s, w, n, e))
+                .dicts())
+    if not rows:
+        return rows
+
+    R = 6378.1  # KM radius of the earth
+    hdist = ((steps * 120.0) - 50.0) / 1000.0
+
+    lats = np.fromiter((row['latitude'] for row in rows), float, len(rows))
+    lngs = np.fromiter((row['longitude'] for row in rows), float, len(rows))
+    # Get the offset from the center of each row in km.
+    north = np.radians(lats - center[0]) * R
+    east = (np.radians(lngs - center[1]) *
+            (R * math.cos(math.radians(center[0]))))
+
+    # Keep the rows in the box, then clip its corners along the 4 diagonals
+    # of the hex.
+    inside = ((lats <= n) & (lats >= s) & (lngs >= w) & (lngs <= e) &
+              (east + north * 0.5 <= hdist) &  # Not too far NE.
+              (east - north * 0.5 <= hdist) &  # Not too far SE.
+              (north * 0.5 - east <= hdist) &  # Not too far NW.
+              (-east - north * 0.5 <= hdist))  # Not too far SW.
+
+    return list(itertools.compress(rows, inside))
+
+
+# Add S2 cells to rows (dicts) that don't have one yet.
+def add_s2cells(rows):
+    rows = [row for row in rows if row.get('s2cell') is None]
+    if rows:
+        cells = s2_leaves([row['latitude'] for row in rows],
+                          [row['longitude'] for row in rows])
+        for row, cell in itertools.izip(rows, cells.tolist()):
+            row['s2cell'] = cell
+
+
+# Fill in the S2 cells of the rows of a model that don't have one yet.
+def backfill_s2cells(db, cls, batch_size=300):
+    key = cls._meta.primary_key
+    total = 0
+    while True:
+        rows = list(cls
+                    .select(key, cls.latitude, cls.longitude)
+                    .where(cls.s2cell >> None)
+                    .limit(batch_size)
+                    .tuples())
+        if not rows:
+            break
+
+        ids, lats, lngs = zip(*rows)
+        cells = zip(ids, s2_leaves(lats, lngs).tolist())
+        with db.atomic():
+            (cls.update(s2cell=case(key, cells))
+             .where(key << list(ids))
+             .execute())
+        total += len(rows)
+
+    log.info('Added S2 cells to %d rows of %s.', total, cls._meta.db_table)
+
+
 # todo: this probably shouldn't _really_ be in "models" anymore, but w/e.
 def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
               api, now_date, account):
@@ -1690,6 +2185,7 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
     gyms = {}
     skipped = 0
     stopsskipped = 0
+    known_gyms = {}
     forts = []
     wild_pokemon = []
     nearby_pokemon = []
@@ -1755,10 +2251,11 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                          for p in wild_pokemon]
         # For all the wild Pokemon we found check if an active Pokemon is in
         # the database.
-        query = (Pokemon
-                 .select(Pokemon.encounter_id, Pokemon.spawnpoint_id)
-                 .where((Pokemon.disappear_time > datetime.utcnow()) &
-                        (Pokemon.encounter_id << encounter_ids))
+        query = (ActivePokemon
+                 .select(ActivePokemon.encounter_id,
+                         ActivePokemon.spawnpoint_id)
+                 .where((ActivePokemon.disappear_time > datetime.utcnow()) &
+                        (ActivePokemon.encounter_id << encounter_ids))
                  .dicts())
 
         # Store all encounter_ids and spawnpoint_ids for the Pokemon in query.
@@ -1931,6 +2428,19 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                     (f['last_modified'] -
                      datetime(1970, 1, 1)).total_seconds())) for f in query]
 
+        # Gyms are written on every scan, but only the ones that changed are
+        # pushed to live feed subscribers.
+        if config['parse_gyms'] and live_feed.enabled:
+            gym_ids = [f['id'] for f in forts if f.get('type') is None]
+            if gym_ids:
+                query = (Gym
+                         .select(Gym.gym_id, Gym.team_id,
+                                 Gym.guard_pokemon_id, Gym.gym_points,
+                                 Gym.last_modified)
+                         .where(Gym.gym_id << gym_ids)
+                         .dicts())
+                known_gyms = dict((g['gym_id'], g) for g in query)
+
         # Complete tutorial with a Pokestop spin
         if args.complete_tutorial and not (len(captcha_url) > 1):
             if config['parse_pokestops']:
@@ -2074,12 +2584,25 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
 
     db_update_queue.put((ScannedLocation, {0: scan_loc}))
 
+    add_s2cells(itertools.chain(pokemon.values(), pokestops.values(),
+                                gyms.values()))
     if pokemon:
         db_update_queue.put((Pokemon, pokemon))
+        if pokemon_index.enabled:
+            pokemon_index.add(pokemon.values())
     if pokestops:
         db_update_queue.put((Pokestop, pokestops))
     if gyms:
         db_update_queue.put((Gym, gyms))
+
+    if live_feed.enabled:
+        # Unchanged Pokemon and pokestops were skipped above.
+        live_feed.publish('pokemon', pokemon.values())
+        live_feed.publish('pokestop', pokestops.values())
+        live_feed.publish('gym', [
+            g for g in gyms.itervalues()
+            if g['gym_id'] not in known_gyms or
+            gym_changed(known_gyms[g['gym_id']], g)])
     if spawn_points:
         db_update_queue.put((SpawnPoint, spawn_points))
         db_update_queue.put((ScanSpawnPoint, scan_spawn_points))
@@ -2109,11 +2632,16 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
     gym_members = {}
     gym_pokemon = {}
     trainers = {}
+    live_gyms = {}
+    # Details for the gym cache, as Gym.get_gym_details() would read them
+    # once the writes are committed.
+    cached_gyms = {}
 
     i = 0
     for g in gym_responses.values():
         gym_state = g['gym_state']
         gym_id = gym_state['fort_data']['id']
+        fort = gym_state['fort_data']
 
         gym_details[gym_id] = {
             'gym_id': gym_id,
@@ -2122,6 +2650,34 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
             'url': g['urls'][0],
         }
 
+        guard_pokemon_id = fort.get('guard_pokemon_id', 0)
+        cached_gyms[gym_id] = {
+            'gym_id': gym_id,
+            'team_id': fort.get('owned_by_team', 0),
+            'name': g['name'],
+            'description': g.get('description'),
+            'guard_pokemon_id': guard_pokemon_id,
+            'guard_pokemon_name': (get_pokemon_name(guard_pokemon_id)
+                                   if guard_pokemon_id else ''),
+            'gym_points': fort.get('gym_points', 0),
+            'latitude': fort['latitude'],
+            'longitude': fort['longitude'],
+            'last_modified': datetime.utcfromtimestamp(
+                fort['last_modified_timestamp_ms'] / 1000.0),
+            'last_scanned': datetime.utcnow(),
+            'pokemon': [],
+        }
+
+        if live_feed.enabled:
+            live_gyms[gym_id] = {
+                'gym_id': gym_id,
+                'latitude': gym_state['fort_data']['latitude'],
+                'longitude': gym_state['fort_data']['longitude'],
+                'team_id': gym_state['fort_data'].get('owned_by_team', 0),
+                'name': g['name'],
+                'pokemon': [],
+            }
+
         if args.webhooks:
             webhook_data = {
                 'id': b64encode(str(gym_id)),
@@ -2171,6 +2727,27 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
                 'last_seen': datetime.utcnow(),
             }
 
+            cached_gyms[gym_id]['pokemon'].append(Gym.add_member_locale({
+                'pokemon_cp': gym_pokemon[i]['cp'],
+                'pokemon_id': gym_pokemon[i]['pokemon_id'],
+                'pokemon_uid': gym_pokemon[i]['pokemon_uid'],
+                'move_1': gym_pokemon[i]['move_1'],
+                'move_2': gym_pokemon[i]['move_2'],
+                'iv_attack': gym_pokemon[i]['iv_attack'],
+                'iv_defense': gym_pokemon[i]['iv_defense'],
+                'iv_stamina': gym_pokemon[i]['iv_stamina'],
+                'trainer_name': trainers[i]['name'],
+                'trainer_level': trainers[i]['level'],
+            }))
+
+            if live_feed.enabled:
+                live_gyms[gym_id]['pokemon'].append({
+                    'pokemon_id': member['pokemon_data']['pokemon_id'],
+                    'pokemon_cp': member['pokemon_data']['cp'],
+                    'trainer_name': member['trainer_public_profile']['name'],
+                    'trainer_level': member['trainer_public_profile']['level'],
+                })
+
             if args.webhooks:
                 webhook_data['pokemon'].append({
                     'pokemon_uid': member['pokemon_data']['id'],
@@ -2232,6 +2809,13 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
         if gym_members:
             db_update_queue.put((GymMember, gym_members))
 
+    for gym in cached_gyms.itervalues():
+        gym['pokemon'].sort(key=lambda p: p['pokemon_cp'], reverse=True)
+    gym_cache.refresh(cached_gyms)
+
+    if live_feed.enabled:
+        live_feed.publish('gym', live_gyms.values())
+
     log.info('Upserted gyms: %d, gym members: %d.',
              len(gym_details),
              len(gym_members))
@@ -2250,20 +2834,27 @@ def db_updater(args, q, db):
                     log.warning('%s... Retrying...', repr(e))
                     time.sleep(5)
 
-            # Loop the queue.
+            # Loop the queue, merging the updates in the write buffer.
             while True:
-                last_upsert = default_timer()
-                model, data = q.get()
-
-                bulk_upsert(model, data, db)
-                q.task_done()
-
-                log.debug('Upserted to %s, %d records (upsert queue '
-                          'remaining: %d) in %.2f seconds.',
-                          model.__name__,
-                          len(data),
-                          q.qsize(),
-                          default_timer() - last_upsert)
+                if write_buffer.full():
+                    # Leave the updates in the queue, which is bounded,
+                    # until the ones already taken are written.
+                    time.sleep(0.1)
+                else:
+                    try:
+                        model, data, token = q.get_entry(
+                            timeout=write_buffer.wait())
+                    except Empty:
+                        pass
+                    else:
+                        write_buffer.add(model, data.values(),
+                                         buffer_key(model), token=token)
+
+                write_buffered(db, q.journal)
+                # Entries are done once their rows are written, for
+                # q.join().
+                for _ in range(write_buffer.finished()):
+                    q.task_done()
 
                 if q.qsize() > 50:
                     log.warning(
@@ -2275,7 +2866,451 @@ def db_updater(args, q, db):
             time.sleep(5)
 
 
+# The queue of database updates for db_updater. What's seen of Pokemon and
+# spawns is written first, the status of the workers last, and only the
+# latest of it is kept. With --db-journal the updates are journaled until
+# they're written.
+def new_db_queue(args):
+    priorities = dict([(model, HIGH) for model in (
+        Pokemon, SpawnPoint, ScanSpawnPoint, SpawnpointDetectionData)] +
+        [(model, LOW) for model in (WorkerStatus, MainWorker)])
+    return UpdateQueue(maxsize=args.db_queue_size,
+                       policy=args.db_queue_full, priorities=priorities,
+                       collapse=(WorkerStatus, MainWorker), key=buffer_key,
+                       journal=Journal(args.db_journal)
+                       if args.db_journal else None)
+
+
+# The fields the queued rows of a model are merged by, None for models
+# without a primary key.
+def buffer_key(model):
+    key = model._meta.primary_key
+    if isinstance(key, CompositeKey):
+        return key.field_names
+    if key:
+        return (key.name,)
+    return None
+
+
+# The rows of the fort and scan tables last written by db_updater, with
+# --db-snapshot-ttl. The scanner sends them again every time it passes by,
+# mostly unchanged.
+last_written = dict(
+    (model, LastWritten(ttl=args.db_snapshot_ttl))
+    for model in (Pokestop, Gym, ScannedLocation, SpawnPoint, ScanSpawnPoint)
+) if args.db_snapshot_ttl > 0 else {}
+
+
+# Write the rows of the write buffer that are due, a statement per model
+# (and set of columns). Rows of the tables in last_written are skipped if
+# they haven't changed since they were written, changed ones only update
+# the columns that did.
+def write_buffered(db, journal=None):
+    while True:
+        taken = write_buffer.take()
+        if taken is None:
+            break
+
+        model, batches = taken
+        count = sum(len(data) for data in batches)
+        last = last_written.get(model)
+        start = default_timer()
+        try:
+            for data in batches:
+                if model is Pokemon:
+                    upsert_pokemon(data, db)
+                elif last is None:
+                    bulk_upsert(model, data, db)
+                else:
+                    for columns, rows in last.split(data):
+                        bulk_upsert(model, rows, db, update=columns)
+                        last.store(rows)
+                        record_changes(model, rows)
+                    continue
+                record_changes(model, data)
+        except Exception:
+            # The rows are written again once the database is back, until
+            # then nothing more is taken from the queue. They stay in the
+            # journal for the next run, in case that's first.
+            write_buffer.restore(model, batches)
+            raise
+        elapsed = default_timer() - start
+        tokens = write_buffer.done(model, count, elapsed)
+        if journal is not None:
+            journal.commit(tokens)
+
+        log.debug('Upserted to %s, %d records (write buffer remaining: %d) '
+                  'in %.2f seconds.', model.__name__, count,
+                  len(write_buffer), elapsed)
+
+
+# Statistics of the writes of db_updater, for the status page.
+def write_stats():
+    stats = write_buffer.stats()
+    for model, last in last_written.iteritems():
+        stats[model._meta.db_table] = last.stats()
+    return stats
+
+
+# Move the Pokemon that have disappeared from the active table to the
+# history, a batch at a time. They're stamped with the time they were moved,
+# so incremental spawnpoint queries pick them up.
+def move_expired_pokemon(db, batch_size=500):
+    moved = 0
+    while True:
+        now = datetime.utcnow()
+        rows = list(ActivePokemon
+                    .select()
+                    .where(ActivePokemon.disappear_time <= now)
+                    .limit(batch_size)
+                    .dicts())
+        if not rows:
+            return moved
+
+        for p in rows:
+            p['last_modified'] = now
+        encounter_ids = [p['encounter_id'] for p in rows]
+        with db.atomic():
+            # Partitioned, the disappear time is part of the primary key.
+            # Pokemon moved again with another one, because their TTH was
+            # found after they were moved, would be kept twice.
+            for ids in chunks(encounter_ids):
+                Pokemon.delete().where(Pokemon.encounter_id << ids).execute()
+            bulk_upsert(Pokemon, {p['encounter_id']: p for p in rows}, db)
+            for ids in chunks(encounter_ids):
+                (ActivePokemon
+                 .delete()
+                 .where(ActivePokemon.encounter_id << ids)
+                 .execute())
+        moved += len(rows)
+
+
+def pokemon_history_loop(args, db):
+    while True:
+        try:
+            start = default_timer()
+            moved = move_expired_pokemon(db)
+            if moved:
+                log.debug('Moved %d disappeared Pokemon to the history in '
+                          '%.2f seconds.', moved, default_timer() - start)
+        except Exception as e:
+            log.exception('Exception in pokemon_history_loop: %s', repr(e))
+        time.sleep(args.pokemon_history_interval)
+
+
+# Pull Pokemon written by other instances into the in-memory index.
+def pokemon_index_loop(args):
+    # Rows are timestamped before they're committed, so look back a bit.
+    overlap = timedelta(seconds=max(args.pokemon_index_sync, 10))
+    last_sync = datetime.utcnow()
+
+    while True:
+        time.sleep(args.pokemon_index_sync)
+        try:
+            sync_start = datetime.utcnow()
+            rows = Pokemon.get_active_rows(last_sync - overlap)
+            pokemon_index.add(rows)
+            last_sync = sync_start
+
+            log.debug('Synced %d Pokemon into the map index (%d active).',
+                      len(rows), len(pokemon_index))
+        except Exception as e:
+            log.exception('Exception in pokemon_index_loop: %s', repr(e))
+
+
+# Add committed map objects to the change log and bump their tiles.
+def record_changes(model, data):
+    if model not in (Pokemon, Pokestop, Gym, ScannedLocation):
+        return
+
+    if model is Gym:
+        gym_cache.update(data.values())
+
+    if tile_versions.enabled:
+        tile_versions.bump([(row['latitude'], row['longitude'])
+                            for row in data.values()])
+
+    if change_log.enabled:
+        key = model._meta.primary_key.name
+        change_log.record(model.__name__.lower(),
+                          [(row[key], row['latitude'], row['longitude'])
+                           for row in data.values()])
+
+
+# Count Pokemon sightings into rows of a stats rollup model, keyed on its
+# key fields with the disappear time bucketed.
+def rollup_sightings(model, rows):
+    fields = model.key_fields[:-1]
+    counts = {}
+    for p in rows:
+        key = tuple(p[f] for f in fields) + (
+            model.bucket(p['disappear_time']),)
+        sighting = {'count': 1, 'last_seen': p['disappear_time'],
+                    'latitude': p['latitude'],
+                    'longitude': p['longitude']}
+        if key not in counts:
+            sighting.update(zip(model.key_fields, key))
+        merge_sightings(counts, key, sighting)
+
+    return counts
+
+
+# Add new Pokemon sightings to the rows of a stats rollup model. With
+# remove, take purged sightings out of them instead: the rows keep their
+# last sighting, rows with nothing left are deleted.
+def update_rollup(model, rows, db, remove=False):
+    counts = rollup_sightings(model, rows)
+    if not counts:
+        return
+
+    first = getattr(model, model.key_fields[0])
+    bucket = getattr(model, model.key_fields[-1])
+    firsts = set(key[0] for key in counts)
+    buckets = set(key[-1] for key in counts)
+    found = {}
+    for first_ids in chunks(firsts, 400):
+        for bucket_ids in chunks(buckets, 400):
+            query = (model
+                     .select()
+                     .where((first << first_ids) & (bucket << bucket_ids))
+                     .dicts())
+            for old in query:
+                key = tuple(old[f] for f in model.key_fields)
+                if key not in counts:
+                    continue
+                if remove:
+                    old['count'] -= counts[key]['count']
+                    found[key] = old
+                else:
+                    merge_sightings(counts, key, old)
+
+    if remove:
+        counts = dict((k, row) for k, row in found.iteritems()
+                      if row['count'] > 0)
+        empty = [k for k, row in found.iteritems() if row['count'] <= 0]
+        for keys in chunks(empty, 300):
+            (model
+             .delete()
+             .where(reduce(operator.or_, [
+                 reduce(operator.and_, [getattr(model, f) == v for f, v in
+                                        zip(model.key_fields, k)])
+                 for k in keys]))
+             .execute())
+        if not counts:
+            return
+
+    if 's2cell' in model._meta.fields:
+        add_s2cells(counts.values())
+    bulk_upsert(model, counts, db)
+
+
+# Pokemon upserts and their rollup updates are serialized, so a Pokemon
+# reported by two workers at once is only counted once.
+pokemon_stats_lock = Lock()
+
+
+# Upsert Pokemon into the active table, adding the ones that weren't in the
+# database yet to the stats rollups, and moving the ones whose disappear
+# time changed.
+def upsert_pokemon(data, db):
+    with pokemon_stats_lock:
+        rows = data.values()
+        known = {}
+        for ids in chunks([p['encounter_id'] for p in rows]):
+            # Pokemon seen again after they were moved are in both tables
+            # until they're moved again, the active one is the latest.
+            for model in (Pokemon, ActivePokemon):
+                query = (model
+                         .select(model.encounter_id, model.spawnpoint_id,
+                                 model.pokemon_id, model.disappear_time,
+                                 model.latitude, model.longitude)
+                         .where(model.encounter_id << ids)
+                         .dicts())
+                known.update((p['encounter_id'], p) for p in query)
+
+        bulk_upsert(ActivePokemon, data, db)
+
+        # Known Pokemon move to the buckets of their new disappear time.
+        # Databases keep whole seconds.
+        new = []
+        old = []
+        for p in rows:
+            seen = known.get(p['encounter_id'])
+            if seen is None:
+                new.append(p)
+            elif abs((p['disappear_time'] -
+                      seen['disappear_time']).total_seconds()) >= 1:
+                new.append(p)
+                old.append(seen)
+        for model in (PokemonHourlyCount, SpawnpointDailyCount,
+                      SpawnpointTimeCount):
+            update_rollup(model, old, db, remove=True)
+            update_rollup(model, new, db)
+
+
+# Take purged Pokemon out of the stats rollups, so the stats count the
+# Pokemon that are kept, as they did before there were rollups.
+def remove_from_rollups(rows, db):
+    with pokemon_stats_lock:
+        for model in (PokemonHourlyCount, SpawnpointDailyCount,
+                      SpawnpointTimeCount):
+            update_rollup(model, rows, db, remove=True)
+
+
+# Build stats rollups from the Pokemon already in a table.
+def backfill_pokemon_stats(db, models=(PokemonHourlyCount,
+                                       SpawnpointDailyCount),
+                           source=Pokemon, batch_size=10000):
+    query = (source
+             .select(source.spawnpoint_id, source.pokemon_id,
+                     source.disappear_time, source.latitude,
+                     source.longitude)
+             .order_by(source.disappear_time)
+             .dicts())
+
+    batch = []
+    total = 0
+    for p in query.iterator():
+        batch.append(p)
+        if len(batch) >= batch_size:
+            for model in models:
+                update_rollup(model, batch, db)
+            total += len(batch)
+            batch = []
+            log.info('Added %d Pokemon to the stats rollups.', total)
+
+    for model in models:
+        update_rollup(model, batch, db)
+
+
+# MySQL's TO_SECONDS(), which the Pokemon partitions are ranged by.
+def to_seconds(dt):
+    return calendar.timegm(dt.timetuple()) + 62167219200
+
+
+# Pokemon partitions are named after the hour they end at.
+def partition_name(end):
+    return datetime.utcfromtimestamp(end - 62167219200).strftime('p%Y%m%d%H')
+
+
+# Partitions of the Pokemon table as (name, end) pairs in order. The last
+# one has no end and takes the Pokemon that don't fit the others.
+def pokemon_partitions(db):
+    cursor = db.execute_sql(
+        'SELECT partition_name, partition_description '
+        'FROM information_schema.partitions '
+        'WHERE table_schema = DATABASE() AND table_name = %s '
+        'AND partition_name IS NOT NULL '
+        'ORDER BY partition_ordinal_position', (Pokemon._meta.db_table,))
+    return [(name, None if end == 'MAXVALUE' else int(end))
+            for name, end in cursor.fetchall()]
+
+
+# Splits the Pokemon table into partitions of `hours` by disappear time.
+# Pokemon that have already disappeared all go to the first partition.
+# MySQL wants the partitioning column in every unique key, so it's added
+# to the primary key.
+def partition_pokemon(db, hours):
+    if pokemon_partitions(db):
+        return
+
+    log.info('Partitioning the Pokemon table, this can take a while...')
+    size = hours * 3600
+    end = to_seconds(datetime.utcnow()) // size * size
+    db.execute_sql(
+        'ALTER TABLE {} DROP PRIMARY KEY, '
+        'ADD PRIMARY KEY (encounter_id, disappear_time) '
+        'PARTITION BY RANGE (TO_SECONDS(disappear_time)) '
+        '(PARTITION {} VALUES LESS THAN ({}), '
+        'PARTITION pmax VALUES LESS THAN MAXVALUE)'.format(
+            Pokemon._meta.db_table, partition_name(end), end))
+    rotate_pokemon_partitions(db, hours)
+
+
+# Adds partitions for the Pokemon of the next two periods and, if given a
+# time, drops the partitions of Pokemon that disappeared before it.
+# Returns the number of partitions dropped.
+def rotate_pokemon_partitions(db, hours, before=None):
+    partitions = pokemon_partitions(db)
+    ends = [end for name, end in partitions if end is not None]
+    if not ends:
+        return 0
+
+    size = hours * 3600
+    ahead = to_seconds(datetime.utcnow()) + 2 * size
+    new = []
+    end = ends[-1]
+    while end < ahead:
+        end = (end // size + 1) * size
+        new.append(end)
+    if new:
+        db.execute_sql(
+            'ALTER TABLE {} REORGANIZE PARTITION pmax INTO ({}, '
+            'PARTITION pmax VALUES LESS THAN MAXVALUE)'.format(
+                Pokemon._meta.db_table, ', '.join(
+                    'PARTITION {} VALUES LESS THAN ({})'.format(
+                        partition_name(e), e) for e in new)))
+
+    if before is None:
+        return 0
+    old = [name for name, e in partitions
+           if e is not None and e <= to_seconds(before)]
+    if old:
+        for rows in partition_rows(db, old):
+            remove_from_rollups(rows, db)
+        db.execute_sql('ALTER TABLE {} DROP PARTITION {}'.format(
+            Pokemon._meta.db_table, ', '.join(old)))
+    return len(old)
+
+
+# The Pokemon of partitions, as rows for the stats rollups, a batch at a
+# time.
+def partition_rows(db, names, batch_size=10000):
+    fields = ('encounter_id', 'spawnpoint_id', 'pokemon_id',
+              'disappear_time', 'latitude', 'longitude')
+    sql = ('SELECT {} FROM {} PARTITION ({}) WHERE encounter_id > %s '
+           'ORDER BY encounter_id LIMIT {}').format(
+               ', '.join(fields), Pokemon._meta.db_table, ', '.join(names),
+               batch_size)
+    after = ''
+    while True:
+        rows = [dict(zip(fields, row))
+                for row in db.execute_sql(sql, (after,)).fetchall()]
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        after = rows[-1]['encounter_id']
+
+
+# Deletes the Pokemon that disappeared before a time, a batch at a time,
+# so the table isn't locked for long and no huge transaction builds up.
+# They're taken out of the stats rollups too.
+def purge_pokemon(before, batch_size=500):
+    db = Pokemon._meta.database
+    deleted = 0
+    while True:
+        rows = list(Pokemon
+                    .select(Pokemon.encounter_id, Pokemon.spawnpoint_id,
+                            Pokemon.pokemon_id, Pokemon.disappear_time,
+                            Pokemon.latitude, Pokemon.longitude)
+                    .where(Pokemon.disappear_time < before)
+                    .limit(batch_size)
+                    .dicts())
+        if not rows:
+            return deleted
+        with db.atomic():
+            deleted += (Pokemon
+                        .delete()
+                        .where(Pokemon.encounter_id <<
+                               [p['encounter_id'] for p in rows])
+                        .execute())
+            remove_from_rollups(rows, db)
+
+
 def clean_db_loop(args):
+    partitioned = (args.db_type == 'mysql' and
+                   args.pokemon_partition_hours > 0)
     while True:
         try:
             query = (MainWorker
@@ -2290,6 +3325,20 @@ def clean_db_loop(args):
                              (datetime.utcnow() - timedelta(minutes=30)))))
             query.execute()
 
+            # Tell map clients about the lures that are about to be removed.
+            if live_feed.enabled and len(live_feed):
+                expired = list(Pokestop
+                               .select(Pokestop.pokestop_id,
+                                       Pokestop.latitude,
+                                       Pokestop.longitude)
+                               .where(Pokestop.lure_expiration <
+                                      datetime.utcnow())
+                               .dicts())
+                for p in expired:
+                    p['lure_expiration'] = None
+                    p['active_fort_modifier'] = None
+                live_feed.publish('pokestop', expired)
+
             # Remove active modifier from expired lured pokestops.
             query = (Pokestop
                      .update(lure_expiration=None, active_fort_modifier=None)
@@ -2307,17 +3356,23 @@ def clean_db_loop(args):
             if args.purge_data > 0:
                 log.info("Beginning purge of old Pokemon spawns.")
                 start = datetime.utcnow()
-                query = (Pokemon
-                         .delete()
-                         .where((Pokemon.disappear_time <
-                                 (datetime.utcnow() -
-                                  timedelta(hours=args.purge_data)))))
-                rows = query.execute()
+                before = start - timedelta(hours=args.purge_data)
+                if partitioned:
+                    rows = rotate_pokemon_partitions(
+                        Pokemon._meta.database, args.pokemon_partition_hours,
+                        before)
+                    what = 'partitions'
+                else:
+                    rows = purge_pokemon(before)
+                    what = 'Pokemon'
                 end = datetime.utcnow()
                 diff = end-start
                 log.info("Completed purge of old Pokemon spawns. "
-                         "%i deleted in %f seconds.",
-                         rows, diff.total_seconds())
+                         "%i %s deleted in %f seconds.",
+                         rows, what, diff.total_seconds())
+            elif partitioned:
+                rotate_pokemon_partitions(Pokemon._meta.database,
+                                          args.pokemon_partition_hours)
 
             log.info('Regular database cleaning complete.')
             time.sleep(60)
@@ -2325,72 +3380,32 @@ def clean_db_loop(args):
             log.exception('Exception in clean_db_loop: %s', repr(e))
 
 
-def bulk_upsert(cls, data, db):
-    num_rows = len(data.values())
-    i = 0
-
-    if args.db_type == 'mysql':
-        step = 250
-    else:
-        # SQLite has a default max number of parameters of 999,
-        # so we need to limit how many rows we insert for it.
-        step = 50
-
-    with db.atomic():
-        while i < num_rows:
-            log.debug('Inserting items %d to %d.', i, min(i + step, num_rows))
-            try:
-                # Turn off FOREIGN_KEY_CHECKS on MySQL, because apparently it's
-                # unable to recognize strings to update unicode keys for
-                # foreign key fields, thus giving lots of foreign key
-                # constraint errors.
-                if args.db_type == 'mysql':
-                    db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
-
-                # Use peewee's own implementation of the insert_many() method.
-                InsertQuery(cls, rows=data.values()[
-                            i:min(i + step, num_rows)]).upsert().execute()
-
-                if args.db_type == 'mysql':
-                    db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
-
-            except Exception as e:
-                # If there is a DB table constraint error, dump the data and
-                # don't retry.
-                #
-                # Unrecoverable error strings:
-                unrecoverable = ['constraint', 'has no attribute',
-                                 'peewee.IntegerField object at']
-                has_unrecoverable = filter(
-                    lambda x: x in str(e), unrecoverable)
-                if has_unrecoverable:
-                    log.warning('%s. Data is:', repr(e))
-                    log.warning(data.items())
-                else:
-                    log.warning('%s... Retrying...', repr(e))
-                    time.sleep(1)
-                    continue
-
-            i += step
+def bulk_upsert(cls, data, db, update=None):
+    upsert(db, cls, data.values(), update=update)
 
 
 def create_tables(db):
     db.connect()
     verify_database_schema(db)
-    db.create_tables([Pokemon, Pokestop, Gym, ScannedLocation, GymDetails,
-                      GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus,
-                      SpawnPoint, ScanSpawnPoint, SpawnpointDetectionData,
-                      Token, LocationAltitude], safe=True)
+    db.create_tables([Pokemon, ActivePokemon, Pokestop, Gym,
+                      ScannedLocation, GymDetails, GymMember, GymPokemon,
+                      Trainer, MainWorker, WorkerStatus, SpawnPoint,
+                      ScanSpawnPoint, SpawnpointDetectionData, Token,
+                      LocationAltitude, PokemonHourlyCount,
+                      SpawnpointDailyCount, SpawnpointTimeCount], safe=True)
+    if args.db_type == 'mysql' and args.pokemon_partition_hours > 0:
+        partition_pokemon(db, args.pokemon_partition_hours)
     db.close()
 
 
 def drop_tables(db):
     db.connect()
-    db.drop_tables([Pokemon, Pokestop, Gym, ScannedLocation, Versions,
-                    GymDetails, GymMember, GymPokemon, Trainer, MainWorker,
-                    WorkerStatus, SpawnPoint, ScanSpawnPoint,
+    db.drop_tables([Pokemon, ActivePokemon, Pokestop, Gym, ScannedLocation,
+                    Versions, GymDetails, GymMember, GymPokemon, Trainer,
+                    MainWorker, WorkerStatus, SpawnPoint, ScanSpawnPoint,
                     SpawnpointDetectionData, LocationAltitude,
-                    Token, Versions], safe=True)
+                    Token, PokemonHourlyCount, SpawnpointDailyCount,
+                    SpawnpointTimeCount, Versions], safe=True)
     db.close()
 
 
@@ -2622,3 +3637,76 @@ def database_migrate(db, old_ver):
                 migrator.add_index('pokestop', ('last_updated',), False)
             )
         log.info('Schema upgrade complete.')
+
+    if old_ver < 17:
+        log.info('Building the Pokemon stats rollups from the existing '
+                 'Pokemon. This can take some time, please be patient.')
+        db.create_tables([PokemonHourlyCount, SpawnpointDailyCount],
+                         safe=True)
+        backfill_pokemon_stats(db)
+        log.info('Pokemon stats rollups are complete.')
+
+    if old_ver < 18:
+        migrate(
+            migrator.add_column('spawnpoint', 's2cell',
+                                BigIntegerField(null=True)),
+            migrator.add_column('scannedlocation', 's2cell',
+                                BigIntegerField(null=True)),
+            migrator.add_index('spawnpoint', ('s2cell',), False),
+            migrator.add_index('scannedlocation', ('s2cell',), False)
+        )
+        for model in (SpawnPoint, ScannedLocation):
+            backfill_s2cells(db, model)
+
+    if old_ver < 19:
+        log.info('Adding S2 cells to Pokemon, pokestops and gyms. This can '
+                 'take some time, please be patient.')
+        tables = ('pokemon', 'pokestop', 'gym', 'locationaltitude')
+        migrate(*([migrator.add_column(table, 's2cell',
+                                       BigIntegerField(null=True))
+                   for table in tables] +
+                  [migrator.add_index(table, ('s2cell',), False)
+                   for table in tables]))
+        # The history isn't looked up by location anymore, its location
+        # index would only slow down writes.
+        for index in db.get_indexes('pokemon'):
+            if index.columns == ['latitude', 'longitude']:
+                migrate(migrator.drop_index('pokemon', index.name))
+        for model in (Pokestop, Gym, LocationAltitude, Pokemon):
+            backfill_s2cells(db, model)
+
+    if old_ver < 20:
+        # Pokemon that haven't disappeared yet go to a table of their own.
+        db.create_tables([ActivePokemon], safe=True)
+        now = datetime.utcnow()
+        fields = [f.name for f in ActivePokemon._meta.sorted_fields]
+        with db.atomic():
+            (ActivePokemon
+             .insert_from([getattr(ActivePokemon, f) for f in fields],
+                          Pokemon
+                          .select(*[getattr(Pokemon, f) for f in fields])
+                          .where(Pokemon.disappear_time > now))
+             .execute())
+            Pokemon.delete().where(Pokemon.disappear_time > now).execute()
+
+    if old_ver < 21:
+        log.info('Counting spawnpoint times for the spawnpoint layer. This '
+                 'can take some time, please be patient.')
+        db.create_tables([SpawnpointTimeCount], safe=True)
+        for source in (Pokemon, ActivePokemon):
+            backfill_pokemon_stats(db, (SpawnpointTimeCount,), source)
+
+    if old_ver < 22:
+        # Lured stops are looked up by lure expiration.
+        for index in db.get_indexes('pokestop'):
+            if index.columns == ['active_fort_modifier']:
+                migrate(migrator.drop_index('pokestop', index.name))
+
+    if old_ver < 23:
+        # Rows without an S2 cell are looked up by location.
+        for table in ('activepokemon', 'pokestop', 'gym', 'locationaltitude',
+                      'scannedlocation', 'spawnpoint'):
+            if not any(index.columns == ['latitude', 'longitude']
+                       for index in db.get_indexes(table)):
+                migrate(migrator.add_index(table, ('latitude', 'longitude'),
+                                           False))
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import sqlite3
+import time
+
+from peewee import CompositeKey, IntegrityError, MySQLDatabase, \
+    OperationalError
+
+log = logging.getLogger(__name__)
+
+# Placeholders a MySQL statement can have.
+MYSQL_MAX_PARAMS = 65535
+
+# SQLite understands ON CONFLICT DO UPDATE since 3.24, older versions fall
+# back to replacing the rows.
+SQLITE_UPSERT = sqlite3.sqlite_version_info >= (3, 24)
+
+# Error messages of rows that will never make it to the database. They are
+# logged and left out instead of retried.
+UNRECOVERABLE = ('constraint', 'has no attribute',
+                 'peewee.IntegerField object at')
+
+
+# Return the fields of a model that make up its primary key, empty for
+# models without one.
+def key_fields(model):
+    key = model._meta.primary_key
+    if isinstance(key, CompositeKey):
+        return [model._meta.fields[name] for name in key.field_names]
+    return [key] if key else []
+
+
+# Return the fields rows of a model set: the fields in the rows, and the
+# ones with a default, as peewee inserts them.
+def row_fields(model, rows, names=None):
+    names = names or row_names(rows)
+    fields = model._meta.fields
+    return sorted((fields[name] for name in names | set(
+        name for name, f in fields.iteritems() if f.default is not None)),
+        key=lambda f: f._sort_key)
+
+
+def row_names(rows):
+    names = set()
+    for row in rows:
+        names.update(row)
+    return names
+
+
+def row_values(fields, row):
+    values = []
+    for field in fields:
+        if field.name in row:
+            value = row[field.name]
+        elif callable(field.default):
+            value = field.default()
+        else:
+            value = field.default
+        values.append(field.db_value(value))
+    return values
+
+
+# Return the SQL inserting `count` rows of the fields into the table of a
+# model, updating the rows that already exist: all their fields, or the ones
+# named in `update`.
+def upsert_sql(db, model, fields, count=1, update=None):
+    def quote(name):
+        return '{0}{1}{0}'.format(db.quote_char, name)
+
+    keys = key_fields(model)
+    columns = ', '.join(quote(f.db_column) for f in fields)
+    row = '({})'.format(', '.join([db.interpolation] * len(fields)))
+    # Fields compare into expressions, they're told apart by name.
+    key_names = set(f.name for f in keys)
+    updates = [f for f in fields if f.name not in key_names and (
+        update is None or f.name in update)]
+    mysql = isinstance(db, MySQLDatabase)
+
+    if not keys or not (mysql or SQLITE_UPSERT):
+        verb = 'REPLACE' if keys and mysql else (
+            'INSERT OR REPLACE' if keys else 'INSERT')
+        return '{} INTO {} ({}) VALUES {}'.format(
+            verb, quote(model._meta.db_table), columns,
+            ', '.join([row] * count))
+
+    sql = 'INSERT INTO {} ({}) VALUES {}'.format(
+        quote(model._meta.db_table), columns, ', '.join([row] * count))
+    if mysql:
+        # A key only table updates a key column to itself.
+        return sql + ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+            '{0} = VALUES({0})'.format(quote(f.db_column))
+            for f in updates or keys[:1])
+    target = ', '.join(quote(f.db_column) for f in keys)
+    if not updates:
+        return sql + ' ON CONFLICT ({}) DO NOTHING'.format(target)
+    return sql + ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+        target, ', '.join('{0} = excluded.{0}'.format(quote(f.db_column))
+                          for f in updates))
+
+
+def is_unrecoverable(e):
+    return isinstance(e, IntegrityError) or any(
+        s in str(e) for s in UNRECOVERABLE)
+
+
+# Write chunks of rows in one transaction. MySQL gets multi-row statements
+# as big as its placeholder limit allows (up to max_rows rows), SQLite a
+# single row statement prepared once and run for every row. A chunk that
+# can't be written is skipped whole.
+def write_chunks(db, model, fields, rows, max_rows, update=None):
+    mysql = isinstance(db, MySQLDatabase)
+    if mysql:
+        step = max(min(max_rows, MYSQL_MAX_PARAMS // len(fields)), 1)
+    else:
+        step = max_rows
+
+    with db.atomic():
+        cursor = db.get_cursor()
+        if mysql:
+            # Turn off FOREIGN_KEY_CHECKS on MySQL, because apparently it's
+            # unable to recognize strings to update unicode keys for
+            # foreign key fields, thus giving lots of foreign key constraint
+            # errors.
+            cursor.execute('SET FOREIGN_KEY_CHECKS=0')
+        try:
+            for i in range(0, len(rows), step):
+                chunk = rows[i:i + step]
+                log.debug('Upserting %s rows %d to %d.',
+                          model._meta.db_table, i, i + len(chunk))
+                try:
+                    with db.atomic():
+                        if mysql:
+                            cursor.execute(
+                                upsert_sql(db, model, fields, len(chunk),
+                                           update),
+                                [v for row in chunk
+                                 for v in row_values(fields, row)])
+                        else:
+                            cursor.executemany(
+                                upsert_sql(db, model, fields, update=update),
+                                [row_values(fields, row) for row in chunk])
+                except Exception as e:
+                    if not is_unrecoverable(e):
+                        raise
+                    log.warning('%s. Data is:', repr(e))
+                    log.warning(chunk)
+        finally:
+            if mysql:
+                cursor.execute('SET FOREIGN_KEY_CHECKS=1')
+
+
+# Insert rows (dicts) of a model, updating the rows whose key exists. Only
+# the columns in the rows (and the ones with defaults) are written, rows
+# missing a column the others have get its default. Pass the names of the
+# columns to update in `update` to leave the others of existing rows alone,
+# columns filled in from their defaults are updated regardless. Failed
+# writes are retried `retries` times, waiting longer every time, before the
+# error is raised.
+def upsert(db, model, rows, max_rows=1000, retries=3, backoff=1.0,
+           update=None):
+    rows = list(rows)
+    if not rows:
+        return
+    names = row_names(rows)
+    fields = row_fields(model, rows, names)
+    if update is not None:
+        update = set(update) | set(f.name for f in fields
+                                   if f.name not in names)
+
+    for attempt in range(retries + 1):
+        try:
+            write_chunks(db, model, fields, rows, max_rows, update)
+            return
+        except Exception as e:
+            if attempt == retries:
+                raise
+            log.warning('%s... Retrying...', repr(e))
+            if isinstance(e, OperationalError) and not db.is_closed():
+                # The connection may be gone, the next try opens a new one.
+                db.close()
+            time.sleep(backoff * 2 ** attempt)
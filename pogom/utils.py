@@ -289,6 +289,16 @@ def get_args():
                         help=('Clear Pokemon from database this many hours ' +
                               'after they disappear (0 to disable).'),
                         type=int, default=0)
+    parser.add_argument('-pph', '--pokemon-partition-hours',
+                        help=('Split the Pokemon table into partitions of ' +
+                              'this many hours by disappear time, so ' +
+                              'purging drops whole partitions (MySQL only, ' +
+                              '0 to disable).'),
+                        type=int, default=0)
+    parser.add_argument('-phi', '--pokemon-history-interval',
+                        help=('Seconds between moving disappeared Pokemon ' +
+                              'from the active table to the history.'),
+                        type=int, default=60)
     parser.add_argument('-px', '--proxy',
                         help='Proxy url (e.g. socks5://127.0.0.1:9050)',
                         action='append')
@@ -330,6 +340,82 @@ def get_args():
                         help=('Number of db threads; increase if the db ' +
                               'queue falls behind.'),
                         type=int, default=1)
+    parser.add_argument('-dbr', '--db-buffer-rows',
+                        help=('Rows the db threads collect before writing ' +
+                              'them, merging repeated updates of the same ' +
+                              'rows. 0 writes every update as it comes.'),
+                        type=int, default=1000)
+    parser.add_argument('-dbd', '--db-buffer-delay',
+                        help=('Seconds the db threads hold on to updates ' +
+                              'at most before writing them.'),
+                        type=float, default=1.0)
+    parser.add_argument('-dbs', '--db-snapshot-ttl',
+                        help=('Seconds the db threads remember the forts ' +
+                              'and scanned locations they wrote, to skip ' +
+                              'writing them again unchanged. Only for a ' +
+                              'single instance writing to the database, ' +
+                              'changes made by others are missed for up to ' +
+                              'as long. 0 to always write them.'),
+                        type=int, default=0)
+    parser.add_argument('-dbq', '--db-queue-size',
+                        help=('Updates the db queue holds at most, 0 for ' +
+                              'no limit. Worker status updates are merged ' +
+                              'and not counted.'),
+                        type=int, default=1000)
+    parser.add_argument('-dbqf', '--db-queue-full',
+                        help=('What to do with updates when the db queue ' +
+                              'is full: block the scanners until there is ' +
+                              'room, drop the oldest update of the lowest ' +
+                              'priority, or spill updates to a temporary ' +
+                              'file.'),
+                        choices=['block', 'drop', 'spill'], default='block')
+    parser.add_argument('-dbj', '--db-journal',
+                        help=('Directory to journal db updates in until ' +
+                              'they are written, so they survive a crash ' +
+                              'or restart while the database is down. ' +
+                              'They are written on the next start.'),
+                        default=None)
+    parser.add_argument('-pi', '--pokemon-index',
+                        help=('Answer map queries for active Pokemon from ' +
+                              'an in-memory index instead of the database.'),
+                        action='store_true', default=False)
+    parser.add_argument('-pis', '--pokemon-index-sync',
+                        help=('Seconds between pulling Pokemon written by ' +
+                              'other instances into the in-memory index. ' +
+                              'Needed when other instances scan into the ' +
+                              'same database (0 to disable).'),
+                        type=int, default=0)
+    parser.add_argument('-ds', '--delta-sync',
+                        help=('Send map clients only the objects that ' +
+                              'changed since their last update. Changes ' +
+                              'are tracked as this instance writes them, ' +
+                              'so this has no effect with --only-server.'),
+                        action='store_true', default=False)
+    parser.add_argument('-lf', '--live-feed',
+                        help=('Push map updates to clients subscribed to ' +
+                              '/stream as they are scanned. Only updates ' +
+                              'scanned by this instance are pushed.'),
+                        action='store_true', default=False)
+    parser.add_argument('-cq', '--coalesce-queries',
+                        help=('Share the results of identical map queries ' +
+                              'between clients for this many seconds ' +
+                              '(0 to disable).'),
+                        type=int, default=0)
+    parser.add_argument('-cqg', '--coalesce-grid',
+                        help=('Size in degrees of the grid viewports are ' +
+                              'snapped to when coalescing map queries.'),
+                        type=float, default=0.005)
+    parser.add_argument('-scd', '--shared-cache-dir',
+                        help=('Directory to share coalesced map query ' +
+                              'results in between web server processes ' +
+                              'on this host, preferably on a tmpfs like ' +
+                              '/dev/shm. Needs --coalesce-queries.'),
+                        default=None)
+    parser.add_argument('-mps', '--max-page-size',
+                        help=('Most Pokemon, pokestops and gyms sent at ' +
+                              'once to clients asking for all of them, ' +
+                              'without a viewport, and on the mobile page.'),
+                        type=int, default=1000)
     parser.add_argument('-wh', '--webhook',
                         help='Define URL(s) to POST webhook information to.',
                         default=None, dest='webhooks', action='append')
@@ -662,6 +748,15 @@ def get_args():
         if args.webhooks is None:
             args.webhook_scheduler_updates = False
 
+    # Without a local scanner the Pokemon index can only be fed from the db.
+    if (args.only_server and args.pokemon_index and
+            not args.pokemon_index_sync):
+        args.pokemon_index_sync = 5
+
+    # The change log only sees what this instance writes to the db.
+    if args.only_server:
+        args.delta_sync = False
+
     return args
 
 
@@ -762,18 +857,107 @@ def get_pokemon_id(pokemon_name):
     return get_pokemon_id.ids.get(pokemon_name, -1)
 
 
+# Translate the words of the data files into a locale.
+def locale_translator(locale):
+    if not hasattr(locale_translator, 'dictionaries'):
+        locale_translator.dictionaries = {}
+    dictionary = locale_translator.dictionaries.get(locale)
+    if dictionary is None:
+        dictionary = {}
+        file_path = os.path.join(
+            config['ROOT_PATH'],
+            config['LOCALES_DIR'],
+            '{}.min.json'.format(locale))
+        if locale != 'en' and os.path.isfile(file_path):
+            with open(file_path, 'r') as f:
+                dictionary = json.loads(f.read())
+        locale_translator.dictionaries[locale] = dictionary
+
+    def translate(word):
+        return dictionary.get(word, word)
+    return translate
+
+
+# Build the Pokemon data of a locale, resolved and indexed by integer id,
+# so enriching rows doesn't go through i8ln for every field.
+def get_pokemon_tables(locale=None):
+    locale = locale or config['LOCALE']
+    if not hasattr(get_pokemon_tables, 'tables'):
+        get_pokemon_tables.tables = {}
+    if locale in get_pokemon_tables.tables:
+        return get_pokemon_tables.tables[locale]
+
+    translate = locale_translator(locale)
+    # Make sure the data file is loaded.
+    get_pokemon_data(1)
+
+    tables = {'pokemon_name': {}, 'pokemon_rarity': {}, 'pokemon_types': {}}
+    for pokemon_id, data in get_pokemon_data.pokemon.iteritems():
+        pokemon_id = int(pokemon_id)
+        tables['pokemon_name'][pokemon_id] = translate(data['name'])
+        tables['pokemon_rarity'][pokemon_id] = translate(data['rarity'])
+        tables['pokemon_types'][pokemon_id] = [
+            {'type': translate(t['type']), 'color': t['color']}
+            for t in data['types']]
+
+    get_pokemon_tables.tables[locale] = tables
+    return tables
+
+
+# Same as get_pokemon_tables(), for the moves. They're only built when a
+# move is looked up.
+def get_move_tables(locale=None):
+    locale = locale or config['LOCALE']
+    if not hasattr(get_move_tables, 'tables'):
+        get_move_tables.tables = {}
+    if locale in get_move_tables.tables:
+        return get_move_tables.tables[locale]
+
+    translate = locale_translator(locale)
+    # Make sure the data file is loaded.
+    get_moves_data(1)
+
+    tables = {'move_name': {}, 'move_damage': {}, 'move_energy': {},
+              'move_type': {}}
+    for move_id, data in get_moves_data.moves.iteritems():
+        move_id = int(move_id)
+        tables['move_name'][move_id] = translate(data['name'])
+        tables['move_damage'][move_id] = translate(data['damage'])
+        tables['move_energy'][move_id] = translate(data['energy'])
+        tables['move_type'][move_id] = {'type': translate(data['type']),
+                                        'type_en': data['type']}
+
+    get_move_tables.tables[locale] = tables
+    return tables
+
+
+# The Pokemon and move tables of a locale, for clients that resolve ids
+# themselves.
+def get_locale_tables(locale=None):
+    tables = dict(get_pokemon_tables(locale))
+    tables.update(get_move_tables(locale))
+    return tables
+
+
+# Add the localized name, rarity and types to a Pokemon row.
+def add_pokemon_locale(p):
+    tables = get_pokemon_tables()
+    pokemon_id = p['pokemon_id']
+    p['pokemon_name'] = tables['pokemon_name'][pokemon_id]
+    p['pokemon_rarity'] = tables['pokemon_rarity'][pokemon_id]
+    p['pokemon_types'] = tables['pokemon_types'][pokemon_id]
+
+
 def get_pokemon_name(pokemon_id):
-    return i8ln(get_pokemon_data(pokemon_id)['name'])
+    return get_pokemon_tables()['pokemon_name'][int(pokemon_id)]
 
 
 def get_pokemon_rarity(pokemon_id):
-    return i8ln(get_pokemon_data(pokemon_id)['rarity'])
+    return get_pokemon_tables()['pokemon_rarity'][int(pokemon_id)]
 
 
 def get_pokemon_types(pokemon_id):
-    pokemon_types = get_pokemon_data(pokemon_id)['types']
-    return map(lambda x: {"type": i8ln(x['type']), "color": x['color']},
-               pokemon_types)
+    return get_pokemon_tables()['pokemon_types'][int(pokemon_id)]
 
 
 def get_moves_data(move_id):
@@ -789,20 +973,19 @@ def get_moves_data(move_id):
 
 
 def get_move_name(move_id):
-    return i8ln(get_moves_data(move_id)['name'])
+    return get_move_tables()['move_name'][int(move_id)]
 
 
 def get_move_damage(move_id):
-    return i8ln(get_moves_data(move_id)['damage'])
+    return get_move_tables()['move_damage'][int(move_id)]
 
 
 def get_move_energy(move_id):
-    return i8ln(get_moves_data(move_id)['energy'])
+    return get_move_tables()['move_energy'][int(move_id)]
 
 
 def get_move_type(move_id):
-    move_type = get_moves_data(move_id)['type']
-    return {"type": i8ln(move_type), "type_en": move_type}
+    return get_move_tables()['move_type'][int(move_id)]
 
 
 class Timer():
@@ -20,12 +20,13 @@ from flask_cache_bust import init_cache_busting
 
 from pogom import config
 from pogom.app import Pogom
-from pogom.utils import get_args, now, extract_sprites
+from pogom.utils import get_args, now, extract_sprites, get_locale_tables
 from pogom.altitude import get_gmaps_altitude
 
 from pogom.search import search_overseer_thread
 from pogom.models import (init_database, create_tables, drop_tables,
-                          Pokemon, db_updater, clean_db_loop)
+                          Pokemon, db_updater, new_db_queue, clean_db_loop,
+                          pokemon_index_loop, pokemon_history_loop)
 from pogom.webhook import wh_updater
 
 from pogom.proxy import check_proxies, proxies_refresher
@@ -264,7 +265,8 @@ def main():
     new_location_queue.put(position)
 
     # DB Updates
-    db_updates_queue = Queue()
+    db_updates_queue = new_db_queue(args)
+    app.set_db_updates_queue(db_updates_queue)
 
     # Thread(s) to process database updates.
     for i in range(args.db_threads):
@@ -274,12 +276,28 @@ def main():
         t.daemon = True
         t.start()
 
+    # Write what the last run left in the journal, before scanning.
+    db_updates_queue.replay_journal()
+
+    # Move disappeared Pokemon to the history.
+    t = Thread(target=pokemon_history_loop, name='pokemon-history',
+               args=(args, db))
+    t.daemon = True
+    t.start()
+
     # db cleaner; really only need one ever.
     if not args.disable_clean:
         t = Thread(target=clean_db_loop, name='db-cleaner', args=(args,))
         t.daemon = True
         t.start()
 
+    # Keep the Pokemon index in sync with other instances.
+    if args.pokemon_index and args.pokemon_index_sync > 0:
+        t = Thread(target=pokemon_index_loop, name='pokemon-index',
+                   args=(args,))
+        t.daemon = True
+        t.start()
+
     # WH updates queue & WH gym/pokéstop unique key LFU cache.
     # The LFU cache will stop the server from resending the same data an
     # infinite number of times.
@@ -346,6 +364,9 @@ def main():
     config['ROOT_PATH'] = app.root_path
     config['GMAPS_KEY'] = args.gmaps_key
 
+    # Resolve the Pokemon and move tables now, not on the first map request.
+    get_locale_tables()
+
     if args.no_server:
         # This loop allows for ctrl-c interupts to work since flask won't be
         # holding the program open.
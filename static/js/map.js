@@ -29,6 +29,7 @@ var languageLookupThreshold = 3
 var searchMarkerStyles
 
 var timestamp
+var seq
 var excludedPokemon = []
 var notifiedPokemon = []
 var notifiedRarity = []
@@ -1109,6 +1110,7 @@ function loadRawData() {
         type: 'GET',
         data: {
             'timestamp': timestamp,
+            'since': seq,
             'pokemon': loadPokemon,
             'lastpokemon': lastpokemon,
             'pokestops': loadPokestops,
@@ -1431,6 +1433,7 @@ function updateMap() {
             }, reincludedPokemon)
         }
         timestamp = result.timestamp
+        seq = result.seq
         lastUpdateTime = Date.now()
     })
 }
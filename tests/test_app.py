@@ -0,0 +1,40 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+import zlib
+
+# The models read the command line when they're imported, the first test
+# module to import them sets it for all.
+DB = os.path.join(tempfile.gettempdir(), 'rocketmap-test.db')
+sys.argv = ['runserver.py', '-os', '-l', '40.75,-73.97', '-k', 'key',
+            '--db', DB, '--disable-blacklist']
+
+from pogom.app import Pogom  # noqa: E402
+from pogom.encoding import JSON  # noqa: E402
+
+
+class MapResponseTest(unittest.TestCase):
+    def setUp(self):
+        app = Pogom(__name__)
+        rows = [{'pokemon_id': i % 151 + 1} for i in range(200)]
+        app.add_url_rule('/payload', 'payload', lambda: app.map_response(
+            {'pokemons': iter(rows)}, JSON))
+        self.client = app.test_client()
+
+    def get(self, accept_encoding):
+        return self.client.get('/payload',
+                               headers={'Accept-Encoding': accept_encoding})
+
+    def test_gzip(self):
+        r = self.get('gzip, deflate')
+        self.assertEqual('gzip', r.headers['Content-Encoding'])
+        body = zlib.decompress(r.data, 16 + zlib.MAX_WBITS)
+        self.assertEqual(200, len(json.loads(body)['pokemons']))
+
+    def test_gzip_refused(self):
+        # Flask-Compress only looks for 'gzip' in the header.
+        r = self.get('gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(200, len(json.loads(r.data)['pokemons']))
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from threading import Thread
+from pogom.cache import SingleFlight, SharedCache, GymCache
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_concurrent_callers_share_fetch(self):
+        flight = SingleFlight(ttl=60)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.1)
+            return [1, 2]
+
+        results = []
+        threads = [Thread(target=lambda: results.append(
+            flight.do('key', fetch))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([[1, 2]] * 5, results)
+        self.assertEqual([1, 2], flight.do('key', fetch))
+
+        stats = flight.stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(4, stats['waits'])
+        self.assertEqual(1, stats['hits'])
+
+    def test_results_are_copies(self):
+        flight = SingleFlight(ttl=60)
+        flight.do('key', lambda: {'a': 1})['b'] = 2
+        self.assertEqual({'a': 1}, flight.do('key', lambda: {}))
+
+    def test_quantize(self):
+        flight = SingleFlight(ttl=5, grid=0.01)
+        self.assertEqual((40.7, -74.03, 40.81, -73.92),
+                         flight.quantize('40.701', '-74.021',
+                                         '40.801', '-73.921'))
+        self.assertEqual((40.71, -74.02, 40.8, -73.93),
+                         flight.quantize(40.701, -74.021, 40.801, -73.921,
+                                         inner=True))
+
+
+class SharedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_set(self):
+        cache = SharedCache(self.path, ttl=60)
+        self.assertEqual((False, None), cache.get(('key', 1)))
+        cache.set(('key', 1), [{'a': 1}])
+        self.assertEqual((True, [{'a': 1}]), cache.get(('key', 1)))
+
+        cache.ttl = -1
+        self.assertEqual((False, None), cache.get(('key', 1)))
+        cache.sweep()
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_processes_share_fetches(self):
+        flights = [SingleFlight(ttl=60, shared=SharedCache(self.path, 60))
+                   for _ in range(2)]
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return [1, 2]
+
+        self.assertEqual([1, 2], flights[0].do('key', fetch))
+        self.assertEqual([1, 2], flights[1].do('key', fetch))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, flights[1].stats()['shared_hits'])
+
+
+def gym(gym_id, team_id=1, last_modified=datetime(2017, 1, 1)):
+    return {'gym_id': gym_id, 'team_id': team_id, 'guard_pokemon_id': 1,
+            'gym_points': 100, 'last_modified': last_modified}
+
+
+class GymCacheTest(unittest.TestCase):
+    def test_fill_after_write_is_dropped(self):
+        cache = GymCache()
+        found, generation = cache.get(['a', 'b'])
+        self.assertEqual({}, found)
+
+        cache.refresh({'a': gym('a', team_id=2)})
+        cache.fill({'a': gym('a'), 'b': gym('b')}, generation)
+        self.assertEqual(({'a': gym('a', team_id=2)}, 1),
+                         cache.get(['a', 'b']))
+
+        cache.fill({'b': gym('b')}, 1)
+        self.assertEqual(['a', 'b'], sorted(cache.get(['a', 'b'])[0]))
+
+    def test_update(self):
+        cache = GymCache()
+        cache.refresh({'a': gym('a'), 'b': gym('b')})
+        cache.update([gym('a', last_modified=datetime(2017, 1, 1, 0, 0, 0,
+                                                      500000)),
+                      gym('b', team_id=3), gym('c')])
+        self.assertEqual(['a'], cache.get(['a', 'b', 'c'])[0].keys())
@@ -0,0 +1,186 @@
+import unittest
+from collections import OrderedDict
+
+from pogom.dbqueue import UpdateQueue, WriteBuffer, LastWritten, HIGH, LOW
+
+
+class Pokemon(object):
+    pass
+
+
+class Stop(object):
+    pass
+
+
+class Status(object):
+    pass
+
+
+def new_queue(maxsize, policy):
+    return UpdateQueue(maxsize=maxsize, policy=policy,
+                       priorities={Pokemon: HIGH, Status: LOW},
+                       collapse=(Status,), key=lambda model: ('name',))
+
+
+class UpdateQueueTest(unittest.TestCase):
+    def test_priority_and_collapse(self):
+        q = new_queue(2, 'block')
+        q.put((Status, {0: {'name': 'a', 'n': 1}}))
+        q.put((Stop, {'s': {}}))
+        q.put((Status, {0: {'name': 'a', 'n': 2}, 1: {'name': 'b'}}))
+        q.put((Pokemon, {'p': {}}))
+        self.assertEqual({'Status': 1, 'Stop': 1, 'Pokemon': 1}, q.depth())
+
+        # Status updates don't take room.
+        self.assertTrue(q.full())
+        self.assertEqual([Pokemon, Stop, Status],
+                         [q.get_nowait()[0] for _ in range(2)] +
+                         [q.get(timeout=0)[0]])
+
+    def test_drop(self):
+        q = new_queue(2, 'drop')
+        q.put((Stop, {'s': 1}))
+        q.put((Pokemon, {'p': 1}))
+        q.put((Pokemon, {'p': 2}))
+        q.put((Stop, {'s': 2}))
+        self.assertEqual([(Pokemon, {'p': 1}), (Pokemon, {'p': 2})],
+                         [q.get(), q.get()])
+        self.assertEqual({'Stop': 2}, q.stats()['dropped'])
+
+    def test_spill(self):
+        q = new_queue(1, 'spill')
+        for i in range(3):
+            q.put((Stop, {'s': i}))
+        q.put((Pokemon, {'p': 0}))
+        self.assertEqual({'Stop': 3, 'Pokemon': 1}, q.depth())
+        self.assertEqual([{'s': 0}, {'s': 1}, {'s': 2}, {'p': 0}],
+                         [q.get()[1] for _ in range(4)])
+        self.assertTrue(q.empty())
+
+
+class WriteBufferTest(unittest.TestCase):
+    def test_merge_by_key(self):
+        buf = WriteBuffer(max_rows=10, max_delay=1)
+        buf.add('worker', [{'username': 'a', 'success': 1},
+                           {'username': 'b', 'success': 1}],
+                ('username',), now=0)
+        buf.add('worker', [{'username': 'a', 'success': 2}],
+                ('username',), now=0.5)
+        self.assertEqual(2, len(buf))
+
+        # Not due until the oldest row has waited long enough.
+        self.assertEqual(0.5, buf.wait(now=0.5))
+        self.assertIsNone(buf.take(now=0.5))
+
+        model, batches = buf.take(now=1)
+        self.assertEqual('worker', model)
+        self.assertEqual([[('b',), ('a',)]], [b.keys() for b in batches])
+        self.assertEqual(2, batches[0][('a',)]['success'])
+
+        buf.done(model, 2, 0.1)
+        stats = buf.stats()
+        self.assertEqual(1.5, stats['coalescing_ratio'])
+        self.assertEqual(100, stats['max_flush_ms'])
+        self.assertIsNone(buf.wait())
+
+    def test_flush_on_size(self):
+        buf = WriteBuffer(max_rows=2, max_delay=60)
+        buf.add('member', [{'gym_id': 'g'}, {'gym_id': 'g'}], None, now=0)
+        self.assertEqual(0, buf.wait(now=0))
+
+        # Rows without a key aren't merged, columns are batched apart.
+        buf.add('spawn', [{'id': 1, 'kind': 'ssss'}, {'id': 2}], ('id',),
+                now=0)
+        model, batches = buf.take(now=0)
+        self.assertEqual('member', model)
+        self.assertEqual([2], map(len, batches))
+        model, batches = buf.take(now=0)
+        self.assertEqual('spawn', model)
+        self.assertEqual([1, 1], map(len, batches))
+
+    def test_one_writer_per_model(self):
+        buf = WriteBuffer(max_rows=0)
+        buf.add('worker', [{'username': 'a'}], ('username',))
+        model, batches = buf.take()
+        buf.add('worker', [{'username': 'a'}], ('username',))
+        self.assertIsNone(buf.wait())
+        self.assertIsNone(buf.take())
+
+        buf.done(model, 1, 0)
+        self.assertEqual('worker', buf.take()[0])
+
+    def test_restore(self):
+        buf = WriteBuffer(max_rows=10, max_delay=60)
+        buf.add('worker', [{'username': 'a', 'success': 1},
+                           {'username': 'b', 'success': 1}],
+                ('username',), now=0, token=1)
+        model, batches = buf.take(now=60)
+        buf.add('worker', [{'username': 'a', 'success': 2}],
+                ('username',), now=60, token=2)
+
+        # The write failed: no rows are lost, the newer one wins, and no
+        # more are taken from the queue until rows are written.
+        buf.restore(model, batches)
+        self.assertEqual(2, len(buf))
+        self.assertTrue(buf.full())
+        model, batches = buf.take(now=60)
+        self.assertEqual([[('b',), ('a',)]], [b.keys() for b in batches])
+        self.assertEqual(2, batches[0][('a',)]['success'])
+
+        self.assertEqual([1, 2], buf.done(model, 2, 0))
+        self.assertFalse(buf.full())
+        self.assertEqual(1, buf.stats()['failed_flushes'])
+
+    def test_finished(self):
+        buf = WriteBuffer(max_rows=0)
+        buf.add('worker', [{'username': 'a'}], ('username',), token=1)
+        buf.add('worker', [{'username': 'a'}], ('username',))
+        buf.add('spawn', [{'id': 1}], ('id',))
+        model, batches = buf.take()
+
+        # Entries are finished once their rows are written, not when
+        # they're merged.
+        self.assertEqual(0, buf.finished())
+        buf.restore(model, batches)
+        self.assertEqual(0, buf.finished())
+        self.assertEqual('spawn', buf.take()[0])
+        self.assertEqual(model, buf.take()[0])
+        self.assertEqual([1], buf.done(model, 1, 0))
+        self.assertEqual(2, buf.finished())
+        buf.done('spawn', 1, 0)
+        self.assertEqual(1, buf.finished())
+
+
+class LastWrittenTest(unittest.TestCase):
+    def test_split(self):
+        last = LastWritten()
+        stop = {'pokestop_id': 'a', 'enabled': True, 'lure': None}
+        data = OrderedDict([(('a',), stop)])
+        self.assertEqual([(None, data)], last.split(data))
+        last.store(data)
+
+        # Unchanged rows aren't written again, changed ones only the
+        # columns that changed.
+        self.assertEqual([], last.split(data))
+        lured = OrderedDict([(('a',), dict(stop, lure=1)),
+                             (('b',), {'pokestop_id': 'b'})])
+        self.assertEqual([(('lure',), ['a']), (None, ['b'])],
+                         [(c, [k[0] for k in rows])
+                          for c, rows in last.split(lured)])
+        self.assertEqual({'unchanged': 1, 'changed': 1, 'new': 2,
+                          'remembered': 1}, last.stats())
+
+    def test_ttl(self):
+        now = [0]
+        last = LastWritten(ttl=10, timer=lambda: now[0])
+        gym = OrderedDict([(('g',), {'gym_id': 'g', 'team_id': 1})])
+        last.store(gym)
+        now[0] = 5
+        changed = OrderedDict([(('g',), {'gym_id': 'g', 'team_id': 2})])
+        self.assertEqual([('team_id',)], [c for c, _ in last.split(changed)])
+        last.store(changed)
+
+        # Rows are written whole, with the columns left to their defaults,
+        # once their time to live from the last whole write is up.
+        now[0] = 11
+        self.assertEqual([None], [c for c, _ in last.split(changed)])
@@ -0,0 +1,69 @@
+import unittest
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from pogom import encoding
+
+
+class EncodingTest(unittest.TestCase):
+    def test_to_columns(self):
+        types = [{'type': 'Grass'}]
+        rows = [{'pokemon_id': 1, 'pokemon_name': 'Bulbasaur',
+                 'pokemon_types': types},
+                {'pokemon_id': 1, 'pokemon_name': 'Bulbasaur',
+                 'pokemon_types': types},
+                {'pokemon_id': 2, 'pokemon_name': 'Ivysaur',
+                 'pokemon_types': list(types), 'gender': 1},
+                {'pokemon_id': 1, 'pokemon_name': 'Bulbasaur',
+                 'pokemon_types': types}]
+        result = encoding.to_columns(rows)
+
+        self.assertEqual(4, result['count'])
+        columns = result['columns']
+        self.assertEqual([1, 1, 2, 1], columns['pokemon_id'])
+        self.assertEqual([None, None, 1, None], columns['gender'])
+        self.assertEqual({'values': ['Bulbasaur', 'Ivysaur'],
+                          'index': [0, 0, 1, 0]}, columns['pokemon_name'])
+        self.assertEqual({'values': [types], 'index': [0, 0, 0, 0]},
+                         columns['pokemon_types'])
+
+    def test_columnar(self):
+        d = {'gyms': {'g': {'gym_id': 'g', 'team_id': 1}},
+             'pokemons': iter([{'pokemon_id': 1}]),
+             'spawns': [1, 2],
+             'timestamp': 1,
+             # Stats of the status page aren't rows.
+             'db_writes': {'written': 3, 'coalescing_ratio': 0.5,
+                           'pokestop': {'changed': 1}}}
+        result = encoding.columnar(d)
+
+        self.assertEqual({'count': 1, 'columns': {'gym_id': ['g'],
+                                                  'team_id': [1]}},
+                         result['gyms'])
+        self.assertEqual({'count': 1, 'columns': {'pokemon_id': [1]}},
+                         result['pokemons'])
+        self.assertEqual([1, 2], result['spawns'])
+        self.assertEqual(1, result['timestamp'])
+        self.assertEqual(d['db_writes'], result['db_writes'])
+
+    def test_choose_format(self):
+        accept = MIMEAccept([('*/*', 1)])
+        self.assertEqual(encoding.JSON, encoding.choose_format(accept))
+        self.assertEqual(encoding.COLUMNS,
+                         encoding.choose_format(accept, 'columns'))
+
+        accept = MIMEAccept([(encoding.COLUMNS, 1)])
+        self.assertEqual(encoding.COLUMNS, encoding.choose_format(accept))
+
+    def test_choose_encoding(self):
+        def choose(header):
+            return encoding.choose_encoding(parse_accept_header(header))
+
+        self.assertEqual('gzip', choose('gzip, deflate'))
+        self.assertEqual('gzip', choose('GZIP;q=0.5, identity'))
+        self.assertIsNone(choose('gzip;q=0, deflate'))
+        self.assertIsNone(choose('*;q=0.5, gzip;q=0'))
+        self.assertIsNone(choose(''))
+        if encoding.brotli is None:
+            self.assertIsNone(choose('br'))
+        else:
+            self.assertEqual('gzip', choose('br;q=0, *'))
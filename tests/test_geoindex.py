@@ -0,0 +1,173 @@
+import unittest
+from datetime import datetime, timedelta
+from s2sphere import CellId, LatLng
+
+from pogom import geoindex
+
+
+def pokemon(encounter_id, lat, lng, minutes=10, pokemon_id=1):
+    return {'encounter_id': encounter_id,
+            'pokemon_id': pokemon_id,
+            'latitude': lat,
+            'longitude': lng,
+            'disappear_time': datetime.utcnow() + timedelta(minutes=minutes)}
+
+
+class CellTest(unittest.TestCase):
+    def test_cell_id(self):
+        # Close locations share a cell, distant ones don't.
+        self.assertEqual(geoindex.cell_id(40.7128, -74.0060),
+                         geoindex.cell_id(40.7129, -74.0061))
+        self.assertNotEqual(geoindex.cell_id(40.7128, -74.0060),
+                            geoindex.cell_id(40.8128, -74.0060))
+
+    def test_cover_bounds(self):
+        cells = geoindex.cover_bounds(40.70, -74.02, 40.80, -73.92)
+        self.assertIn(geoindex.cell_id(40.75, -73.97), cells)
+        self.assertNotIn(geoindex.cell_id(41.75, -73.97), cells)
+
+        # Huge viewports aren't covered.
+        self.assertIsNone(geoindex.cover_bounds(-60, -170, 60, 170))
+
+    def test_tile_ranges(self):
+        tiles = geoindex.tile_range(40.70, -74.02, 40.80, -73.92)
+        bounds = geoindex.range_bounds(tiles)
+        self.assertEqual(tiles, geoindex.inner_tile_range(*bounds))
+
+        # Only whole tiles count as inside the original viewport.
+        inner = geoindex.inner_tile_range(40.70, -74.02, 40.80, -73.92)
+        self.assertEqual(geoindex.range_size(tiles) - 2 * (
+            tiles[2] - tiles[0] + tiles[3] - tiles[1]),
+            geoindex.range_size(inner))
+
+    def test_range_difference(self):
+        a = (0, 0, 9, 9)
+        self.assertEqual([], geoindex.range_difference(a, a))
+        self.assertEqual([a], geoindex.range_difference(a, (20, 20, 30, 30)))
+        self.assertEqual([a], geoindex.range_difference(a, (5, 5, 4, 4)))
+
+        parts = geoindex.range_difference(a, (2, 3, 5, 6))
+        self.assertEqual(100 - 16, sum(map(geoindex.range_size, parts)))
+
+    def test_s2_leaves(self):
+        # Same cells as s2sphere, as signed integers.
+        for lat, lng in ((40.75, -73.97), (-33.87, 151.21), (0, 0),
+                         (90, 0), (-90, 0), (35.68, 139.69)):
+            cell = CellId.from_lat_lng(LatLng.from_degrees(lat, lng)).id()
+            if cell >= 1 << 63:
+                cell -= 1 << 64
+            self.assertEqual(cell, geoindex.s2_leaf(lat, lng))
+
+    def test_s2_ranges(self):
+        bounds = (40.70, -74.02, 40.80, -73.92)
+        ranges = geoindex.s2_ranges(*bounds)
+        self.assertEqual(sorted(ranges), list(ranges))
+        self.assertLess(len(ranges), 50)
+
+        def covered(lat, lng):
+            cell = geoindex.s2_leaf(lat, lng)
+            return any(first <= cell <= last for first, last in ranges)
+
+        for i in range(21):
+            for j in range(21):
+                self.assertTrue(covered(40.70 + i * 0.005,
+                                        -74.02 + j * 0.005))
+        self.assertFalse(covered(40.90, -73.97))
+        self.assertFalse(covered(40.75, -74.20))
+
+
+class ChangeLogTest(unittest.TestCase):
+    def test_since(self):
+        log = geoindex.ChangeLog(size=3, enabled=True)
+        seq = log.record('gym', [('a', 40.75, -73.97)])
+        log.record('gym', [('b', 41.75, -73.97), ('a', 40.75, -73.97)])
+
+        self.assertEqual({'gym': set(['a', 'b'])}, log.since(seq - 1))
+        self.assertEqual({'gym': set(['a', 'b'])}, log.since(seq))
+        tiles = geoindex.tile_range(40.70, -74.02, 40.80, -73.92)
+        self.assertEqual({'gym': set(['a'])}, log.since(seq, tiles))
+        self.assertEqual({}, log.since(log.seq))
+
+        # Unknown sequence numbers need a full reload.
+        self.assertIsNone(log.since(log.seq + 1))
+        self.assertIsNone(log.since(0))
+        log.record('gym', [('c', 40.75, -73.97)])
+        self.assertIsNone(log.since(seq - 1))
+
+
+class PokemonIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = geoindex.PokemonIndex(enabled=True)
+        self.index.add([pokemon('a', 40.75, -73.97),
+                        pokemon('b', 40.76, -73.98, pokemon_id=149),
+                        pokemon('c', 41.75, -73.97)])
+
+    def ids(self, rows):
+        return sorted(r['encounter_id'] for r in rows)
+
+    def test_query_bounds(self):
+        self.assertEqual(['a', 'b'], self.ids(
+            self.index.query('40.70', '-74.02', '40.80', '-73.92')))
+        self.assertEqual(['a', 'b', 'c'], self.ids(self.index.query()))
+
+    def test_query_filters(self):
+        self.assertEqual(['b'], self.ids(
+            self.index.query(40.70, -74.02, 40.80, -73.92, ids=[149])))
+        self.assertEqual(['b'], self.ids(
+            self.index.query(40.70, -74.02, 40.80, -73.92,
+                             exclude=(40.70, -74.02, 40.755, -73.92))))
+
+        since = datetime.utcnow()
+        self.index.add([pokemon('d', 40.77, -73.99)])
+        self.assertEqual(['d'], self.ids(
+            self.index.query(40.70, -74.02, 40.80, -73.92, since=since)))
+
+    def test_despawn(self):
+        self.index.add([pokemon('old', 40.75, -73.97, minutes=-1)])
+        self.assertEqual(3, len(self.index))
+
+        self.index.remove_expired(datetime.utcnow() + timedelta(minutes=11))
+        self.assertEqual(0, len(self.index))
+
+    def test_rows_are_copies(self):
+        self.index.query()[0]['pokemon_name'] = 'Bulbasaur'
+        self.assertNotIn('pokemon_name', self.index.query()[0])
+
+    def test_cold_start_keeps_new_rows(self):
+        self.index.ensure_loaded(lambda: [pokemon('a', 0, 0),
+                                          pokemon('e', 40.75, -73.97)])
+        self.assertEqual(['a', 'b', 'e'], self.ids(
+            self.index.query(40.70, -74.02, 40.80, -73.92)))
+
+    def test_nearest(self):
+        self.index.add([pokemon('p%d' % i, 40.75 + i * 0.002, -73.97)
+                        for i in range(1, 200)])
+        ranked = geoindex.nearest(self.index.nearest(40.75, -73.97, limit=3),
+                                  40.75, -73.97, limit=3)
+        self.assertEqual(['a', 'p1', 'p2'], [r[0]['encounter_id']
+                                             for r in ranked])
+        self.assertEqual('', ranked[0][2])
+        self.assertEqual('N', ranked[1][2])
+        self.assertAlmostEqual(222, ranked[1][1], delta=1)
+
+        # Only the rings up to the nearest Pokemon had to be searched.
+        self.assertLess(len(self.index.nearest(40.75, -73.97, limit=3)), 50)
+
+        ranked = geoindex.nearest(self.index.nearest(40.75, -73.97,
+                                                     radius=500),
+                                  40.75, -73.97, radius=500)
+        self.assertEqual(['a', 'p1', 'p2'], [r[0]['encounter_id']
+                                             for r in ranked])
+
+
+class TileVersionsTest(unittest.TestCase):
+    def test_bump(self):
+        versions = geoindex.TileVersions(enabled=True)
+        x, y = geoindex.tile_xy(40.75, -73.97, 15)
+        before = versions.etag(15, x, y)
+        other = versions.etag(15, x + 1, y)
+
+        versions.bump([(40.75, -73.97)])
+        self.assertNotEqual(before, versions.etag(15, x, y))
+        self.assertNotEqual(before, versions.etag(12, x >> 3, y >> 3))
+        self.assertEqual(other, versions.etag(15, x + 1, y))
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pogom.dbqueue import UpdateQueue, WriteBuffer
+from pogom.journal import Journal
+
+
+class Stop(object):
+    pass
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_replay(self):
+        journal = Journal(self.path, segment_size=1)
+        tokens = [journal.append((Stop, {'s': i})) for i in range(3)]
+        journal.commit(tokens[1:2])
+        self.assertEqual(2, len(os.listdir(self.path)))
+
+        # A crash cutting the last record short.
+        last = os.path.join(self.path, sorted(os.listdir(self.path))[-1])
+        with open(last, 'r+b') as f:
+            f.truncate(os.path.getsize(last) - 1)
+
+        journal = Journal(self.path)
+        self.assertEqual([(Stop, {'s': 0})], list(journal.replay()))
+        self.assertEqual([], os.listdir(self.path))
+        self.assertEqual(1, journal.stats()['corrupt_segments'])
+
+    def test_commit_written(self):
+        q = UpdateQueue(key=lambda model: ('s',),
+                        journal=Journal(self.path))
+        buf = WriteBuffer(max_rows=0)
+        for i in range(2):
+            q.put((Stop, {i: {'s': i}}))
+            model, data, token = q.get_entry()
+            buf.add(model, data.values(), ('s',), token=token)
+        model, batches = buf.take()
+        self.assertEqual(1, len(os.listdir(self.path)))
+
+        # Rows of the journal aren't written anywhere else.
+        q.journal.commit(buf.done(model, 2, 0))
+        self.assertEqual([], os.listdir(self.path))
+        self.assertEqual(0, q.stats()['journal']['pending'])
@@ -0,0 +1,32 @@
+import calendar
+import json
+import unittest
+import zlib
+from datetime import datetime
+from pogom import jsonstream
+
+
+class JsonStreamTest(unittest.TestCase):
+    def test_epoch_ms(self):
+        dt = datetime(2017, 3, 4, 5, 6, 7, 891234)
+        self.assertEqual(calendar.timegm(dt.timetuple()) * 1000 + 891,
+                         jsonstream.epoch_ms(dt))
+
+    def test_iter_json(self):
+        d = {'timestamp': datetime(1970, 1, 1, 0, 0, 1),
+             'pokemons': (p for p in [{'pokemon_id': 1}, {'pokemon_id': 2}]),
+             'gyms': {'a': {'team_id': 1}},
+             'scanned': [],
+             'lastgyms': 'true'}
+        text = ''.join(jsonstream.iter_json(d, chunk_size=8))
+        self.assertEqual({'timestamp': 1000,
+                          'pokemons': [{'pokemon_id': 1}, {'pokemon_id': 2}],
+                          'gyms': {'a': {'team_id': 1}},
+                          'scanned': [],
+                          'lastgyms': 'true'}, json.loads(text))
+
+    def test_iter_gzip(self):
+        chunks = ['{"a":', '1}']
+        data = ''.join(jsonstream.iter_gzip(chunks))
+        self.assertEqual('{"a":1}',
+                         zlib.decompress(data, 16 + zlib.MAX_WBITS))
@@ -0,0 +1,47 @@
+import unittest
+from datetime import datetime, timedelta
+from pogom import geoindex
+from pogom.livefeed import LiveFeed, RESYNC
+
+
+def pokemon(encounter_id, lat, lng, minutes=10):
+    return {'encounter_id': encounter_id,
+            'latitude': lat,
+            'longitude': lng,
+            'disappear_time': datetime.utcnow() + timedelta(minutes=minutes)}
+
+
+class LiveFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.feed = LiveFeed(buffer_size=2, enabled=True)
+        self.subscriber = self.feed.subscribe(
+            geoindex.tile_range(40.70, -74.02, 40.80, -73.92))
+
+    def test_publish_filters_cells(self):
+        self.feed.publish('pokemon', [pokemon('a', 40.75, -73.97),
+                                      pokemon('b', 41.75, -73.97)])
+        messages = self.subscriber.get(0)
+        self.assertEqual(1, len(messages))
+        kind, op, rows = messages[0]
+        self.assertEqual(('pokemon', 'update'), (kind, op))
+        self.assertEqual(['a'], [r['encounter_id'] for r in rows])
+
+        self.feed.publish('gym', [{'latitude': 41.75, 'longitude': -73.97}])
+        self.assertEqual([], self.subscriber.get(0))
+
+    def test_slow_subscriber_resyncs(self):
+        for i in range(3):
+            self.feed.publish('pokemon', [pokemon(i, 40.75, -73.97)])
+        self.assertEqual([RESYNC], self.subscriber.get(0))
+
+        self.feed.publish('pokemon', [pokemon('c', 40.75, -73.97)])
+        self.assertEqual(1, len(self.subscriber.get(0)))
+
+    def test_expire(self):
+        self.feed.publish('pokemon', [pokemon('a', 40.75, -73.97)])
+        self.subscriber.get(0)
+
+        self.feed.expire(datetime.utcnow() + timedelta(minutes=11))
+        kind, op, rows = self.subscriber.get(0)[0]
+        self.assertEqual('expired', op)
+        self.assertEqual(['a'], [r['encounter_id'] for r in rows])
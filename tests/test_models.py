@@ -0,0 +1,333 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import Counter
+from datetime import datetime, timedelta
+
+# The models read the command line when they're imported, the first test
+# module to import them sets it for all.
+DB = os.path.join(tempfile.gettempdir(), 'rocketmap-test.db')
+sys.argv = ['runserver.py', '-os', '-l', '40.75,-73.97', '-k', 'key',
+            '--db', DB, '--disable-blacklist']
+
+from flask import Flask  # noqa: E402
+from peewee import OperationalError  # noqa: E402
+from pogom import models  # noqa: E402
+from pogom.journal import Journal  # noqa: E402
+
+db = models.init_database(Flask(__name__))
+
+
+# Records the SQL run by the partition code, which only runs on MySQL.
+class PartitionedDatabase(object):
+    def __init__(self, ends):
+        self.partitions = [(models.partition_name(end), str(end))
+                           for end in ends] + [('pmax', 'MAXVALUE')]
+        self.sql = []
+
+    def execute_sql(self, sql, params=None):
+        self.sql.append(sql)
+        return Cursor(self.partitions if 'information_schema' in sql else [])
+
+
+class Cursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+
+def tearDownModule():
+    db.close()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(DB + suffix):
+            os.remove(DB + suffix)
+
+
+class ModelsTest(unittest.TestCase):
+    def setUp(self):
+        models.drop_tables(db)
+        models.create_tables(db)
+        models.cache.clear()
+        self.now = datetime.utcnow().replace(second=0, microsecond=0)
+
+    # Sightings over three days, the last of them still active. Times are
+    # half a minute off the minute, so windows of whole hours never start
+    # at one.
+    def sightings(self, count=300, seed=1):
+        rand = random.Random(seed)
+        rows = {}
+        for i in range(count):
+            p = {'encounter_id': 'e{}'.format(i),
+                 'spawnpoint_id': 's{}'.format(rand.randint(0, 4)),
+                 'pokemon_id': rand.randint(1, 5),
+                 'latitude': 40.75 + rand.random() / 100,
+                 'longitude': -73.97 + rand.random() / 100,
+                 'disappear_time': self.now - timedelta(
+                     minutes=rand.randint(-30, 3 * 24 * 60), seconds=30)}
+            rows[p['encounter_id']] = p
+        return rows
+
+    def add(self, rows):
+        models.upsert_pokemon(rows, db)
+        models.move_expired_pokemon(db)
+
+    # Sightings counted with a plain GROUP BY over both tables.
+    def group_by(self, fields, after=None, pokemon_id=None):
+        counts = Counter()
+        for model in (models.Pokemon, models.ActivePokemon):
+            columns = [getattr(model, f) for f in fields]
+            query = (model
+                     .select(*(columns +
+                               [models.fn.COUNT(model.encounter_id)
+                                .coerce(False)]))
+                     .group_by(*columns)
+                     .tuples())
+            if after:
+                query = query.where(model.disappear_time > after)
+            if pokemon_id:
+                query = query.where(model.pokemon_id == pokemon_id)
+            for row in query:
+                counts[row[:-1]] += row[-1]
+        return counts
+
+    def seen(self, timediff):
+        models.cache.clear()
+        return Counter(dict(((p['pokemon_id'],), p['count']) for p in
+                            models.Pokemon.get_seen(timediff)['pokemon']))
+
+    def appearances(self, pokemon_id, timediff):
+        return Counter(dict(
+            ((p['spawnpoint_id'],), p['count']) for p in
+            models.Pokemon.get_appearances(pokemon_id, timediff)))
+
+    def assert_stats(self):
+        for hours in (None, 1, 5, 30):
+            timediff = hours and timedelta(hours=hours)
+            after = hours and self.now - timediff
+            self.assertEqual(self.group_by(['pokemon_id'], after),
+                             self.seen(timediff))
+            for pokemon_id in range(1, 6):
+                self.assertEqual(
+                    self.group_by(['spawnpoint_id'], after, pokemon_id),
+                    self.appearances(pokemon_id, timediff))
+
+    def test_stats(self):
+        rows = self.sightings()
+        self.add(rows)
+        self.assertTrue(models.ActivePokemon.select().count())
+        self.assert_stats()
+
+        # Seeing the same Pokemon again doesn't count them twice.
+        self.add(rows)
+        self.assert_stats()
+
+    def test_move_expired(self):
+        rows = self.sightings(count=1100)
+        models.upsert_pokemon(rows, db)
+        now = datetime.utcnow()
+        expired = len([p for p in rows.values()
+                       if p['disappear_time'] <= now])
+        self.assertGreater(expired, 1000)
+
+        self.assertEqual(expired, models.move_expired_pokemon(db))
+        self.assertEqual(expired, models.Pokemon.select().count())
+        self.assertEqual(len(rows) - expired,
+                         models.ActivePokemon.select().count())
+        self.assertEqual(0, models.ActivePokemon.select()
+                         .where(models.ActivePokemon.disappear_time <= now)
+                         .count())
+
+        # Stamped with the time they were moved.
+        self.assertEqual(0, models.Pokemon.select()
+                         .where(models.Pokemon.last_modified < now).count())
+
+    def counted(self, model):
+        return sum(row.count for row in model.select())
+
+    def test_seen_again(self):
+        rows = self.sightings()
+        self.add(rows)
+        rollups = (models.PokemonHourlyCount, models.SpawnpointDailyCount,
+                   models.SpawnpointTimeCount)
+        for model in rollups:
+            self.assertEqual(len(rows), self.counted(model))
+
+        # Its TTH was found after it was moved to the history.
+        p = min(rows.values(), key=lambda p: p['disappear_time'])
+        p = dict(p, disappear_time=p['disappear_time'] + timedelta(hours=1))
+        models.upsert_pokemon({p['encounter_id']: p}, db)
+        hour = models.PokemonHourlyCount.get(
+            pokemon_id=p['pokemon_id'],
+            hour=models.PokemonHourlyCount.bucket(p['disappear_time']))
+        self.assertGreaterEqual(hour.last_seen, p['disappear_time'])
+        for model in rollups:
+            self.assertEqual(len(rows), self.counted(model))
+
+        # Moved again, it replaces the first move.
+        models.move_expired_pokemon(db)
+        self.assertEqual(p['disappear_time'], models.Pokemon.get(
+            encounter_id=p['encounter_id']).disappear_time)
+        self.assert_stats()
+
+        # Seen again in either table.
+        self.add(rows)
+        for model in rollups:
+            self.assertEqual(len(rows), self.counted(model))
+
+    def test_backfill(self):
+        self.add(self.sightings())
+        rollups = (models.PokemonHourlyCount, models.SpawnpointDailyCount)
+        written = dict((model, sorted(model.select().tuples()))
+                       for model in rollups)
+        for model in rollups:
+            model.delete().execute()
+
+        models.backfill_pokemon_stats(db, batch_size=40)
+        models.backfill_pokemon_stats(db, source=models.ActivePokemon)
+        for model in rollups:
+            self.assertEqual(written[model], sorted(model.select().tuples()))
+        self.assert_stats()
+
+    def test_purge(self):
+        self.add(self.sightings())
+        deleted = models.purge_pokemon(self.now - timedelta(days=1),
+                                       batch_size=40)
+        self.assertTrue(deleted)
+        self.assert_stats()
+
+        # Rows with nothing left are gone, the spawnpoint layer only has
+        # what's left.
+        for model in (models.PokemonHourlyCount, models.SpawnpointDailyCount,
+                      models.SpawnpointTimeCount):
+            self.assertEqual(0, model.select()
+                             .where(model.count <= 0).count())
+        times = Counter(
+            (p.spawnpoint_id,
+             models.SpawnpointTimeCount.bucket(p.disappear_time))
+            for model in (models.Pokemon, models.ActivePokemon)
+            for p in model.select())
+        self.assertEqual(times, Counter(dict(
+            ((t.spawnpoint_id, t.time), t.count)
+            for t in models.SpawnpointTimeCount.select())))
+
+    def test_purge_batches(self):
+        self.add(self.sightings())
+        before = self.now - timedelta(days=2)
+        old = (models.Pokemon.select()
+               .where(models.Pokemon.disappear_time < before).count())
+        kept = models.Pokemon.select().count() - old
+        self.assertGreater(old, 7)
+
+        self.assertEqual(old, models.purge_pokemon(before, batch_size=7))
+        self.assertEqual(kept, models.Pokemon.select().count())
+        self.assertEqual(0, models.Pokemon.select()
+                         .where(models.Pokemon.disappear_time < before)
+                         .count())
+
+    def test_write_failed(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        journal = Journal(path)
+        stops = dict((str(i), {'pokestop_id': str(i), 'enabled': True,
+                               'latitude': 40.75, 'longitude': -73.97,
+                               'last_modified': self.now})
+                     for i in range(3))
+        models.write_buffer.add(models.Pokestop, stops.values(),
+                                ('pokestop_id',), now=0,
+                                token=journal.append((models.Pokestop, stops)))
+
+        def locked(*args, **kwargs):
+            raise OperationalError('database is locked')
+
+        bulk_upsert = models.bulk_upsert
+        models.bulk_upsert = locked
+        try:
+            self.assertRaises(OperationalError, models.write_buffered, db,
+                              journal)
+        finally:
+            models.bulk_upsert = bulk_upsert
+        self.assertEqual(1, journal.stats()['pending'])
+        self.assertEqual(3, len(models.write_buffer))
+        self.assertTrue(models.write_buffer.full())
+
+        # Written once the database is back.
+        models.write_buffered(db, journal)
+        self.assertEqual(3, models.Pokestop.select().count())
+        self.assertEqual(0, journal.stats()['pending'])
+        self.assertFalse(models.write_buffer.full())
+
+    def test_in_bounds(self):
+        stops = [{'pokestop_id': str(i), 'enabled': True,
+                  'latitude': 40.75 + i / 1000.0, 'longitude': -73.97,
+                  'last_modified': self.now} for i in range(4)]
+        # The last ones are written without S2 cells, by an instance from
+        # before they were added.
+        models.add_s2cells(stops[:2])
+        for stop in stops:
+            models.Pokestop.insert(**stop).execute()
+
+        query = (models.Pokestop
+                 .select(models.Pokestop.pokestop_id)
+                 .where(models.in_bounds(models.Pokestop, 40.7505, -73.971,
+                                         40.7525, -73.969))
+                 .tuples())
+        self.assertEqual(['1', '2'], sorted(p for p, in query))
+
+    def location_indexes(self, table):
+        return [index.name for index in db.get_indexes(table)
+                if index.columns == ['latitude', 'longitude']]
+
+    def test_location_indexes(self):
+        tables = ('activepokemon', 'pokestop', 'gym', 'locationaltitude',
+                  'scannedlocation', 'spawnpoint')
+        for table in tables:
+            names = self.location_indexes(table)
+            self.assertTrue(names)
+            for name in names:
+                db.execute_sql('DROP INDEX "{}"'.format(name))
+
+        # Databases from before the indexes were added back.
+        models.Versions.update(val=22).execute()
+        models.verify_database_schema(db)
+        for table in tables:
+            self.assertTrue(self.location_indexes(table))
+
+
+class PartitionTest(unittest.TestCase):
+    def test_partition_name(self):
+        # TO_SECONDS('1970-01-01') in MySQL.
+        self.assertEqual(62167219200, models.to_seconds(datetime(1970, 1, 1)))
+        end = models.to_seconds(datetime(2017, 3, 4, 6))
+        self.assertEqual(0, end % (6 * 3600))
+        self.assertEqual('p2017030406', models.partition_name(end))
+
+    def test_rotate(self):
+        size = 6 * 3600
+        hour = models.to_seconds(datetime.utcnow()) // size * size
+        db = PartitionedDatabase([hour - 2 * size, hour - size, hour + size])
+
+        dropped = models.rotate_pokemon_partitions(
+            db, 6, before=datetime.utcnow() - timedelta(hours=6))
+        self.assertEqual(2, dropped)
+
+        # Partitions are added two ahead, on the hours that are a multiple
+        # of the partition size.
+        reorganize = [sql for sql in db.sql if 'REORGANIZE' in sql]
+        self.assertEqual(1, len(reorganize))
+        self.assertIn('PARTITION {} VALUES LESS THAN ({}), '.format(
+            models.partition_name(hour + 2 * size), hour + 2 * size),
+            reorganize[0])
+        self.assertNotIn(str(hour + 4 * size), reorganize[0])
+
+        # The rows of the dropped partitions are read first, to take them
+        # out of the stats.
+        names = ', '.join(models.partition_name(end)
+                          for end in (hour - 2 * size, hour - size))
+        self.assertIn('PARTITION ({})'.format(names), db.sql[-2])
+        self.assertEqual('ALTER TABLE pokemon DROP PARTITION ' + names,
+                         db.sql[-1])
@@ -0,0 +1,82 @@
+import unittest
+from peewee import (SqliteDatabase, Model, CharField, IntegerField,
+                    CompositeKey)
+
+from pogom import upsert
+
+db = SqliteDatabase(':memory:')
+
+
+class Stop(Model):
+    stop_id = CharField(primary_key=True)
+    name = CharField(null=True)
+    visits = IntegerField(default=0)
+
+    class Meta:
+        database = db
+
+
+class Link(Model):
+    a = CharField()
+    b = CharField()
+
+    class Meta:
+        database = db
+        primary_key = CompositeKey('a', 'b')
+
+
+class UpsertTest(unittest.TestCase):
+    def setUp(self):
+        db.create_tables([Stop, Link])
+
+    def tearDown(self):
+        db.drop_tables([Stop, Link])
+
+    def test_upsert(self):
+        upsert.upsert(db, Stop, [{'stop_id': 'a', 'name': 'A'},
+                                 {'stop_id': 'b', 'name': 'B', 'visits': 2}],
+                      max_rows=1)
+        upsert.upsert(db, Stop, [{'stop_id': 'b', 'visits': 3},
+                                 {'stop_id': 'c', 'visits': 1}])
+
+        # Columns that aren't written keep their values.
+        self.assertEqual([('a', 'A', 0), ('b', 'B', 3), ('c', None, 1)],
+                         [(s.stop_id, s.name, s.visits)
+                          for s in Stop.select().order_by(Stop.stop_id)])
+
+    def test_update_columns(self):
+        upsert.upsert(db, Stop, [{'stop_id': 'a', 'name': 'A'}])
+        upsert.upsert(db, Stop, [{'stop_id': 'a', 'name': 'B', 'visits': 1},
+                                 {'stop_id': 'b', 'name': 'B', 'visits': 1}],
+                      update=['visits'])
+
+        # New rows are inserted whole.
+        self.assertEqual([('a', 'A', 1), ('b', 'B', 1)],
+                         [(s.stop_id, s.name, s.visits)
+                          for s in Stop.select().order_by(Stop.stop_id)])
+
+    def test_key_only(self):
+        rows = [{'a': 'x', 'b': 'y'}, {'a': 'x', 'b': 'z'}]
+        upsert.upsert(db, Link, rows)
+        upsert.upsert(db, Link, rows)
+        self.assertEqual(2, Link.select().count())
+
+    def test_skipped_chunk(self):
+        upsert.upsert(db, Link, [{'a': 'w', 'b': 'x'}, {'a': 'x', 'b': None},
+                                 {'a': 'y', 'b': 'z'}], max_rows=2)
+
+        # The chunk with the bad row isn't written at all.
+        self.assertEqual([('y', 'z')], list(Link.select(Link.a, Link.b)
+                                            .tuples()))
+
+    def test_sql(self):
+        fields = upsert.row_fields(Stop, [{'stop_id': 'a', 'name': 'A'}])
+        self.assertEqual(['stop_id', 'name', 'visits'],
+                         [f.name for f in fields])
+        if upsert.SQLITE_UPSERT:
+            self.assertEqual(
+                'INSERT INTO "stop" ("stop_id", "name", "visits") '
+                'VALUES (?, ?, ?), (?, ?, ?) ON CONFLICT ("stop_id") '
+                'DO UPDATE SET "name" = excluded."name", '
+                '"visits" = excluded."visits"',
+                upsert.upsert_sql(db, Stop, fields, 2))
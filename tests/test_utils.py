@@ -16,3 +16,9 @@ class UtilsTest(unittest.TestCase):
 
         # Unknown ID raises KeyError
         self.assertRaises(KeyError, utils.get_pokemon_name, 12367)
+
+    def test_add_pokemon_locale(self):
+        p = {'pokemon_id': 149}
+        utils.add_pokemon_locale(p)
+        self.assertEqual("Dragonite", p['pokemon_name'])
+        self.assertEqual(utils.get_pokemon_types(149), p['pokemon_types'])
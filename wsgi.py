@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# WSGI entry point for serving the map from a pre-forking server, in
+# processes of their own next to a scanner started with runserver.py:
+#
+#   gunicorn --workers 4 --bind 0.0.0.0:5000 wsgi:app
+#
+# Arguments are read from config/config.ini (or the file POGOMAP_CONFIG
+# points to) and POGOMAP_* environment variables, the command line belongs
+# to the WSGI server. The map always runs as --only-server. Database
+# connections are only opened by requests, so every worker process gets a
+# connection pool of its own, even when the app is preloaded. For the same
+# reason the Pokemon index of a worker starts syncing on its first request,
+# threads don't survive the fork into the workers.
+
+import logging
+import re
+import sys
+from queue import Queue
+from threading import Event, Thread
+
+logging.basicConfig(
+    format='%(asctime)s [%(process)6d][%(module)14s][%(levelname)8s] ' +
+    '%(message)s')
+log = logging.getLogger()
+
+
+def create_app():
+    # pogom reads its arguments on import.
+    sys.argv = sys.argv[:1] + ['--only-server']
+
+    from flask_cors import CORS
+    from flask_cache_bust import init_cache_busting
+
+    from pogom import config
+    from pogom.app import Pogom
+    from pogom.models import init_database, pokemon_index_loop
+    from pogom.utils import get_args, now, get_locale_tables
+
+    args = get_args()
+    log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    logging.getLogger('peewee').setLevel(logging.INFO)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    # Web processes don't look up locations or altitudes, the scanner does.
+    res = re.match(r'^(\-?\d+\.\d+),?\s?(\-?\d+\.\d+)$', args.location)
+    if not res:
+        log.critical('The WSGI app needs the location as coordinates.')
+        sys.exit(1)
+    position = (float(res.group(1)), float(res.group(2)), 0)
+
+    # Only the scanner's process sees what it scans.
+    if args.live_feed:
+        log.critical('The live feed is not available from the WSGI app, '
+                     'enable it on an instance that scans.')
+        sys.exit(1)
+
+    config['LOCALE'] = args.locale
+    config['CHINA'] = args.china
+
+    app = Pogom(__name__)
+    app.before_request(app.validate_request)
+    init_database(app)
+    app.set_current_location(position)
+
+    if args.cors:
+        CORS(app)
+    init_cache_busting(app)
+
+    # Search controls only make sense in the scanner's process, these keep
+    # the endpoints working.
+    app.set_search_control(Event())
+    app.set_heartbeat_control([now()])
+    app.set_location_queue(Queue())
+
+    # Keep the Pokemon index of each worker in sync with the scanner.
+    def start_index_sync():
+        t = Thread(target=pokemon_index_loop, name='pokemon-index',
+                   args=(args,))
+        t.daemon = True
+        t.start()
+
+    if args.pokemon_index and args.pokemon_index_sync > 0:
+        app.before_first_request(start_index_sync)
+
+    config['ROOT_PATH'] = app.root_path
+    config['GMAPS_KEY'] = args.gmaps_key
+    get_locale_tables()
+
+    return app
+
+
+app = create_app()